@@ -0,0 +1,134 @@
+"""
+Serves KaTeX, its fonts and the preview stylesheets at `draftsmith://assets/`.
+
+Pages built by `Markdown.build_html` used to inline several hundred KB of
+KaTeX into every preview, palette preview and math popup. Once the handler
+is installed they link to these URLs instead, and as each URL names one
+version of a file, see `markdown_render.asset_url`, the engine can keep it
+cached for good.
+"""
+
+import mimetypes
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from PyQt6.QtCore import QBuffer, QByteArray, QIODevice
+from PyQt6.QtWebEngineCore import (
+    QWebEngineProfile,
+    QWebEngineUrlRequestJob,
+    QWebEngineUrlScheme,
+    QWebEngineUrlSchemeHandler,
+)
+
+from markdown_render import ASSET_DIRECTORIES, KATEX_DIR
+
+SCHEME = b"draftsmith"
+HOST = "assets"
+
+CONTENT_TYPES = {
+    ".css": "text/css",
+    ".js": "text/javascript",
+    ".woff": "font/woff",
+    ".woff2": "font/woff2",
+    ".ttf": "font/ttf",
+}
+
+# Sent with every reply, URLs change with the file so can be cached for good
+RESPONSE_HEADERS = {
+    b"Cache-Control": [b"public, max-age=31536000, immutable"],
+    # Fonts are fetched with CORS, the previews are file:// pages
+    b"Access-Control-Allow-Origin": [b"*"],
+}
+
+
+def register_scheme() -> None:
+    """
+    Registers `draftsmith://`, must be called before the QApplication is created.
+    """
+    scheme = QWebEngineUrlScheme(SCHEME)
+    scheme.setSyntax(QWebEngineUrlScheme.Syntax.Host)
+    scheme.setFlags(
+        QWebEngineUrlScheme.Flag.SecureScheme
+        | QWebEngineUrlScheme.Flag.LocalAccessAllowed
+        | QWebEngineUrlScheme.Flag.CorsEnabled
+    )
+    QWebEngineUrlScheme.registerScheme(scheme)
+
+
+class AssetSchemeHandler(QWebEngineUrlSchemeHandler):
+    """
+    Answers `draftsmith://assets/<directory>/<path>` from `ASSET_DIRECTORIES`.
+
+    Files are kept in memory until their mtime changes.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.files: Dict[Path, Tuple[int, bytes]] = {}
+
+    def resolve(self, url_path: str) -> Optional[Path]:
+        """
+        The file a URL path names, None unless it is inside a served directory.
+        """
+        name, _, relative = url_path.lstrip("/").partition("/")
+        directory = ASSET_DIRECTORIES.get(name)
+        if directory is None or not relative:
+            return None
+        path = (directory / relative).resolve()
+        if not path.is_relative_to(directory) or not path.is_file():
+            return None
+        return path
+
+    def read(self, path: Path) -> bytes:
+        mtime = path.stat().st_mtime_ns
+        cached = self.files.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = self.files[path] = (mtime, path.read_bytes())
+        return cached[1]
+
+    def requestStarted(self, job: QWebEngineUrlRequestJob):
+        url = job.requestUrl()
+        if url.host() != HOST:
+            job.fail(QWebEngineUrlRequestJob.Error.UrlNotFound)
+            return
+        path = self.resolve(url.path())
+        if path is None:
+            job.fail(QWebEngineUrlRequestJob.Error.UrlNotFound)
+            return
+        try:
+            data = self.read(path)
+        except OSError:
+            job.fail(QWebEngineUrlRequestJob.Error.RequestFailed)
+            return
+        content_type = CONTENT_TYPES.get(path.suffix) or (
+            mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        )
+        # The job deletes the buffer along with itself
+        buffer = QBuffer(job)
+        buffer.setData(QByteArray(data))
+        buffer.open(QIODevice.OpenModeFlag.ReadOnly)
+        job.setAdditionalResponseHeaders(RESPONSE_HEADERS)
+        job.reply(content_type.encode(), buffer)
+
+
+def install_asset_scheme(
+    css_path: Optional[Path] = None, profile: Optional[QWebEngineProfile] = None
+) -> AssetSchemeHandler:
+    """
+    Serves KaTeX and a stylesheet directory to a profile's pages, which from
+    then on link to them rather than inlining them.
+
+    Args:
+        css_path (Optional[Path]): The directory of preview stylesheets.
+        profile (Optional[QWebEngineProfile]): Defaults to the default profile,
+            which every view in the editor uses.
+    """
+    profile = profile or QWebEngineProfile.defaultProfile()
+    handler = AssetSchemeHandler(profile)
+    profile.installUrlSchemeHandler(SCHEME, handler)
+    # Only there once installed locally, see `install_katex`
+    if KATEX_DIR.is_dir():
+        ASSET_DIRECTORIES["katex"] = KATEX_DIR.resolve()
+    if css_path is not None and css_path.is_dir():
+        ASSET_DIRECTORIES["styles"] = css_path.resolve()
+    return handler
@@ -0,0 +1,463 @@
+"""
+Benchmarks the full-text index over synthetic vaults.
+
+Generates reproducible vaults of Markdown notes with headings, lists, math,
+code, tags and wikilinks at several scales, then measures:
+
+- cold build: indexing an empty database
+- no-op re-index: a second run with nothing changed
+- incremental re-index: after editing, adding and deleting 1% of the notes
+- database size, checked against the same index storing the note bodies
+  itself, as the original layout did
+- latency of typical palette queries (p50/p95/p99), and of the snippets
+  of the results in view
+- keystrokes past the last match, answered from the query cache and, for
+  comparison, by running the query
+
+Results are written as JSON and can be compared against an earlier run:
+
+    python benchmarks/fts_bench.py --scales 1000 10000 -o new.json
+    python benchmarks/fts_bench.py --compare old.json new.json
+
+Databases are kept in the work directory, the user's index is untouched.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import fts  # noqa: E402
+from fts import FTS, QueryCache  # noqa: E402
+
+SYLLABLES = (
+    "ka ri to mu sa ne lo vi da pe zu ho ga mi ru te ba ko ni su ".split()
+    + "al en or is um an et ox ir ul ".split()
+)
+
+VOCABULARY_SIZE = 20000
+
+# Per query category, see `query_sets`
+QUERIES_PER_CATEGORY = 200
+
+# Results a search palette shows at once, it only fetches their snippets
+VISIBLE_ROWS = 12
+
+# A metric must change by more than this fraction to count in `--compare`
+DEFAULT_THRESHOLD = 0.10
+
+# Metrics where a larger value is better, everything else is a cost
+HIGHER_IS_BETTER = ("files_per_s", "mb_per_s")
+
+
+def make_vocabulary(rng: random.Random, size: int = VOCABULARY_SIZE) -> List[str]:
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+    return sorted(words)
+
+
+class VaultGenerator:
+    """
+    Writes notes whose words follow a Zipf distribution, like prose.
+    """
+
+    def __init__(self, seed: int = 0):
+        self.rng = random.Random(seed)
+        self.words = make_vocabulary(self.rng)
+        self.weights = [1 / rank for rank in range(1, len(self.words) + 1)]
+
+    def sentence(self, n: Optional[int] = None) -> str:
+        n = n or self.rng.randint(6, 18)
+        words = self.rng.choices(self.words, self.weights, k=n)
+        return " ".join(words).capitalize() + "."
+
+    def paragraph(self) -> str:
+        return " ".join(self.sentence() for _ in range(self.rng.randint(2, 6)))
+
+    def block(self, names: List[str]) -> str:
+        kind = self.rng.random()
+        if kind < 0.1:
+            calls = [f"    x{i} = {self.rng.choice(self.words)}({i})" for i in range(4)]
+            return "```python\ndef f():\n" + "\n".join(calls) + "\n```"
+        if kind < 0.2:
+            a, b = self.rng.sample(self.words[:50], 2)
+            return (
+                f"$$\n\\int_0^1 {a}(x) \\, d{b} = "
+                "\\sum_{n=0}^\\infty \\frac{1}{n!}\n$$"
+            )
+        if kind < 0.3:
+            items = self.rng.randint(2, 6)
+            return "\n".join(f"- {self.sentence(5)}" for _ in range(items))
+        text = self.paragraph()
+        if self.rng.random() < 0.3:
+            text += f" See [[{self.rng.choice(names)}]] and $e^{{i\\pi}} + 1 = 0$."
+        if self.rng.random() < 0.2:
+            text += f" #{self.rng.choice(self.words[:200])}"
+        return text
+
+    def note(self, names: List[str]) -> str:
+        # Sizes are roughly log-normal, most notes are short, a few long
+        sections = max(1, int(self.rng.lognormvariate(1.0, 0.8)))
+        parts = [f"# {self.sentence(3)[:-1]}"]
+        for _ in range(sections):
+            parts.append(f"## {self.sentence(3)[:-1]}")
+            parts.extend(self.block(names) for _ in range(self.rng.randint(1, 4)))
+        return "\n\n".join(parts) + "\n"
+
+    def write(self, directory: Path, count: int) -> int:
+        """
+        Writes `count` notes in folders of 500.
+
+        Returns:
+            int: The total size in bytes.
+        """
+        names = [f"note{i}" for i in range(count)]
+        total = 0
+        for i, name in enumerate(names):
+            folder = directory / f"folder{i // 500}"
+            folder.mkdir(parents=True, exist_ok=True)
+            data = self.note(names).encode("utf-8")
+            (folder / f"{name}.md").write_bytes(data)
+            total += len(data)
+        return total
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+
+    def at(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    return {
+        "p50_ms": at(0.50) * 1000,
+        "p95_ms": at(0.95) * 1000,
+        "p99_ms": at(0.99) * 1000,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+    }
+
+
+def query_sets(generator: VaultGenerator, rng: random.Random) -> Dict[str, list]:
+    """
+    Typical palette queries, drawn from moderately common words.
+    """
+    common = generator.words[20:2000]
+    words = rng.sample(common, QUERIES_PER_CATEGORY)
+    pairs = [rng.sample(common, 2) for _ in range(QUERIES_PER_CATEGORY)]
+    tags = generator.words[:200]
+    return {
+        # Each keystroke of a word, sharing the cache as the palette does
+        "typing": [[w[:i] for i in range(1, len(w) + 1)] for w in words[:40]],
+        "prefix": [w[: rng.randint(3, len(w))] for w in words],
+        "two_words": [f"{a} {b[:3]}" for a, b in pairs],
+        "tag": [f"tag:{rng.choice(tags)}" for _ in range(QUERIES_PER_CATEGORY)],
+        "heading": [f"heading:{w[:4]}" for w in words],
+        "substring": [w[1:5] for w in words],
+        "second_page": [w[:3] for w in words],
+        "visible_snippets": [w[: rng.randint(2, len(w))] for w in words],
+        # No syllable contains a "q", every keystroke after it finds nothing
+        "dead_end": [[w + "quiz"[:i] for i in range(1, 5)] for w in words[:50]],
+    }
+
+
+def time_queries(index: FTS, queries: Dict[str, list]) -> Dict[str, dict]:
+    results = {}
+    for category, items in queries.items():
+        samples = []
+        if category == "typing":
+            for keystrokes in items:
+                index.cache = QueryCache()
+                for text in keystrokes:
+                    # The palette lists results first, see `visible_snippets`
+                    start = time.perf_counter()
+                    index.search(text, mode="prefix", snippets=False)
+                    samples.append(time.perf_counter() - start)
+        elif category == "dead_end":
+            uncached = []
+            for keystrokes in items:
+                index.cache = QueryCache()
+                # The first keystroke without matches is run and cached
+                index.search(keystrokes[0], mode="prefix", snippets=False)
+                for text in keystrokes[1:]:
+                    start = time.perf_counter()
+                    narrowed = index.search(text, mode="prefix", snippets=False)
+                    samples.append(time.perf_counter() - start)
+                    # The same query run against the index, bypassing the cache
+                    start = time.perf_counter()
+                    full = list(
+                        index.iter_search(text, fts.SEARCH_PAGE_SIZE, mode="prefix")
+                    )
+                    uncached.append(time.perf_counter() - start)
+                    assert narrowed == full == []
+            results["dead_end_uncached"] = {
+                "count": len(uncached),
+                **percentiles(uncached),
+            }
+        elif category == "visible_snippets":
+            for text in items:
+                page = index.search(text, mode="prefix", snippets=False)
+                start = time.perf_counter()
+                index.snippets(text, "prefix", page[:VISIBLE_ROWS])
+                samples.append(time.perf_counter() - start)
+        else:
+            mode = {"substring": "substring"}.get(category, "prefix")
+            offset = fts.SEARCH_PAGE_SIZE if category == "second_page" else 0
+            for text in items:
+                # Measure the query itself, not a cache hit
+                index.cache = QueryCache()
+                start = time.perf_counter()
+                index.search(text, offset=offset, mode=mode)
+                samples.append(time.perf_counter() - start)
+        results[category] = {"count": len(samples), **percentiles(samples)}
+    return results
+
+
+def database_size(index: FTS) -> int:
+    index.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return sum(
+        os.path.getsize(path)
+        for path in (index.db_path, Path(f"{index.db_path}-wal"))
+        if os.path.exists(path)
+    )
+
+
+def inline_content_size(index: FTS, path: Path) -> int:
+    """
+    The size of an index of the same documents that stores their text in the
+    FTS table, rather than compressed in `content`.
+    """
+    if path.exists():
+        path.unlink()
+    index.db.execute("ATTACH DATABASE ? AS inline", (str(path),))
+    try:
+        with index.db:
+            index.db.execute(
+                f"""
+                CREATE VIRTUAL TABLE inline.fts USING fts5(
+                    title, body, headings, meta, tags,
+                    tokenize = 'unicode61', prefix = '{fts.PREFIX_INDEXES}'
+                )
+                """
+            )
+            index.db.execute(
+                "INSERT INTO inline.fts(rowid, title, body, headings, meta, tags) "
+                "SELECT id, title, body, headings, meta, tags FROM main.documents"
+            )
+            index.db.execute("INSERT INTO inline.fts(fts) VALUES ('optimize')")
+    finally:
+        index.db.execute("DETACH DATABASE inline")
+    size = os.path.getsize(path)
+    path.unlink()
+    return size
+
+
+def touch_notes(vault: Path, generator: VaultGenerator, fraction: float) -> int:
+    """
+    Edits, adds and deletes notes, as a day of writing might.
+
+    Returns:
+        int: The number of files changed.
+    """
+    notes = sorted(vault.rglob("*.md"))
+    count = max(3, int(len(notes) * fraction))
+    rng = generator.rng
+    changed = rng.sample(notes, count)
+    third = count // 3
+    for path in changed[:third]:
+        path.unlink()
+    for path in changed[third:]:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("\n" + generator.paragraph() + "\n")
+    for i in range(third):
+        (vault / "folder0" / f"new{i}.md").write_text(generator.note(["note0"]))
+    return count
+
+
+def bench_scale(
+    count: int, workdir: Path, jobs: Optional[int], seed: int, trigram: bool
+) -> dict:
+    vault = workdir / f"vault-{count}"
+    generator = VaultGenerator(seed)
+    shutil.rmtree(vault, ignore_errors=True)
+    start = time.perf_counter()
+    nbytes = generator.write(vault, count)
+    print(
+        f"[{count}] generated {nbytes / 1e6:.1f} MB in "
+        f"{time.perf_counter() - start:.1f}s",
+        file=sys.stderr,
+    )
+
+    result = {"notes": count, "vault_mb": nbytes / 1e6}
+    with FTS([".md"], str(vault), trigram=trigram) as index:
+        index.remove_database()
+    with FTS([".md"], str(vault), trigram=trigram) as index:
+        start = time.perf_counter()
+        index.index_current_dir(jobs=jobs)
+        elapsed = time.perf_counter() - start
+        result["cold_build"] = {
+            "seconds": elapsed,
+            "files_per_s": count / elapsed,
+            "mb_per_s": nbytes / 1e6 / elapsed,
+        }
+        result["db_mb"] = database_size(index) / 1e6
+        inline = inline_content_size(index, workdir / "inline.sqlite3")
+        result["inline_content_db_mb"] = inline / 1e6
+        # Storing the bodies once, compressed, is the point of the layout
+        assert result["db_mb"] < result["inline_content_db_mb"], (
+            f"The index takes {result['db_mb']:.2f} MB, more than the "
+            f"{result['inline_content_db_mb']:.2f} MB of one storing the text"
+        )
+
+        start = time.perf_counter()
+        index.index_current_dir(jobs=jobs)
+        result["noop_reindex"] = {"seconds": time.perf_counter() - start}
+
+        changed = touch_notes(vault, generator, 0.01)
+        start = time.perf_counter()
+        index.index_current_dir(jobs=jobs)
+        result["incremental_reindex"] = {
+            "seconds": time.perf_counter() - start,
+            "files": changed,
+        }
+
+        queries = query_sets(generator, random.Random(seed + 1))
+        result["queries"] = time_queries(index, queries)
+    return result
+
+
+def flatten(result: dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in result.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(old: dict, new: dict, threshold: float) -> int:
+    """
+    Prints the metrics that changed between two runs.
+
+    Returns:
+        int: The number of regressions beyond `threshold`.
+    """
+    regressions = 0
+    for scale in sorted(set(old["results"]) & set(new["results"]), key=int):
+        before = flatten(old["results"][scale])
+        after = flatten(new["results"][scale])
+        print(f"{scale} notes")
+        for name in sorted(set(before) & set(after)):
+            if name.endswith((".count", ".files", "notes", "vault_mb")):
+                continue
+            a, b = before[name], after[name]
+            if a == 0:
+                continue
+            change = (b - a) / a
+            # Positive when worse, whichever way the metric points
+            cost = -change if name.rsplit(".", 1)[-1] in HIGHER_IS_BETTER else change
+            flag = ""
+            if cost > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            elif cost < -threshold:
+                flag = "  improved"
+            print(f"  {name:40} {a:12.3f} {b:12.3f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def machine_info() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the FTS index")
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=[1000, 10000], help="Vault sizes"
+    )
+    parser.add_argument("--jobs", type=int, default=None, help="Indexing processes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--trigram", action="store_true", help="Also build the trigram index"
+    )
+    parser.add_argument("--workdir", type=Path, default=None, help="Keep vaults here")
+    parser.add_argument("-o", "--output", type=Path, default=None, help="JSON results")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        type=Path,
+        metavar=("OLD", "NEW"),
+        help="Compare two result files instead of running",
+    )
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.compare:
+        old, new = (json.loads(path.read_text()) for path in args.compare)
+        sys.exit(1 if compare(old, new, args.threshold) else 0)
+
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix="fts-bench-"))
+    # Keep the benchmark databases out of the user's data directory
+    fts.config.data_home = workdir / "data"
+    report = {"machine": machine_info(), "results": {}}
+    try:
+        for count in args.scales:
+            # The index reports progress on stdout, keep it for the JSON
+            with redirect_stdout(sys.stderr):
+                result = bench_scale(
+                    count, workdir, args.jobs, args.seed, args.trigram
+                )
+            report["results"][str(count)] = result
+            build = result["cold_build"]
+            print(
+                f"[{count}] cold build {build['seconds']:.2f}s, "
+                f"incremental {result['incremental_reindex']['seconds']:.2f}s, "
+                f"db {result['db_mb']:.1f} MB, prefix p50 "
+                f"{result['queries']['prefix']['p50_ms']:.2f}ms",
+                file=sys.stderr,
+            )
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmarks rendering notes with a reused converter against building the
+extension pipeline for every render, as the preview used to on each keystroke.
+
+    python benchmarks/markdown_bench.py
+    python benchmarks/markdown_bench.py --repeat 50 -o markdown.json
+
+Notes of several sizes are generated with the same vocabulary and structure
+as `fts_bench.py`. For each size the median time of a render is reported
+both ways, along with the time to build a converter once.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import markdown
+
+from fts_bench import VaultGenerator, machine_info
+
+# fts_bench puts the repository on the path
+from markdown_render import (
+    EXTENSION_CONFIGS,
+    build_converter,
+    extensions,
+    get_converter,
+)
+
+# Approximate note sizes in bytes
+SIZES = {"tiny": 200, "small": 2_000, "medium": 20_000, "large": 100_000}
+
+
+def make_note(generator: VaultGenerator, size: int) -> str:
+    names = [f"note{i}" for i in range(100)]
+    parts = [f"# {generator.sentence(3)[:-1]}"]
+    length = 0
+    while length < size:
+        if len(parts) % 5 == 0:
+            parts.append(f"## {generator.sentence(3)[:-1]}")
+        part = generator.block(names)
+        parts.append(part)
+        length += len(part)
+    return "\n\n".join(parts) + "\n"
+
+
+def median_ms(renders: List[Callable[[], object]], repeat: int) -> List[float]:
+    """
+    Times several ways of rendering, interleaved so that drift in the
+    machine's speed affects each of them alike.
+    """
+    samples: List[List[float]] = [[] for _ in renders]
+    for _ in range(repeat):
+        for render, times in zip(renders, samples):
+            start = time.perf_counter()
+            render()
+            times.append(time.perf_counter() - start)
+    return [statistics.median(times) * 1000 for times in samples]
+
+
+def bench(repeat: int, seed: int, base_path: str) -> Dict[str, dict]:
+    generator = VaultGenerator(seed)
+    (build_ms,) = median_ms([lambda: build_converter(base_path)], repeat)
+    results = {"build_converter_ms": build_ms}
+    for name, size in SIZES.items():
+        text = make_note(generator, size)
+
+        def rebuilt():
+            return markdown.markdown(
+                text,
+                extensions=extensions(base_path),
+                extension_configs=EXTENSION_CONFIGS,
+            )
+
+        def reused():
+            return get_converter(base_path).reset().convert(text)
+
+        # Build the shared converter and warm the caches of both first
+        if rebuilt() != reused():
+            raise AssertionError(f"The {name} note renders differently")
+        before, after = median_ms([rebuilt, reused], repeat)
+        results[name] = {
+            "bytes": len(text.encode("utf-8")),
+            "rebuilt_ms": before,
+            "reused_ms": after,
+            "saved_ms": before - after,
+            "speedup": before / after,
+        }
+        print(
+            f"{name:>6} ({results[name]['bytes'] / 1000:.0f} KB): "
+            f"{before:.2f} ms -> {after:.2f} ms per render, "
+            f"{before - after:.2f} ms saved ({before / after:.1f}x)",
+            file=sys.stderr,
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=50, help="Renders per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=Path, default=None, help="JSON results")
+    args = parser.parse_args()
+
+    # Wikilinks and transclusions resolve against an empty directory
+    with tempfile.TemporaryDirectory(prefix="markdown-bench-") as base_path:
+        os.chdir(base_path)
+        results = bench(args.repeat, args.seed, base_path)
+    print(
+        f"building a converter: {results['build_converter_ms']:.2f} ms",
+        file=sys.stderr,
+    )
+
+    output = json.dumps({"machine": machine_info(), "results": results}, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
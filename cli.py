@@ -0,0 +1,244 @@
+"""
+Headless command line interface: index, search and render without Qt.
+
+Only `fts` and `config` are imported up front, `markdown_render` and
+`embeddings` only by the commands that need them, so scripting against a
+vault doesn't pay for starting PyQt6 or WebEngine.
+
+    draftsmith index ~/Notes
+    draftsmith search "tag:todo" --dir ~/Notes --json
+    draftsmith search "standup" --dir ~/Notes --root ~/Work
+    draftsmith render note.md -o note.html
+"""
+
+import json
+import os
+import sys
+from enum import Enum
+from pathlib import Path
+from typing import List, Optional
+
+import typer
+
+from config import Config
+from fts import FTS, SEARCH_PAGE_SIZE, database_path
+
+config = Config()
+
+app = typer.Typer(
+    help="Index, search and render a directory of notes without the editor.",
+    add_completion=False,
+    no_args_is_help=True,
+)
+
+
+class SearchMode(str, Enum):
+    fts = "fts"
+    prefix = "prefix"
+    substring = "substring"
+
+
+def resolve_directory(directory: Optional[Path]) -> str:
+    """
+    The directory an index belongs to, as the editor would name it.
+    """
+    directory = directory or config.config.get("directory") or os.getcwd()
+    return os.path.abspath(os.path.expanduser(directory))
+
+
+def require_index(root: str) -> None:
+    """
+    Exits unless a directory has been indexed, rather than creating an index.
+    """
+    if not database_path(root).exists():
+        typer.echo(f"No index for {root}, run `index` first", err=True)
+        raise typer.Exit(1)
+
+
+@app.command()
+def index(
+    directory: Optional[Path] = typer.Argument(
+        None, help="Directory to index, defaults to the current directory"
+    ),
+    jobs: Optional[int] = typer.Option(
+        None, help="Processes used to read files, defaults to the CPU count"
+    ),
+    rebuild: bool = typer.Option(
+        False, "--rebuild", help="Discard the existing index first"
+    ),
+):
+    """
+    Index every note in a directory, only re-reading files that changed.
+    """
+    root = resolve_directory(directory)
+    if rebuild:
+        with FTS([".md"], root) as fts:
+            fts.remove_database()
+    jobs = jobs or config.config.get("index_jobs")
+    with FTS([".md"], root) as fts:
+        fts.index_current_dir(jobs=jobs)
+
+
+@app.command()
+def update(
+    paths: List[Path] = typer.Argument(
+        ..., help="Files that were added, edited or deleted"
+    ),
+    directory: Optional[Path] = typer.Option(
+        None, "--dir", help="The indexed directory"
+    ),
+):
+    """
+    Update the index for specific files without scanning the whole directory.
+    """
+    root = resolve_directory(directory)
+    with FTS([".md"], root) as fts:
+        added, updated, removed = fts.update_files(
+            [os.path.abspath(path) for path in paths]
+        )
+    typer.echo(f"{added} added, {updated} updated, {removed} removed")
+
+
+@app.command()
+def search(
+    query: str = typer.Argument(..., help="The search text"),
+    directory: Optional[Path] = typer.Option(
+        None, "--dir", help="The indexed directory"
+    ),
+    mode: SearchMode = typer.Option(
+        SearchMode.prefix,
+        help="prefix: words as typed in the palette, fts: raw FTS5 syntax, "
+        "substring: text anywhere",
+    ),
+    limit: int = typer.Option(SEARCH_PAGE_SIZE, help="Results per page, -1 for all"),
+    offset: int = typer.Option(0, help="Results to skip"),
+    roots: List[Path] = typer.Option(
+        [], "--root", help="Also search this indexed directory, can be repeated"
+    ),
+    as_json: bool = typer.Option(False, "--json", help="Print results as JSON"),
+):
+    """
+    Search an index, best matches first.
+
+    With --root, the indexes of every directory are searched as one and
+    paths are printed in full.
+    """
+    root = resolve_directory(directory)
+    require_index(root)
+    with FTS([".md"], root) as fts:
+        if fts.is_empty():
+            typer.echo(f"No index for {root}, run `index` first", err=True)
+            raise typer.Exit(1)
+        if not roots:
+            results = fts.search(query, limit, offset, mode.value)
+    if roots:
+        from workspace import Workspace
+
+        directories = [root, *(os.path.abspath(path) for path in roots)]
+        with Workspace(directories) as workspace:
+            results = workspace.search(query, limit, offset, mode.value)
+    if as_json:
+        json.dump([result._asdict() for result in results], sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    for result in results:
+        typer.echo(os.path.join(result.root, result.path))
+        if result.snippet:
+            typer.echo(f"    {' '.join(result.snippet.split())}")
+
+
+@app.command()
+def similar(
+    query: str = typer.Argument(..., help="A question or passage"),
+    directory: Optional[Path] = typer.Option(
+        None, "--dir", help="The indexed directory"
+    ),
+    limit: int = typer.Option(10, help="Notes to return"),
+    server: Optional[str] = typer.Option(
+        None, help="Embedding server, defaults to the configured openai_api_server"
+    ),
+    as_json: bool = typer.Option(False, "--json", help="Print results as JSON"),
+):
+    """
+    Find notes by meaning with embeddings, embedding changed notes first.
+    """
+    from embeddings import EmbeddingClient, EmbeddingError, EmbeddingIndex
+
+    root = resolve_directory(directory)
+    require_index(root)
+    with FTS([".md"], root) as fts:
+        if fts.is_empty():
+            typer.echo(f"No index for {root}, run `index` first", err=True)
+            raise typer.Exit(1)
+        index = EmbeddingIndex(fts, EmbeddingClient(server))
+        try:
+            results = index.search(query, limit)
+        except EmbeddingError as e:
+            typer.echo(str(e), err=True)
+            raise typer.Exit(1)
+        finally:
+            index.close()
+    if as_json:
+        json.dump([result._asdict() for result in results], sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    for result in results:
+        heading = f"  ({result.heading})" if result.heading else ""
+        typer.echo(f"{result.score:.3f}  {result.path}{heading}")
+
+
+@app.command()
+def render(
+    path: Path = typer.Argument(
+        ..., exists=True, dir_okay=False, help="Markdown file"
+    ),
+    output: Optional[Path] = typer.Option(
+        None, "--output", "-o", help="Write the HTML here instead of stdout"
+    ),
+    directory: Optional[Path] = typer.Option(
+        None, "--dir", help="Directory wikilinks and transclusions resolve against"
+    ),
+    css: Optional[Path] = typer.Option(
+        None, help="Directory of CSS files, defaults to the configured css_path"
+    ),
+    dark: bool = typer.Option(False, "--dark", help="Use the dark theme"),
+    body_only: bool = typer.Option(
+        False, "--body-only", help="Only the rendered body, no page or styles"
+    ),
+    remote_katex: bool = typer.Option(
+        config.config.get("remote_katex", True),
+        "--remote-katex/--local-katex",
+        help="Load KaTeX from the CDN, defaults to the configured remote_katex",
+    ),
+):
+    """
+    Render a note to HTML the way the preview does.
+    """
+    from markdown_render import KATEX_DIR, Markdown
+
+    local_katex = not remote_katex
+    if local_katex and not body_only and not KATEX_DIR.is_dir():
+        typer.echo(f"KaTeX isn't installed in {KATEX_DIR}, using the CDN", err=True)
+        local_katex = False
+
+    text = path.read_text(encoding="utf-8")
+    if output is not None:
+        output = output.resolve()
+    # Wikilinks and transclusions resolve against the working directory
+    os.chdir(resolve_directory(directory))
+    css_path = css or config.config.get("css_path")
+    markdown_content = Markdown(
+        text=text, css_path=Path(css_path) if css_path else None, dark_mode=dark
+    )
+    if body_only:
+        html = markdown_content.make_html()
+    else:
+        html = markdown_content.build_html(local_katex=local_katex)
+    if output is None:
+        sys.stdout.write(html)
+    else:
+        output.write_text(html, encoding="utf-8")
+
+
+if __name__ == "__main__":
+    app()
@@ -47,6 +47,33 @@ class Config:
             "openai_api_server": "http://localhost:11434",
             "use_relative_paths": False,  # Not yet implemented
             "notification_timeout": 500,
+            # Directory the editor and the command line work in, null for the
+            # current one
+            "directory": None,
+            # gitignore-style patterns for files and directories that are never
+            # indexed or listed, on top of any .gitignore files
+            "ignore_patterns": [".*", "node_modules", "__pycache__", "venv"],
+            # Processes used to read files when indexing, null for the CPU count
+            "index_jobs": None,
+            # Keep the index current as files change
+            "index_watch": True,
+            # Milliseconds between rescans for edits the watcher can't see, 0 disables
+            "index_poll_interval": 30000,
+            # Other directories searched along with the current one, each
+            # keeps its own index
+            "workspace_roots": [],
+            # Secondary index for substring searches (prefix the query with ~)
+            "trigram_index": False,
+            # Latent dimensions of the related notes index, 0 for plain TF-IDF
+            "semantic_dimensions": 128,
+            # Embedding search through openai_api_server
+            "embedding_model": "nomic-embed-text",
+            "embedding_batch_size": 32,
+            "embedding_concurrency": 4,
+            # Milliseconds of quiet after an edit before the preview renders,
+            # and the longest it lags behind while typing continues
+            "preview_debounce_ms": 150,
+            "preview_max_latency_ms": 500,
             "fonts": {
                 "editor": {
                     "mono": "fira code",
@@ -0,0 +1,579 @@
+"""
+Semantic search with embeddings from the configured `openai_api_server`.
+
+Notes are split into chunks at their headings and each chunk is embedded
+through the server's OpenAI compatible `/v1/embeddings` endpoint (Ollama,
+llama.cpp, vLLM, ...). Requests are batched, run a few at a time, and reuse
+one keep-alive connection per worker thread. Vectors are cached in SQLite by
+the hash of the chunk text and the model, so editing a note only embeds the
+chunks that changed, and rebuilding the FTS index embeds nothing. Each vault
+keeps a memory-mapped matrix of its chunk vectors next to its FTS database.
+"""
+
+import hashlib
+import http.client
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from config import Config
+from fts import FENCE_PATTERN, FTS, HEADING_PATTERN, TOKEN_PATTERN
+
+config = Config()
+
+# Bump whenever the stored arrays change; older indexes are rebuilt
+EMBEDDING_VERSION = 1
+
+# Sections longer than this are split at paragraphs, most embedding
+# models truncate their input at a few thousand tokens
+MAX_CHUNK_CHARS = 2000
+
+# Texts sent per request and requests in flight, see `EmbeddingClient`
+BATCH_SIZE = 32
+CONCURRENCY = 4
+
+REQUEST_TIMEOUT = 120
+
+# Vectors read from the cache per query
+CACHE_READ_SIZE = 500
+
+# Chunks embedded between writes to the cache, so an interrupted refresh
+# keeps most of its work
+CACHE_WRITE_SIZE = 512
+
+SEARCH_LIMIT = 20
+
+
+class EmbeddingError(Exception):
+    """
+    The embedding server could not be reached or returned an error.
+    """
+
+
+class Chunk(NamedTuple):
+    """
+    A section of a note, embedded on its own.
+
+    Attributes:
+        path (str): The note, relative to the indexed directory.
+        heading (str): The headings leading to the section, e.g. "A > B",
+            empty before the first heading.
+        text (str): What is embedded, the section prefixed with its note
+            and heading for context.
+        hash (str): The sha256 of `text`, the key of the vector cache.
+    """
+
+    path: str
+    heading: str
+    text: str
+    hash: str
+
+
+class SimilarChunk(NamedTuple):
+    """
+    The best matching section of a note.
+
+    Attributes:
+        path (str): The note, relative to the indexed directory.
+        heading (str): The headings of the section, see `Chunk`.
+        score (float): The cosine similarity, higher is closer.
+    """
+
+    path: str
+    heading: str
+    score: float
+
+
+def split_section(text: str) -> List[str]:
+    """
+    Splits a long section at blank lines into pieces of `MAX_CHUNK_CHARS`.
+    """
+    pieces, current = [], ""
+    for paragraph in text.split("\n\n"):
+        if current and len(current) + len(paragraph) > MAX_CHUNK_CHARS:
+            pieces.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+        while len(current) > MAX_CHUNK_CHARS:
+            pieces.append(current[:MAX_CHUNK_CHARS])
+            current = current[MAX_CHUNK_CHARS:]
+    if current.strip():
+        pieces.append(current)
+    return pieces
+
+
+def chunk_document(path: str, body: str) -> List[Chunk]:
+    """
+    Splits a note into chunks at its ATX headings, ignoring fenced code.
+
+    Args:
+        path (str): The note, relative to the indexed directory.
+        body (str): The text of the note.
+    """
+    sections: List[Tuple[List[str], List[str]]] = [([], [])]
+    trail: List[Tuple[int, str]] = []
+    fence = None
+    for line in body.split("\n"):
+        m = FENCE_PATTERN.match(line)
+        if m:
+            if fence is None:
+                fence = m.group(1)[0] * len(m.group(1))
+            elif m.group(1).startswith(fence):
+                fence = None
+        elif fence is None:
+            m = HEADING_PATTERN.match(line)
+            if m:
+                level = len(line.lstrip()) - len(line.lstrip().lstrip("#"))
+                trail = [(lvl, h) for lvl, h in trail if lvl < level]
+                trail.append((level, m.group(1)))
+                sections.append(([h for _, h in trail], []))
+                continue
+        sections[-1][1].append(line)
+
+    chunks = []
+    for headings, lines in sections:
+        heading = " > ".join(headings)
+        for piece in split_section("\n".join(lines).strip()):
+            text = f"{path}\n{heading}\n\n{piece}" if heading else f"{path}\n\n{piece}"
+            digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            chunks.append(Chunk(path, heading, text, digest))
+    return chunks
+
+
+class EmbeddingClient:
+    """
+    Embeds texts through an OpenAI compatible `/v1/embeddings` endpoint.
+
+    Texts are sent in batches of `batch_size`, with up to `concurrency`
+    requests in flight. Each worker thread keeps its HTTP connection open
+    between requests, avoiding a TCP (and TLS) handshake per batch.
+    """
+
+    def __init__(
+        self,
+        server: Optional[str] = None,
+        model: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        concurrency: Optional[int] = None,
+    ):
+        """
+        Args:
+            server (Optional[str]): The base URL, defaults to the
+                `openai_api_server` config option.
+            model (Optional[str]): Defaults to the `embedding_model` option.
+            batch_size (Optional[int]): Defaults to `embedding_batch_size`.
+            concurrency (Optional[int]): Defaults to `embedding_concurrency`.
+        """
+        server = server or config.config.get("openai_api_server")
+        url = urlsplit(server)
+        self.https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port
+        self.endpoint = url.path.rstrip("/") + "/v1/embeddings"
+        self.model = model or config.config.get("embedding_model", "nomic-embed-text")
+        self.batch_size = batch_size or config.config.get(
+            "embedding_batch_size", BATCH_SIZE
+        )
+        concurrency = concurrency or config.config.get(
+            "embedding_concurrency", CONCURRENCY
+        )
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="embedding"
+        )
+
+    def connection(self) -> http.client.HTTPConnection:
+        """
+        The calling thread's connection, opened on first use.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            if self.https:
+                conn = http.client.HTTPSConnection(
+                    self.host, self.port, timeout=REQUEST_TIMEOUT
+                )
+            else:
+                conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=REQUEST_TIMEOUT
+                )
+            self.local.conn = conn
+        return conn
+
+    def request(self, texts: List[str]) -> np.ndarray:
+        body = json.dumps({"model": self.model, "input": texts})
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        # A kept-alive connection may have been closed by the server since
+        # its last use, so retry once on a fresh one
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                conn.request("POST", self.endpoint, body, headers)
+                response = conn.getresponse()
+                # Reading the whole body lets the connection be reused
+                payload = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError) as e:
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise EmbeddingError(f"Embedding request failed: {e}") from e
+            except OSError as e:
+                conn.close()
+                self.local.conn = None
+                raise EmbeddingError(f"Embedding request failed: {e}") from e
+        if response.status != 200:
+            raise EmbeddingError(
+                f"Embedding server returned {response.status}: {payload[:200]!r}"
+            )
+        data = sorted(json.loads(payload)["data"], key=lambda d: d["index"])
+        return np.array([d["embedding"] for d in data], dtype=np.float32)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Embeds texts, in concurrent batches.
+
+        Returns:
+            np.ndarray: One row per text.
+        """
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        batches = [
+            texts[i : i + self.batch_size]
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        return np.vstack(list(self.executor.map(self.request, batches)))
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+
+class VectorCache:
+    """
+    Embeddings by model and text hash, shared by every vault.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        """
+        Args:
+            path (Optional[Path]): Defaults to embeddings.sqlite3 in the
+                data directory.
+        """
+        path = path or config.data_home / "embeddings.sqlite3"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        with self.db:
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS vectors (
+                    model TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (model, hash)
+                ) WITHOUT ROWID
+                """
+            )
+
+    def get(self, model: str, hashes: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Looks up the cached vectors of some texts.
+
+        Returns:
+            Dict[str, np.ndarray]: The vectors found, by hash.
+        """
+        found = {}
+        for i in range(0, len(hashes), CACHE_READ_SIZE):
+            cursor = self.db.execute(
+                """
+                SELECT hash, vector FROM vectors
+                WHERE model = ? AND hash IN (SELECT value FROM json_each(?))
+                """,
+                (model, json.dumps(hashes[i : i + CACHE_READ_SIZE])),
+            )
+            for digest, blob in cursor:
+                found[digest] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put(self, model: str, vectors: Dict[str, np.ndarray]) -> None:
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO vectors(model, hash, vector) VALUES (?, ?, ?)",
+                [
+                    (model, digest, np.asarray(vector, np.float32).tobytes())
+                    for digest, vector in vectors.items()
+                ],
+            )
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def embedding_dir(db_path: Path) -> Path:
+    """
+    Where the chunk vectors of an FTS database are stored.
+    """
+    return db_path.with_name(db_path.stem + ".embeddings")
+
+
+class EmbeddingIndex:
+    """
+    The chunk vectors of a vault, searched by cosine similarity.
+
+    Not thread safe, like the FTS connection it reads from it should only
+    be used by one thread.
+    """
+
+    def __init__(
+        self,
+        fts: FTS,
+        client: Optional[EmbeddingClient] = None,
+        cache: Optional[VectorCache] = None,
+    ):
+        self.fts = fts
+        self.client = client or EmbeddingClient()
+        self.cache = cache or VectorCache()
+        self.path = embedding_dir(fts.db_path)
+        self.chunks: List[Tuple[str, str, str]] = []
+        self.notes: Dict[str, str] = {}
+        self.vectors: Optional[np.ndarray] = None
+        self.generation = None
+        self.load()
+
+    def load(self) -> None:
+        """
+        Opens the stored index, the vectors are memory-mapped.
+        """
+        try:
+            with open(self.path / "meta.json", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return
+        if meta.get("version") != EMBEDDING_VERSION:
+            return
+        if meta.get("model") != self.client.model:
+            return
+        self.chunks = [tuple(chunk) for chunk in meta["chunks"]]
+        self.notes = meta["notes"]
+        self.vectors = np.load(self.path / "vectors.npy", mmap_mode="r")
+
+    def save(self, vectors: np.ndarray) -> None:
+        """
+        Writes the index, replacing the old files only once all are written.
+        """
+        staging = self.path.with_name(self.path.name + ".tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        np.save(staging / "vectors.npy", vectors)
+        meta = {
+            "version": EMBEDDING_VERSION,
+            "model": self.client.model,
+            "chunks": self.chunks,
+            "notes": self.notes,
+        }
+        with open(staging / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(staging, self.path)
+        self.load()
+
+    def remove(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def embed_chunks(self, chunks: List[Chunk]) -> Dict[str, np.ndarray]:
+        """
+        Embeds the chunks that aren't cached yet.
+
+        Returns:
+            Dict[str, np.ndarray]: The vector of every chunk, by hash.
+        """
+        hashes = list(dict.fromkeys(chunk.hash for chunk in chunks))
+        vectors = self.cache.get(self.client.model, hashes)
+        missing = {c.hash: c.text for c in chunks if c.hash not in vectors}
+        missing = list(missing.items())
+        for i in range(0, len(missing), CACHE_WRITE_SIZE):
+            group = missing[i : i + CACHE_WRITE_SIZE]
+            embedded = self.client.embed([text for _, text in group])
+            new = dict(zip([digest for digest, _ in group], embedded))
+            self.cache.put(self.client.model, new)
+            vectors.update(new)
+        return vectors
+
+    def refresh(self) -> int:
+        """
+        Brings the index up to date with the FTS database, if it changed.
+
+        Returns:
+            int: The number of chunks that were embedded or read from the cache.
+        """
+        generation = self.fts.generation
+        if generation == self.generation:
+            return 0
+        manifest = self.fts.manifest_hashes()
+        changed = [p for p, h in manifest.items() if self.notes.get(p) != h]
+        removed = [p for p in self.notes if p not in manifest]
+        if not (changed or removed):
+            self.generation = generation
+            return 0
+
+        chunks = [
+            chunk
+            for path, _, body in self.fts.read_documents(changed)
+            for chunk in chunk_document(path, body)
+        ]
+        vectors = self.embed_chunks(chunks)
+
+        dropped = set(changed) | set(removed)
+        keep = [i for i, (path, _, _) in enumerate(self.chunks) if path not in dropped]
+        rows = [np.asarray(self.vectors)[keep]] if keep else []
+        if chunks:
+            new = np.vstack([vectors[chunk.hash] for chunk in chunks])
+            norms = np.linalg.norm(new, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            rows.append((new / norms).astype(np.float32))
+        self.chunks = [self.chunks[i] for i in keep]
+        self.chunks += [(c.path, c.heading, c.hash) for c in chunks]
+        for path in removed:
+            del self.notes[path]
+        self.notes.update((path, manifest[path]) for path in changed)
+        self.save(np.vstack(rows) if rows else np.zeros((0, 0), np.float32))
+        self.generation = generation
+        return len(chunks)
+
+    def search(
+        self, text: str, limit: int = SEARCH_LIMIT, exclude: Optional[str] = None
+    ) -> List[SimilarChunk]:
+        """
+        Finds the notes whose sections are closest in meaning to some text.
+
+        Args:
+            text (str): The query, e.g. a question or the current buffer.
+            limit (int): The number of notes to return.
+            exclude (Optional[str]): A path to leave out.
+
+        Returns:
+            List[SimilarChunk]: The best section of each of the closest
+                notes, best first.
+        """
+        self.refresh()
+        if self.vectors is None or not len(self.chunks) or not text.strip():
+            return []
+        # Queries aren't cached, they rarely repeat
+        (query,) = self.client.embed([text])
+        query = query / (np.linalg.norm(query) or 1)
+        scores = self.vectors @ query.astype(np.float32)
+        # Notes have several chunks, so rank more chunks than notes wanted
+        candidates = min(len(scores), limit * 8)
+        while True:
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            results, seen = [], set()
+            for i in top[np.argsort(-scores[top])]:
+                path, heading, _ = self.chunks[i]
+                if path in seen or path == exclude:
+                    continue
+                seen.add(path)
+                results.append(SimilarChunk(path, heading, float(scores[i])))
+                if len(results) == limit:
+                    return results
+            if candidates == len(scores):
+                return results
+            candidates = min(len(scores), candidates * 4)
+
+    def close(self) -> None:
+        self.client.close()
+        self.cache.close()
+
+
+def serve_stub(port: int = 8089, dimensions: int = 256) -> None:
+    """
+    Serves fake embeddings for testing without a model.
+
+    Vectors hash each word into one of `dimensions` buckets, so texts that
+    share words are similar, which is enough to exercise the pipeline.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    words = re.compile(TOKEN_PATTERN)
+
+    def embed(text: str) -> List[float]:
+        vector = [0.0] * dimensions
+        for word in words.findall(text.lower()):
+            bucket = int(hashlib.md5(word.encode()).hexdigest(), 16) % dimensions
+            vector[bucket] += 1.0
+        return vector
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive needs HTTP/1.1 and a Content-Length on every response
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            texts = request["input"]
+            if isinstance(texts, str):
+                texts = [texts]
+            body = json.dumps(
+                {
+                    "object": "list",
+                    "model": request.get("model"),
+                    "data": [
+                        {"object": "embedding", "index": i, "embedding": embed(t)}
+                        for i, t in enumerate(texts)
+                    ],
+                }
+            ).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    with ThreadingHTTPServer(("127.0.0.1", port), Handler) as server:
+        print(f"Serving stub embeddings on http://127.0.0.1:{port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(description="Embedding based note search")
+    commands = parser.add_subparsers(dest="command", required=True)
+    search = commands.add_parser("search", help="Search a vault by meaning")
+    search.add_argument("query")
+    search.add_argument("directory", nargs="?", default=os.getcwd())
+    search.add_argument("--limit", type=int, default=10)
+    search.add_argument("--server", default=None)
+    stub = commands.add_parser("stub", help="Serve fake embeddings for testing")
+    stub.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+
+    if args.command == "stub":
+        serve_stub(args.port)
+        sys.exit()
+    with FTS([".md"], os.path.abspath(args.directory)) as fts:
+        with closing(EmbeddingIndex(fts, EmbeddingClient(args.server))) as index:
+            start = time.perf_counter()
+            embedded = index.refresh()
+            elapsed = time.perf_counter() - start
+            print(f"Refreshed {embedded} chunks in {elapsed:.2f}s", file=sys.stderr)
+            start = time.perf_counter()
+            for result in index.search(args.query, args.limit):
+                print(f"{result.score:.3f}  {result.path}  {result.heading}")
+            elapsed = (time.perf_counter() - start) * 1000
+            print(
+                f"Searched {len(index.chunks)} chunks in {elapsed:.1f}ms",
+                file=sys.stderr,
+            )
@@ -0,0 +1,430 @@
+"""
+Lists the notes under a directory for the indexer, the watcher and the palettes.
+
+Directories are read with `os.scandir` and pruned by `.gitignore` files and
+the `ignore_patterns` config option, so `.git`, `node_modules` and virtual
+environments are never descended into. Listings are cached per directory
+and re-read only when the directory's mtime, or that of its `.gitignore`,
+changes, so listing an unchanged tree costs one `stat` per directory.
+"""
+
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from config import Config
+
+config = Config()
+
+IGNORE_FILE = ".gitignore"
+
+# A directory modified this recently may change again within the same mtime
+# tick, its listing is re-read until it has settled
+RACY_NS = 2_000_000_000
+
+
+def translate_pattern(pattern: str) -> str:
+    """
+    Translates a gitignore glob into a regular expression.
+
+    `*` and `?` don't match `/`, `**/` matches any number of directories and
+    a trailing `**` everything below.
+    """
+    i, n = 0, len(pattern)
+    parts = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            parts.append("[^/]*")
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "\\" and i + 1 < n:
+            parts.append(re.escape(pattern[i + 1]))
+            i += 1
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end < 0:
+                parts.append(re.escape(c))
+            else:
+                body = pattern[i + 1 : end].replace("\\", "\\\\")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                parts.append(f"[{body}]")
+                i = end
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return "".join(parts)
+
+
+class IgnoreRule(NamedTuple):
+    """
+    One line of a `.gitignore` file.
+
+    Attributes:
+        base (str): The directory of the file the rule came from, relative to
+            the root with `/` separators, "" for the root.
+        pattern (re.Pattern): Matches a path relative to `base` if
+            `anchored`, otherwise a file or directory name.
+        negate (bool): The rule re-includes what it matches (`!pattern`).
+        directory_only (bool): The rule only matches directories (`pattern/`).
+        anchored (bool): The pattern contains a `/`.
+    """
+
+    base: str
+    pattern: re.Pattern
+    negate: bool
+    directory_only: bool
+    anchored: bool
+
+
+def parse_rules(base: str, lines: Iterable[str]) -> List[IgnoreRule]:
+    """
+    Parses `.gitignore` lines, blank lines and comments are skipped.
+    """
+    rules = []
+    for line in lines:
+        line = line.rstrip("\n")
+        # Trailing spaces are ignored unless escaped
+        if not line.endswith("\\ "):
+            line = line.rstrip(" ")
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        anchored = "/" in line
+        line = line.lstrip("/")
+        if not line:
+            continue
+        pattern = re.compile(translate_pattern(line))
+        rules.append(IgnoreRule(base, pattern, negate, directory_only, anchored))
+    return rules
+
+
+class IgnoreRules:
+    """
+    The rules in effect for one directory: the configured patterns followed
+    by those of every `.gitignore` from the root down, the last match wins.
+    """
+
+    def __init__(self, rules: Tuple[IgnoreRule, ...] = ()):
+        self.rules = rules
+
+    def __eq__(self, other) -> bool:
+        # Equal rules keep the cached listings below a re-read directory
+        return isinstance(other, IgnoreRules) and self.rules == other.rules
+
+    def __hash__(self) -> int:
+        return hash(self.rules)
+
+    def extend(self, base: str, lines: Iterable[str]) -> "IgnoreRules":
+        """
+        The rules for a subdirectory with its own `.gitignore`.
+        """
+        return IgnoreRules(self.rules + tuple(parse_rules(base, lines)))
+
+    def ignored(self, path: str, is_dir: bool) -> bool:
+        """
+        Whether a path relative to the root is excluded.
+        """
+        if not self.rules:
+            return False
+        if os.sep != "/":
+            path = path.replace(os.sep, "/")
+        name = path.rpartition("/")[2]
+        for rule in reversed(self.rules):
+            if rule.directory_only and not is_dir:
+                continue
+            relative = path
+            if rule.base:
+                if not path.startswith(rule.base + "/"):
+                    continue
+                relative = path[len(rule.base) + 1 :]
+            if rule.pattern.fullmatch(relative if rule.anchored else name):
+                return not rule.negate
+        return False
+
+
+class DirectoryListing(NamedTuple):
+    """
+    The cached entries of one directory, ignored ones already removed.
+
+    Attributes:
+        stamp (Optional[tuple]): The mtimes the listing was read at, None
+            if they were too recent to trust.
+        inherited (IgnoreRules): The rules of the parent directory.
+        rules (IgnoreRules): The rules for entries of this directory.
+        files (Tuple[str, ...]): File names, sorted.
+        subdirs (Tuple[str, ...]): Subdirectory names, sorted. Symlinks to
+            directories aren't followed, as with `os.walk`.
+        paths (Tuple[str, ...]): The files relative to the root.
+    """
+
+    stamp: Optional[tuple]
+    inherited: IgnoreRules
+    rules: IgnoreRules
+    files: Tuple[str, ...]
+    subdirs: Tuple[str, ...]
+    paths: Tuple[str, ...]
+
+
+class FileTree:
+    """
+    A cached, ignore-aware listing of one directory tree.
+
+    Shared between threads, see `file_tree`.
+    """
+
+    def __init__(self, root: str, ignore_patterns: Optional[List[str]] = None):
+        """
+        Args:
+            root (str): The directory to list.
+            ignore_patterns (Optional[List[str]]): gitignore-style patterns
+                applied below every `.gitignore`. Defaults to the
+                `ignore_patterns` config option.
+        """
+        if ignore_patterns is None:
+            ignore_patterns = config.config.get("ignore_patterns") or []
+        self.root = os.path.abspath(root)
+        self.base_rules = IgnoreRules().extend("", ignore_patterns)
+        self.listings: Dict[str, DirectoryListing] = {}
+        self.lock = threading.RLock()
+
+    def stamp(self, reldir: str, has_ignore_file: bool) -> Optional[tuple]:
+        """
+        The mtimes a listing depends on, None if the directory is missing.
+        """
+        full_dir = os.path.join(self.root, reldir)
+        try:
+            mtimes = [os.stat(full_dir).st_mtime_ns]
+            if has_ignore_file:
+                ignore_file = os.path.join(full_dir, IGNORE_FILE)
+                mtimes.append(os.stat(ignore_file).st_mtime_ns)
+        except OSError:
+            return None
+        return tuple(mtimes)
+
+    def scan(self, reldir: str, inherited: IgnoreRules) -> Optional[DirectoryListing]:
+        """
+        Reads a directory, None if it is missing or unreadable.
+        """
+        full_dir = os.path.join(self.root, reldir)
+        started = time.time_ns()
+        try:
+            with os.scandir(full_dir) as it:
+                entries = [
+                    (entry.name, entry.is_dir(), entry.is_symlink()) for entry in it
+                ]
+        except OSError:
+            return None
+        rules = inherited
+        has_ignore_file = any(name == IGNORE_FILE for name, _, _ in entries)
+        if has_ignore_file:
+            try:
+                ignore_file = os.path.join(full_dir, IGNORE_FILE)
+                with open(ignore_file, encoding="utf-8", errors="replace") as f:
+                    rules = inherited.extend(reldir.replace(os.sep, "/"), f)
+            except OSError:
+                pass
+        prefix = reldir + os.sep if reldir else ""
+        files, subdirs = [], []
+        for name, is_dir, is_symlink in entries:
+            if is_dir and is_symlink:
+                continue
+            if rules.ignored(prefix + name, is_dir):
+                continue
+            (subdirs if is_dir else files).append(name)
+        files.sort()
+        subdirs.sort()
+        stamp = self.stamp(reldir, has_ignore_file)
+        if stamp is not None and started - max(stamp) < RACY_NS:
+            stamp = None
+        return DirectoryListing(
+            stamp,
+            inherited,
+            rules,
+            tuple(files),
+            tuple(subdirs),
+            tuple(prefix + name for name in files),
+        )
+
+    def listing(
+        self, reldir: str, inherited: IgnoreRules
+    ) -> Optional[DirectoryListing]:
+        """
+        The listing of a directory, read again if it changed since it was cached.
+        """
+        cached = self.listings.get(reldir)
+        if (
+            cached is not None
+            and cached.inherited == inherited
+            and cached.stamp is not None
+            and cached.stamp == self.stamp(reldir, len(cached.stamp) > 1)
+        ):
+            return cached
+        listing = self.scan(reldir, inherited)
+        if listing is None:
+            self.listings.pop(reldir, None)
+        else:
+            self.listings[reldir] = listing
+        return listing
+
+    def resolve(
+        self, reldir: str
+    ) -> Tuple[Optional[IgnoreRules], Optional[DirectoryListing]]:
+        """
+        Follows a directory down from the root.
+
+        Returns:
+            Tuple[Optional[IgnoreRules], Optional[DirectoryListing]]: The
+                rules for its entries, None if the directory is ignored, and
+                its listing, None if it doesn't exist.
+        """
+        listing = self.listing("", self.base_rules)
+        rules = listing.rules if listing else self.base_rules
+        path = ""
+        for part in [p for p in reldir.split(os.sep) if p and p != os.curdir]:
+            path = os.path.join(path, part)
+            if rules.ignored(path, True):
+                return None, None
+            listing = self.listing(path, rules) if listing is not None else None
+            rules = listing.rules if listing else rules
+        return rules, listing
+
+    def walk(
+        self, subdirectory: Optional[str] = None
+    ) -> Iterator[Tuple[str, DirectoryListing]]:
+        """
+        Yields every directory that isn't ignored, top-down, relative to the root.
+        """
+        start = os.path.normpath(subdirectory or "")
+        start = "" if start == os.curdir else start
+        with self.lock:
+            _, listing = self.resolve(start)
+            if listing is None:
+                return
+            visited = []
+            stack = [(start, listing)]
+            while stack:
+                reldir, listing = stack.pop()
+                visited.append((reldir, listing))
+                for name in reversed(listing.subdirs):
+                    path = os.path.join(reldir, name)
+                    child = self.listing(path, listing.rules)
+                    if child is not None:
+                        stack.append((path, child))
+            if not start:
+                # Forget directories that were removed or are now ignored
+                seen = {reldir for reldir, _ in visited}
+                for reldir in [d for d in self.listings if d not in seen]:
+                    del self.listings[reldir]
+        yield from visited
+
+    def files(
+        self,
+        extensions: Optional[Iterable[str]] = None,
+        subdirectory: Optional[str] = None,
+    ) -> List[str]:
+        """
+        Lists the files below a directory.
+
+        Args:
+            extensions (Optional[Iterable[str]]): Only files ending in one of
+                these, every file if None.
+            subdirectory (Optional[str]): Only list this part of the tree.
+
+        Returns:
+            List[str]: Paths relative to the root.
+        """
+        suffixes = tuple(extensions) if extensions is not None else ("",)
+        return [
+            path
+            for _, listing in self.walk(subdirectory)
+            for path in listing.paths
+            if path.endswith(suffixes)
+        ]
+
+    def directories(self, subdirectory: Optional[str] = None) -> List[str]:
+        """
+        Lists the directories below one, including it, as absolute paths.
+        """
+        return [
+            os.path.normpath(os.path.join(self.root, reldir))
+            for reldir, _ in self.walk(subdirectory)
+        ]
+
+    def entries(self, reldir: str) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        """
+        The file and subdirectory names directly inside a directory, both
+        empty if it is missing or ignored.
+        """
+        with self.lock:
+            rules, listing = self.resolve(os.path.normpath(reldir))
+        if rules is None or listing is None:
+            return (), ()
+        return listing.files, listing.subdirs
+
+    def is_ignored(self, path: str) -> bool:
+        """
+        Whether a file, relative to the root, is excluded, even if it doesn't exist.
+        """
+        path = os.path.normpath(path)
+        with self.lock:
+            rules, _ = self.resolve(os.path.dirname(path))
+        return rules is None or rules.ignored(path, False)
+
+    def invalidate(self, reldir: Optional[str] = None) -> None:
+        """
+        Drops the cached listing of a directory, or of every directory.
+        """
+        with self.lock:
+            if reldir is None:
+                self.listings.clear()
+            else:
+                reldir = os.path.normpath(reldir)
+                self.listings.pop("" if reldir == os.curdir else reldir, None)
+
+
+# Shared by every user of a root, see `file_tree`
+trees: Dict[str, FileTree] = {}
+trees_lock = threading.Lock()
+
+
+def file_tree(root: Optional[str] = None) -> FileTree:
+    """
+    The shared listing of a directory, created on first use.
+
+    Args:
+        root (Optional[str]): Defaults to the current working directory.
+    """
+    root = os.path.abspath(root or os.getcwd())
+    with trees_lock:
+        tree = trees.get(root)
+        if tree is None:
+            tree = trees[root] = FileTree(root)
+    return tree
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="List the notes under a directory")
+    parser.add_argument("directory", nargs="?", default=os.getcwd())
+    parser.add_argument("--extension", action="append", default=None)
+    args = parser.parse_args()
+    tree = FileTree(args.directory)
+    for path in tree.files(args.extension or [".md"]):
+        print(path)
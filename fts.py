@@ -1,19 +1,671 @@
 import sqlite3
 import sys
-from tqdm import tqdm
+import time
 import os
 import hashlib
+import json
+import multiprocessing
+import re
+import unicodedata
+import zlib
+from urllib.parse import unquote
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import threading
+from collections import OrderedDict
+from contextlib import closing, contextmanager, nullcontext
+from itertools import repeat
 from config import Config
-from typing import Optional, List
+from filetree import file_tree
+from typing import Callable, Dict, Iterator, NamedTuple, Optional, List, Tuple, Union
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from workspace import Workspace
 
 config = Config()
 
+# Bump whenever the schema changes; older databases are rebuilt from scratch
+SCHEMA_VERSION = 7
+
+# Rows handed to each executemany call while indexing
+BATCH_SIZE = 1000
+
+# Seconds between progress reports while indexing, whatever the batch size
+PROGRESS_INTERVAL = 0.1
+
+# Prepared statements kept per connection, the palette's queries stay hot
+STATEMENT_CACHE_SIZE = 256
+
+# zlib level for stored bodies, they are only read back for snippets
+CONTENT_COMPRESSION_LEVEL = 6
+
+# Page cache used during bulk loads, in KiB
+BULK_CACHE_KIB = 64 * 1024
+
+# Bytes the WAL is cut back to once checkpointed, the vacuum after a bulk
+# load passes a copy of the whole database through it
+WAL_SIZE_LIMIT = 4 * 1024 * 1024
+
+
+# Below this many files to read, a process pool costs more than it saves
+PARALLEL_THRESHOLD = 256
+
+# Files handed to a worker process at a time
+PARALLEL_CHUNKSIZE = 32
+
+
+# Results per page returned by `FTS.search`
+SEARCH_PAGE_SIZE = 50
+
+# Queries kept by each connection's `QueryCache`
+QUERY_CACHE_SIZE = 128
+
+# Tokens of context in each result's snippet
+SNIPPET_TOKENS = 16
+
+# The trigram tokenizer makes a token of every character
+SNIPPET_TRIGRAMS = 64
+
+# Markers `snippet()` puts around matches, stripped by `parse_highlight`
+HIGHLIGHT_OPEN = "\x02"
+HIGHLIGHT_CLOSE = "\x03"
+
+
+# Prefix lengths `fts` keeps a dedicated index for, see `prefix_query`
+PREFIX_INDEXES = "2 3"
+
+# A partial word shorter than this is matched as a whole word, one letter
+# would expand to most of the vocabulary
+MIN_PREFIX_LENGTH = 2
+
+# Input containing any of these may be a hand written FTS5 query
+FTS_SYNTAX_PATTERN = re.compile(r'["*():^+{}]|\b(?:AND|OR|NOT|NEAR)\b')
+
+# Substring searches containing these are run as GLOB patterns
+GLOB_PATTERN = re.compile(r"[*?\[]")
+
+# Front matter as understood by the Markdown `meta` extension
+META_BEGIN_PATTERN = re.compile(r"^-{3}(\s.*)?$")
+META_END_PATTERN = re.compile(r"^(-{3}|\.{3})(\s.*)?$")
+META_PATTERN = re.compile(r"^[ ]{0,3}(?P<key>[A-Za-z0-9_-]+):\s*(?P<value>.*)")
+META_MORE_PATTERN = re.compile(r"^[ ]{4,}(?P<value>.*)")
+
+FENCE_PATTERN = re.compile(r"^\s{0,3}(`{3,}|~{3,})")
+HEADING_PATTERN = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)(?:\s+#+)?\s*$")
+INLINE_CODE_PATTERN = re.compile(r"`[^`]*`")
+TAG_PATTERN = re.compile(r"(?<![\w#&/])#([^\W\d][\w/-]*)")
+
+# Links between notes: `[[wikilinks]]`, `![[transclusions]]` and
+# `[text](target)` links, images excluded
+WIKILINK_PATTERN = re.compile(r"(!?)\[\[([^\]\n]+)\]\]")
+MARKDOWN_LINK_PATTERN = re.compile(
+    r"(?<!!)\[[^\]\n]*\]\(\s*<?([^)\s>]+)>?(?:\s+\"[^\"]*\")?\s*\)"
+)
+URL_SCHEME_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*:")
+
+# Where links point, removed before looking for tags so that in-page links
+# like `[setup](#setup)` or `[[#setup]]` don't become tags
+LINK_DESTINATION_PATTERN = re.compile(
+    r"\]\(\s*<?[^)\s>]*>?(?:\s+\"[^\"]*\")?\s*\)|\[\[[^\]\n]+\]\]"
+)
+
+# Column names that may prefix a search term, e.g. `tag:foo`
+FIELD_ALIASES = {
+    "title": "title",
+    "path": "title",
+    "heading": "headings",
+    "headings": "headings",
+    "meta": "meta",
+    "tag": "tags",
+    "tags": "tags",
+}
+FIELD_PATTERN = re.compile(r"^(\w+):(.*)$")
+
+# The column filters of an FTS5 query, `col:` or `{col col}:`, and the
+# quoted strings around them, where a colon is just text
+COLUMN_FILTER_PATTERN = re.compile(r'"(?:[^"]|"")*"|(\{[^}]*\}|\b\w+)(\s*:)')
+
+# bm25 weights of title, body, headings, meta and tags
+COLUMN_WEIGHTS = (10.0, 1.0, 5.0, 3.0, 8.0)
+
+# What the unicode61 tokenizer considers a token
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+
+def resolve_fields(query: str) -> str:
+    """
+    Rewrites the column filters of an FTS5 query that use `FIELD_ALIASES`,
+    e.g. `tag:foo` to `tags:foo`, leaving the rest of it as it is.
+    """
+
+    def resolve(m: re.Match) -> str:
+        if m.group(1) is None:
+            return m.group(0)
+        columns = re.sub(
+            r"\w+",
+            lambda name: FIELD_ALIASES.get(name.group(0).lower(), name.group(0)),
+            m.group(1),
+        )
+        return columns + m.group(2)
+
+    return COLUMN_FILTER_PATTERN.sub(resolve, query)
+
+
+def split_field(chunk: str) -> Tuple[Optional[str], str]:
+    """
+    Splits a `field:value` search term into its column and value.
+
+    Returns:
+        Tuple[Optional[str], str]: The FTS column, None if `chunk` has no
+            known field, and the rest of the term.
+    """
+    m = FIELD_PATTERN.match(chunk)
+    if m and m.group(1).lower() in FIELD_ALIASES:
+        return FIELD_ALIASES[m.group(1).lower()], m.group(2)
+    return None, chunk
+
+
+# Empty FTS tables that queries are checked against, one per thread
+query_parsers = threading.local()
+
+
+def is_valid_query(text: str) -> bool:
+    """
+    Whether FTS5 accepts a query for the columns of `fts`.
+    """
+    db = getattr(query_parsers, "db", None)
+    if db is None:
+        db = sqlite3.connect(":memory:")
+        db.execute(
+            "CREATE VIRTUAL TABLE fts USING fts5(title, body, headings, meta, tags)"
+        )
+        query_parsers.db = db
+    try:
+        db.execute("SELECT rowid FROM fts WHERE fts MATCH ?", (text,)).fetchall()
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def is_fts_syntax(text: str) -> bool:
+    """
+    Whether search text is a hand written FTS5 query rather than plain words.
+
+    Only well formed queries count, so that e.g. "TODO:", "10:30" or an
+    unbalanced "(" are searched for as words instead of failing.
+    """
+    return any(
+        FTS_SYNTAX_PATTERN.search(split_field(chunk)[1]) for chunk in text.split()
+    ) and is_valid_query(resolve_fields(text))
+
+
+def prefix_query(text: str) -> str:
+    """
+    Rewrites text typed into a search box into an FTS5 prefix query.
+
+    Every complete word must match and the word being typed (the last one,
+    unless followed by a space) matches as a prefix. The index keeps words
+    as written rather than stemmed, as "runn" is not a prefix of "run", the
+    stem of "running". Typing more of a word therefore only ever narrows
+    the results. Words written as `field:word`, e.g. `tag:foo` or
+    `heading:foo`, only match that column, see `FIELD_ALIASES`. Text that
+    already uses FTS5 syntax is passed through with its aliases resolved,
+    see `resolve_fields`.
+
+    Args:
+        text (str): The raw search text.
+
+    Returns:
+        str: An FTS5 query, or "" when there is nothing to search for.
+    """
+    if is_fts_syntax(text):
+        return resolve_fields(text)
+    chunks = text.split()
+    typing = bool(text) and not text[-1].isspace()
+    terms = []
+    for i, chunk in enumerate(chunks):
+        column, value = split_field(chunk)
+        tokens = TOKEN_PATTERN.findall(value)
+        for j, token in enumerate(tokens):
+            term = f'"{token}"'
+            partial = typing and i == len(chunks) - 1 and j == len(tokens) - 1
+            if partial and len(token) >= MIN_PREFIX_LENGTH:
+                term += "*"
+            if column is not None:
+                term = f"{column} : {term}"
+            terms.append(term)
+    return " AND ".join(terms)
+
+
+def match_query(query: str, mode: str) -> str:
+    """
+    The text a search passes to MATCH, or compares against for substrings.
+
+    Args:
+        query (str): The search text.
+        mode (str): See `FTS.iter_search`.
+    """
+    if mode == "prefix":
+        return prefix_query(query)
+    if mode == "fts":
+        return resolve_fields(query)
+    return query
+
+
+class SearchResult(NamedTuple):
+    """
+    A search hit.
+
+    Attributes:
+        path (str): The file path relative to the indexed directory.
+        rank (float): The bm25 score, lower is better.
+        snippet (str): The best matching fragment of the note.
+        matches (List[Tuple[int, int]]): Start and end offsets of each
+            matched term within `snippet`.
+        root (str): The indexed directory, set by workspace searches that
+            span several, see `workspace.Workspace`.
+    """
+
+    path: str
+    rank: float
+    snippet: str
+    matches: List[Tuple[int, int]]
+    root: str = ""
+
+
+def parse_highlight(text: str) -> Tuple[str, List[Tuple[int, int]]]:
+    """
+    Strips the match markers from a snippet, recording where they were.
+
+    Returns:
+        Tuple[str, List[Tuple[int, int]]]: The plain snippet and the offsets
+            of each match in it.
+    """
+    plain, matches = [], []
+    length = 0
+    for i, part in enumerate(text.split(HIGHLIGHT_OPEN)):
+        if i == 0:
+            plain.append(part)
+            length += len(part)
+            continue
+        match, _, rest = part.partition(HIGHLIGHT_CLOSE)
+        matches.append((length, length + len(match)))
+        plain.extend((match, rest))
+        length += len(match) + len(rest)
+    return "".join(plain), matches
+
+
+def snippet_column(table: str, tokens: int = SNIPPET_TOKENS) -> str:
+    """
+    The SQL computing a match's snippet from an FTS table, see `parse_highlight`.
+    """
+    markers = f"'{HIGHLIGHT_OPEN}', '{HIGHLIGHT_CLOSE}'"
+    return f"snippet({table}, -1, {markers}, '…', {tokens})"
+
+
+def snippet_source(
+    query: str, mode: str, trigram: bool
+) -> Optional[Tuple[str, str, int]]:
+    """
+    Where the snippets of a search come from, mirroring `FTS.iter_rows`.
+
+    Args:
+        query (str): The search text.
+        mode (str): See `FTS.iter_search`.
+        trigram (bool): Whether the index has a trigram table.
+
+    Returns:
+        Optional[Tuple[str, str, int]]: The FTS table, the MATCH expression and
+            the snippet length, None for searches without snippets.
+    """
+    query = match_query(query, mode)
+    if query.strip() == "":
+        return None
+    if mode != "substring":
+        return "fts", query, SNIPPET_TOKENS
+    if trigram and len(query) >= 3 and not GLOB_PATTERN.search(query):
+        return "fts_trigram", '"' + query.replace('"', '""') + '"', SNIPPET_TRIGRAMS
+    return None
+
+
+def narrows(old_text: str, new_text: str) -> bool:
+    """
+    Whether every match of `prefix_query(new_text)` also matches `old_text`.
+
+    True when text was only appended, unless the old partial word was too
+    short to be matched as a prefix, became a `field:` prefix or either
+    query is raw FTS5 syntax.
+    """
+    if not new_text.startswith(old_text) or is_fts_syntax(new_text):
+        return False
+    old_chunks = old_text.split()
+    if not old_chunks or old_text[-1].isspace():
+        return True
+    column, value = split_field(old_chunks[-1])
+    if split_field(new_text.split()[len(old_chunks) - 1])[0] != column:
+        return False
+    tokens = TOKEN_PATTERN.findall(value)
+    return not tokens or len(tokens[-1]) >= MIN_PREFIX_LENGTH
+
+
+class QueryCache:
+    """
+    An LRU cache of search results, emptied whenever the index changes.
+
+    Entries map (query, mode, limit, offset, snippets) to the (rowid,
+    SearchResult) pairs returned for it.
+    """
+
+    def __init__(self, maxsize: int = QUERY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.generation = None
+        self.entries: OrderedDict[tuple, List[Tuple[int, SearchResult]]] = (
+            OrderedDict()
+        )
+
+    def validate(self, generation) -> None:
+        """
+        Drops every entry if the index generation has moved on.
+        """
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, key: tuple) -> Optional[List[Tuple[int, SearchResult]]]:
+        rows = self.entries.get(key)
+        if rows is not None:
+            self.entries.move_to_end(key)
+        return rows
+
+    def put(self, key: tuple, rows: List[Tuple[int, SearchResult]]) -> None:
+        self.entries[key] = rows
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def excludes(self, text: str) -> bool:
+        """
+        Whether a cached prefix query that `text` narrows found nothing, so
+        `text` can't match anything either.
+
+        Only empty results are reused. Restricting the query to a non-empty
+        candidate set still evaluates the whole MATCH and loses the early
+        exit of `ORDER BY rank LIMIT`, it is slower than running it as is.
+        """
+        for (old_text, mode, limit, offset, _), rows in self.entries.items():
+            if mode == "prefix" and offset == 0 and limit != 0 and not rows:
+                if narrows(old_text, text):
+                    return True
+        return False
+
+
+class IndexCancelled(Exception):
+    """
+    Raised when an index build is cancelled, the build is rolled back.
+    """
+
+
+def normalise_text(text: str) -> str:
+    """
+    Normalises a document body before it is indexed.
+
+    Strips a byte order mark, converts line endings to `\\n` and composes
+    unicode so that e.g. "é" matches regardless of how it was typed.
+    """
+    text = text.removeprefix("\ufeff").replace("\r\n", "\n").replace("\r", "\n")
+    return unicodedata.normalize("NFC", text)
+
+
+def deflate(body: str) -> bytes:
+    """
+    Compresses a body for the `content` table.
+    """
+    return zlib.compress(body.encode("utf-8"), CONTENT_COMPRESSION_LEVEL)
+
+
+def inflate(data: bytes) -> str:
+    """
+    Decompresses a body from the `content` table, registered as an SQL function.
+    """
+    return zlib.decompress(data).decode("utf-8")
+
+
+class Document(NamedTuple):
+    """
+    The indexed fields of a note, one per FTS column besides the title.
+
+    Attributes:
+        body (str): The normalised text.
+        headings (str): The text of each ATX heading, one per line.
+        meta (str): The `meta` extension front matter as "key value" lines.
+        tags (str): Inline #tags and those listed under a `tags` key.
+        links (Tuple[Tuple[str, str], ...]): The target and kind of each link,
+            see `resolve_link`. Stored in the `links` table, not searched.
+        compressed (bytes): `body` as stored in the `content` table, see
+            `deflate`. Set by `read_document`, so that worker processes
+            compress rather than the thread writing the index.
+    """
+
+    body: str
+    headings: str
+    meta: str
+    tags: str
+    links: Tuple[Tuple[str, str], ...] = ()
+    compressed: bytes = b""
+
+
+class Link(NamedTuple):
+    """
+    A link from one note to another, paths are relative to the indexed directory.
+
+    Attributes:
+        source (str): The note containing the link.
+        target (str): The file linked to, which may not exist.
+        kind (str): "wikilink", "transclusion" or "markdown".
+    """
+
+    source: str
+    target: str
+    kind: str
+
+
+def parse_front_matter(lines: List[str]) -> Tuple[Dict[str, List[str]], int]:
+    """
+    Parses front matter the way the Markdown `meta` extension does.
+
+    Returns:
+        Tuple[Dict[str, List[str]], int]: The values of each (lower case)
+            key and the number of lines the front matter took up.
+    """
+    meta: Dict[str, List[str]] = {}
+    start = 1 if lines and META_BEGIN_PATTERN.match(lines[0]) else 0
+    key = None
+    for i in range(start, len(lines)):
+        line = lines[i]
+        if not line.strip() or (start and META_END_PATTERN.match(line)):
+            return meta, i + 1
+        m = META_PATTERN.match(line)
+        if m:
+            key = m.group("key").lower()
+            meta.setdefault(key, []).append(m.group("value").strip())
+            continue
+        m = META_MORE_PATTERN.match(line)
+        if m and key is not None:
+            meta[key].append(m.group("value").strip())
+            continue
+        return meta, i
+    return meta, len(lines)
+
+
+def resolve_link(source: str, target: str, kind: str) -> Optional[str]:
+    """
+    Resolves a link to the path of the file it points to, as the preview would.
+
+    Wikilinks and transclusions name a note relative to the indexed
+    directory, with spaces in wikilinks replaced as `WikiLinkExtension`
+    does. Markdown links are relative to the linking note.
+
+    Args:
+        source (str): The path of the linking note, relative to the indexed
+            directory.
+        target (str): The link text or URL.
+        kind (str): "wikilink", "transclusion" or "markdown".
+
+    Returns:
+        Optional[str]: The relative path, None for external URLs, anchors
+            within the note and paths outside the directory.
+    """
+    if kind == "wikilink":
+        target = re.sub(r"([ ]+_)|(_[ ]+)|([ ]+)", "_", target.strip()) + ".md"
+    elif kind == "transclusion":
+        target = target + ".md"
+    else:
+        if URL_SCHEME_PATTERN.match(target):
+            return None
+        target = unquote(target.split("#", 1)[0].split("?", 1)[0])
+        if not target:
+            return None
+        if not target.startswith("/"):
+            target = os.path.join(os.path.dirname(source), target)
+    path = os.path.normpath(target.lstrip("/"))
+    if path.startswith(os.pardir) or os.path.isabs(path):
+        return None
+    return path
+
+
+def extract_links(source: str, line: str) -> List[Tuple[str, str]]:
+    """
+    Finds the links in a line of a note, see `resolve_link`.
+    """
+    links = []
+    for m in WIKILINK_PATTERN.finditer(line):
+        kind = "transclusion" if m.group(1) else "wikilink"
+        links.append((m.group(2), kind))
+    for m in MARKDOWN_LINK_PATTERN.finditer(line):
+        links.append((m.group(1), "markdown"))
+    resolved = []
+    for target, kind in links:
+        path = resolve_link(source, target, kind)
+        if path is not None:
+            resolved.append((path, kind))
+    return resolved
+
+
+def extract_fields(body: str, filepath: str = "") -> Document:
+    """
+    Pulls the headings, front matter, tags and links out of a note's body.
+
+    Fenced code blocks and inline code are skipped, so neither comments in
+    code nor `#include` lines become headings or tags.
+
+    Args:
+        body (str): The normalised text.
+        filepath (str): The path of the note relative to the indexed
+            directory, relative Markdown links are resolved against it.
+    """
+    lines = body.split("\n")
+    meta, end = parse_front_matter(lines)
+    headings, tags, links = [], [], []
+    for value in meta.get("tags", []) + meta.get("tag", []):
+        tags.extend(t.lstrip("#") for t in re.split(r"[,\s]+", value) if t)
+    fence = None
+    for line in lines[end:]:
+        m = FENCE_PATTERN.match(line)
+        if m:
+            if fence is None:
+                fence = m.group(1)[0] * len(m.group(1))
+            elif m.group(1).startswith(fence):
+                fence = None
+            continue
+        if fence is not None:
+            continue
+        m = HEADING_PATTERN.match(line)
+        if m:
+            headings.append(m.group(1))
+            continue
+        line = INLINE_CODE_PATTERN.sub("", line)
+        links.extend(extract_links(filepath, line))
+        tags.extend(TAG_PATTERN.findall(LINK_DESTINATION_PATTERN.sub("]", line)))
+    meta_text = "\n".join(f"{key} {' '.join(values)}" for key, values in meta.items())
+    return Document(
+        body,
+        "\n".join(headings),
+        meta_text,
+        " ".join(tags),
+        tuple(dict.fromkeys(links)),
+    )
+
+
+def read_document(root: str, filepath: str) -> Tuple[str, Document]:
+    """
+    Reads a file for indexing.
+
+    Args:
+        root (str): The indexed directory.
+        filepath (str): The path of the file relative to `root`.
+
+    Returns:
+        Tuple[str, Document]: The sha256 of the raw bytes and the fields of
+            the normalised body, ready to be written.
+    """
+    with open(os.path.join(root, filepath), "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    body = normalise_text(content.decode("utf-8", errors="replace"))
+    document = extract_fields(body, filepath)
+    return digest, document._replace(compressed=deflate(body))
+
+
+def extract_document(
+    root: str, filepath: str
+) -> Tuple[str, Optional[str], Union[Document, str]]:
+    """
+    Wraps `read_document` for use in a worker process.
+
+    Errors are returned rather than raised so that one unreadable file does
+    not abort the whole `Executor.map`.
+
+    Returns:
+        Tuple[str, Optional[str], Union[Document, str]]: The path, the hash
+            (None on error) and the document (the error message on error).
+    """
+    try:
+        digest, document = read_document(root, filepath)
+    except (OSError, ValueError) as e:
+        return filepath, None, str(e)
+    return filepath, digest, document
+
+
+def process_context() -> multiprocessing.context.BaseContext:
+    """
+    How worker processes are started for `FTS.extract_documents`.
+
+    Indexing runs alongside other threads in the editor, forking such a
+    process could leave a worker waiting on a lock one of them held. A fork
+    server is forked from a clean process instead, where there is none
+    `spawn` starts a fresh interpreter for each worker.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    return multiprocessing.get_context("forkserver")
+
+
+def database_path(directory: str, extension: str = "sqlite3") -> Path:
+    """
+    Where the index of a directory is kept, whether or not it exists yet.
+    """
+    # Hash the content to generate a unique filename
+    hash_hex = hashlib.sha256(directory.encode("utf-8")).hexdigest()
+    return config.data_home / f"{hash_hex}.{extension}"
+
 
 class FTS:
     def __init__(
         self,
         allowed_extensions: Optional[List[str]] = None,
         current_dir: Optional[str] = None,
+        trigram: Optional[bool] = None,
     ):
         """
         Initializes the full-text search class.
@@ -22,11 +674,20 @@ class FTS:
             allowed_extensions (Optional[List[str]]): List of file extensions to include.
                 Defaults to [".md"] if None is provided.
             current_dir (Optional[str]): The directory to index. Defaults to the current working directory.
+            trigram (Optional[bool]): Maintain a secondary trigram index for
+                substring searches. Defaults to the `trigram_index` config option.
         """
         if allowed_extensions is None:
             allowed_extensions = [".md"]
         self.allowed_extensions = allowed_extensions
         self.current_dir = current_dir or os.getcwd()
+        if trigram is None:
+            trigram = config.config.get("trigram_index", False)
+        self.trigram = trigram
+        self.fts_tables = ["fts"] + (["fts_trigram"] if trigram else [])
+        # Commits made through this connection, see `generation`
+        self.writes = 0
+        self.cache = QueryCache()
         self.set_db_path()
         self.load_database()
 
@@ -37,86 +698,587 @@ class FTS:
         Args:
             extension (str): The file extension for the database file. Defaults to 'sqlite3'.
         """
-        # Hash the content to generate a unique filename
-        hash_object = hashlib.sha256(self.current_dir.encode("utf-8"))
-        hash_hex = hash_object.hexdigest()
-        db_name = f"{hash_hex}.{extension}"
-        self.db_path = (
-            config.data_home / db_name
-        )  # Assuming config.data_home is a Path object
+        self.db_path = database_path(self.current_dir, extension)
 
     def load_database(self) -> None:
         """
         Loads the database if it exists; otherwise, creates a new one.
+
+        Databases written by an older schema (e.g. without the file manifest)
+        are dropped and recreated, the next index run repopulates them.
         """
-        if not self.db_path.exists():
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Each connection is used by one thread, but `SearchService` may
+        # interrupt or close it from another
+        self.db = sqlite3.connect(
+            self.db_path,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=False,
+        )
+        # The `documents` view decompresses bodies with this
+        self.db.create_function("inflate", 1, inflate, deterministic=True)
+        # Lets searches read the last committed index while a build is running
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute(f"PRAGMA journal_size_limit = {WAL_SIZE_LIMIT}")
+        (version,) = self.db.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
             self.create_database()
         else:
-            self.db = sqlite3.connect(self.db_path)
+            self.sync_trigram_table()
 
-    def create_database(self) -> None:
+    def create_trigram_table(self) -> None:
         """
-        Creates a new FTS database with the required schema.
+        Creates the secondary index used for substring and `GLOB` searches.
+
+        Like `fts` it reads its columns from the `documents` view.
         """
-        self.db = sqlite3.connect(self.db_path)
         self.db.execute(
-            "CREATE VIRTUAL TABLE fts USING fts5(title, body, tokenize = 'porter')"
+            """
+            CREATE VIRTUAL TABLE fts_trigram USING fts5(
+                title, body, content = 'documents', content_rowid = 'id',
+                tokenize = 'trigram'
+            )
+            """
         )
 
-    def walk_files(self, relative: bool = True) -> List[str]:
+    def sync_trigram_table(self) -> None:
+        """
+        Adds or drops the trigram index after the `trigram` option changed.
+        """
+        exists = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'fts_trigram'"
+        ).fetchone()
+        if self.trigram and not exists:
+            with self.db:
+                self.db.execute("BEGIN")
+                self.create_trigram_table()
+                self.db.execute("INSERT INTO fts_trigram(fts_trigram) VALUES ('rebuild')")
+            self.writes += 1
+        elif not self.trigram and exists:
+            with self.db:
+                self.db.execute("BEGIN")
+                self.db.execute("DROP TABLE fts_trigram")
+            self.writes += 1
+
+    def create_database(self) -> None:
+        """
+        Creates a new FTS database with the required schema.
+
+        The `files` table is a manifest of everything in the index, its `id`
+        doubles as the rowid of the matching row in `fts`. Bodies are stored
+        once, zlib compressed, in `content` along with the headings, front
+        matter and tags pulled out of them. The FTS tables are external
+        content tables that only hold the index and read their columns for
+        snippets through the `documents` view. `fts` indexes words as written,
+        with prefix indexes for searches as you type. `links` records every link
+        between notes by the id of the source and the path of the target, so
+        that links to notes which don't exist yet resolve once they do.
+
+        The schema is built in one transaction, so a failure part way leaves
+        the previous version behind to be rebuilt next time.
+        """
+        with self.db:
+            # DDL would otherwise run outside of the implicit transaction
+            self.db.execute("BEGIN")
+            self.db.execute("DROP TABLE IF EXISTS links")
+            self.db.execute("DROP TABLE IF EXISTS fts")
+            self.db.execute("DROP TABLE IF EXISTS fts_prefix")
+            self.db.execute("DROP TABLE IF EXISTS fts_trigram")
+            self.db.execute("DROP VIEW IF EXISTS documents")
+            self.db.execute("DROP TABLE IF EXISTS content")
+            self.db.execute("DROP TABLE IF EXISTS files")
+            self.db.execute(
+                """
+                CREATE TABLE files (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT NOT NULL UNIQUE,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    hash TEXT NOT NULL
+                )
+                """
+            )
+            self.db.execute(
+                """
+                CREATE TABLE content (
+                    id INTEGER PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    headings TEXT NOT NULL,
+                    meta TEXT NOT NULL,
+                    tags TEXT NOT NULL
+                )
+                """
+            )
+            self.db.execute(
+                """
+                CREATE VIEW documents AS
+                SELECT files.id AS id, files.path AS title,
+                    inflate(content.body) AS body, content.headings AS headings,
+                    content.meta AS meta, content.tags AS tags
+                FROM files JOIN content ON content.id = files.id
+                """
+            )
+            # Unstemmed, so that a partial word is a prefix of what it will be.
+            # One index serves every mode, a second, stemmed, copy of the
+            # bodies would cost more than the stemming is worth
+            self.db.execute(
+                f"""
+                CREATE VIRTUAL TABLE fts USING fts5(
+                    title, body, headings, meta, tags,
+                    content = 'documents', content_rowid = 'id',
+                    tokenize = 'unicode61', prefix = '{PREFIX_INDEXES}'
+                )
+                """
+            )
+            self.db.execute(
+                """
+                CREATE TABLE links (
+                    source INTEGER NOT NULL,
+                    target TEXT NOT NULL,
+                    kind TEXT NOT NULL
+                )
+                """
+            )
+            self.db.execute("CREATE INDEX links_source ON links(source)")
+            self.db.execute("CREATE INDEX links_target ON links(target)")
+            # Makes `ORDER BY rank` weigh matches by column
+            weights = ", ".join(map(str, COLUMN_WEIGHTS))
+            self.db.execute(
+                "INSERT INTO fts(fts, rank) VALUES ('rank', ?)",
+                (f"bm25({weights})",),
+            )
+            if self.trigram:
+                self.create_trigram_table()
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        # Give back the pages of any tables that were dropped
+        self.db.execute("VACUUM")
+        self.writes += 1
+
+    def walk_files(
+        self, relative: bool = True, subdirectory: Optional[str] = None
+    ) -> List[str]:
         """
         Walks through the current directory and collects all files with allowed extensions.
 
+        Ignored files and directories are skipped and listings of unchanged
+        directories are reused, see `filetree.FileTree`.
+
+        Args:
+            relative (bool): Return paths relative to the current directory.
+            subdirectory (Optional[str]): Only walk this part of the tree.
+
         Returns:
             List[str]: A list of file paths.
         """
-        all_files = []
-        print(f"Indexing {self.current_dir}...")
-        for root, dirs, files in os.walk(self.current_dir):
-            for filename in files:
-                if filename.endswith(tuple(self.allowed_extensions)):
-                    file_path = os.path.join(root, filename)
-                    if relative:
-                        file_path = os.path.relpath(file_path, self.current_dir)
-                    all_files.append(file_path)
+        all_files = file_tree(self.current_dir).files(
+            self.allowed_extensions, subdirectory
+        )
+        if not relative:
+            all_files = [os.path.join(self.current_dir, path) for path in all_files]
         return all_files
 
     def remove_database(self) -> None:
         """
-        Removes the FTS database file.
+        Removes the FTS database file along with its WAL files.
+        """
+        for suffix in ("", "-wal", "-shm"):
+            path = self.db_path.with_name(self.db_path.name + suffix)
+            if path.exists():
+                os.remove(path)
+
+    def is_empty(self) -> bool:
+        """
+        Whether nothing has been indexed yet.
+        """
+        return self.db.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+
+    def load_manifest(self) -> Dict[str, Tuple[int, float, int, str]]:
+        """
+        Reads the file manifest from the database.
+
+        Returns:
+            Dict[str, Tuple[int, float, int, str]]: Maps each indexed path to
+                its (id, mtime, size, hash).
+        """
+        cursor = self.db.execute("SELECT path, id, mtime, size, hash FROM files")
+        return {path: tuple(entry) for path, *entry in cursor}
+
+    def find_changes(
+        self, manifest: Dict[str, Tuple[int, float, int, str]]
+    ) -> List[Tuple[str, float, int, Optional[Tuple[int, float, int, str]]]]:
         """
-        if self.db_path.exists():
-            os.remove(self.db_path)
+        Stats every file in the current directory against the manifest.
+
+        Entries for files found on disk are popped from `manifest`, so
+        whatever is left afterwards has been deleted.
 
-    def index_current_dir(self) -> None:
+        Returns:
+            List[Tuple[str, float, int, Optional[Tuple[int, float, int, str]]]]:
+                (path, mtime, size, manifest entry) for every file that is new
+                or whose mtime or size changed.
         """
-        Indexes all files in the current directory into the FTS database.
+        pending = []
+        for filepath in self.walk_files(relative=True):
+            try:
+                stat = os.stat(os.path.join(self.current_dir, filepath))
+            except OSError as e:
+                print(f"Error indexing file {filepath}: {e}", file=sys.stderr)
+                continue
+            entry = manifest.pop(filepath, None)
+            if entry is not None:
+                _, mtime, size, _ = entry
+                if stat.st_mtime == mtime and stat.st_size == size:
+                    continue
+            pending.append((filepath, stat.st_mtime, stat.st_size, entry))
+        return pending
+
+    def update_files(self, filepaths: List[str]) -> Tuple[int, int, int]:
         """
-        # TODO: check hash before indexing
-        # TODO candidate for config file
-        all_files = self.walk_files(relative=True)
-        for i, filepath in tqdm(enumerate(all_files)):
-            ext = filepath
-            ext = os.path.splitext(ext)[-1]
-            if ext in self.allowed_extensions:
-                print(f"Indexing {filepath}")
+        Re-indexes specific files without scanning the rest of the tree.
+
+        Args:
+            filepaths (List[str]): Absolute paths or paths relative to the
+                current directory. Files that no longer exist are removed
+                from the index, paths outside it are ignored.
+
+        Returns:
+            Tuple[int, int, int]: The number of added, updated and removed files.
+        """
+        pending, removed = [], []
+        tree = file_tree(self.current_dir)
+        relpaths = {
+            os.path.relpath(os.path.join(self.current_dir, filepath), self.current_dir)
+            for filepath in filepaths
+        }
+        for filepath in sorted(relpaths):
+            if filepath.startswith(os.pardir) or not filepath.endswith(
+                tuple(self.allowed_extensions)
+            ):
+                continue
+            entry = self.db.execute(
+                "SELECT id, mtime, size, hash FROM files WHERE path = ?", (filepath,)
+            ).fetchone()
+            try:
+                # Files that are now ignored are dropped like deleted ones
+                if tree.is_ignored(filepath):
+                    raise FileNotFoundError(filepath)
+                stat = os.stat(os.path.join(self.current_dir, filepath))
+            except FileNotFoundError:
+                if entry is not None:
+                    removed.append((entry[0],))
+                continue
+            except OSError as e:
+                print(f"Error indexing file {filepath}: {e}", file=sys.stderr)
+                continue
+            if entry is not None:
+                _, mtime, size, _ = entry
+                if stat.st_mtime == mtime and stat.st_size == size:
+                    continue
+            pending.append((filepath, stat.st_mtime, stat.st_size, entry))
+
+        with self.db:
+            (next_id,) = self.db.execute(
+                "SELECT COALESCE(MAX(id), 0) + 1 FROM files"
+            ).fetchone()
+            batch = []
+            for filepath, mtime, size, entry in pending:
                 try:
-                    with open(filepath, "r", encoding="utf-8") as f:
-                        body = f.read()
-                        title = filepath
+                    digest, document = read_document(self.current_dir, filepath)
+                except OSError as e:
+                    print(f"Error indexing file {filepath}: {e}", file=sys.stderr)
+                    continue
+                batch.append((filepath, mtime, size, entry, digest, document))
+            added, updated = self.write_batch(batch, next_id)
+            self.delete_rows(removed)
+        if added or updated or removed:
+            self.writes += 1
+        return added, updated, len(removed)
+
+    def update_directory(self, directory: str) -> Tuple[int, int, int]:
+        """
+        Re-indexes the files directly inside one directory.
+
+        Subdirectories that are new to the index or no longer exist, e.g. a
+        folder moved in by a sync tool, are handled recursively. Existing
+        subdirectories are left to their own change notifications.
+
+        Args:
+            directory (str): An absolute path or one relative to the current
+                directory.
+
+        Returns:
+            Tuple[int, int, int]: See `update_files`.
+        """
+        full_dir = os.path.join(self.current_dir, directory)
+        reldir = os.path.relpath(full_dir, self.current_dir)
+        prefix = "" if reldir == os.curdir else reldir + os.sep
+        cursor = self.db.execute(
+            "SELECT path FROM files WHERE path >= ? AND path < ?",
+            (prefix, prefix + "\U0010ffff"),
+        )
+        indexed_subdirs: Dict[str, List[str]] = {}
+        candidates = set()
+        for (filepath,) in cursor:
+            name, sep, _ = filepath[len(prefix) :].partition(os.sep)
+            if sep:
+                indexed_subdirs.setdefault(name, []).append(filepath)
+            else:
+                candidates.add(filepath)
+
+        tree = file_tree(self.current_dir)
+        # Change notifications can arrive within the directory's mtime tick
+        tree.invalidate(reldir)
+        files, subdirs = tree.entries(reldir)
+        for name in subdirs:
+            if indexed_subdirs.pop(name, None) is None:
+                candidates.update(self.walk_files(subdirectory=prefix + name))
+        for name in files:
+            if name.endswith(tuple(self.allowed_extensions)):
+                candidates.add(prefix + name)
+        # Anything left was indexed under a subdirectory that is gone
+        for filepaths in indexed_subdirs.values():
+            candidates.update(filepaths)
+        return self.update_files(list(candidates))
+
+    @contextmanager
+    def bulk_load(self) -> Iterator[None]:
+        """
+        Relaxes durability for the duration of a large build.
+
+        A crash mid-build can at worst lose the build itself, the manifest is
+        only committed alongside the rows it describes.
+        """
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("PRAGMA temp_store = MEMORY")
+        self.db.execute(f"PRAGMA cache_size = -{BULK_CACHE_KIB}")
+        try:
+            yield
+        finally:
+            self.db.execute("PRAGMA synchronous = NORMAL")
+
+    def write_batch(self, documents: List[tuple], next_id: int) -> Tuple[int, int]:
+        """
+        Writes a batch of read documents to the manifest and the FTS table.
+
+        Args:
+            documents (List[tuple]): (path, mtime, size, manifest entry, hash,
+                Document) for each document.
+            next_id (int): The id to give the first new document.
+
+        Returns:
+            Tuple[int, int]: The number of added and updated documents.
+        """
+        new_files, new_rows, manifest_updates, stale_ids = [], [], [], []
+        contents, links = [], []
+        for filepath, mtime, size, entry, digest, document in documents:
+            if entry is None:
+                file_id = next_id
+                next_id += 1
+                new_files.append((file_id, filepath, mtime, size, digest))
+            else:
+                file_id, _, _, old_hash = entry
+                manifest_updates.append((mtime, size, digest, file_id))
+                if digest == old_hash:
+                    continue
+                stale_ids.append((file_id,))
+            new_rows.append((file_id, filepath, *document[:4]))
+            compressed = document.compressed or deflate(document.body)
+            contents.append((file_id, compressed, *document[1:4]))
+            links.extend((file_id, target, kind) for target, kind in document.links)
+
+        # Remove the old tokens while `documents` still returns what was indexed
+        for table in self.fts_tables:
+            self.db.executemany(f"DELETE FROM {table} WHERE rowid = ?", stale_ids)
+        self.db.executemany("DELETE FROM links WHERE source = ?", stale_ids)
+        self.db.executemany(
+            "INSERT INTO files(id, path, mtime, size, hash) VALUES (?, ?, ?, ?, ?)",
+            new_files,
+        )
+        self.db.executemany(
+            "UPDATE files SET mtime = ?, size = ?, hash = ? WHERE id = ?",
+            manifest_updates,
+        )
+        self.db.executemany(
+            "INSERT OR REPLACE INTO content(id, body, headings, meta, tags) "
+            "VALUES (?, ?, ?, ?, ?)",
+            contents,
+        )
+        self.db.executemany(
+            "INSERT INTO fts(rowid, title, body, headings, meta, tags) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            new_rows,
+        )
+        if self.trigram:
+            self.db.executemany(
+                "INSERT INTO fts_trigram(rowid, title, body) VALUES (?, ?, ?)",
+                [row[:3] for row in new_rows],
+            )
+        self.db.executemany(
+            "INSERT INTO links(source, target, kind) VALUES (?, ?, ?)", links
+        )
+        return len(new_files), len(stale_ids)
+
+    def delete_rows(self, file_ids: List[Tuple[int]]) -> None:
+        """
+        Removes documents from the manifest, every FTS table and the link graph.
+
+        Args:
+            file_ids (List[Tuple[int]]): The ids of the documents, as 1-tuples
+                for executemany.
+        """
+        # The FTS tables read the old tokens through `documents`, so go first
+        for table in self.fts_tables:
+            self.db.executemany(f"DELETE FROM {table} WHERE rowid = ?", file_ids)
+        self.db.executemany("DELETE FROM links WHERE source = ?", file_ids)
+        self.db.executemany("DELETE FROM content WHERE id = ?", file_ids)
+        self.db.executemany("DELETE FROM files WHERE id = ?", file_ids)
+
+    def extract_documents(
+        self, filepaths: List[str], jobs: Optional[int] = None
+    ) -> Iterator[Tuple[str, Optional[str], Union[Document, str]]]:
+        """
+        Reads, normalises and compresses files, in parallel when there are
+        enough of them.
+
+        Args:
+            filepaths (List[str]): Paths relative to the current directory.
+            jobs (Optional[int]): Number of worker processes. Defaults to the
+                `index_jobs` config option, or the number of CPUs if unset.
+
+        Yields:
+            Tuple[str, Optional[str], Union[Document, str]]: See
+                `extract_document`, in the
+                order of `filepaths`.
+        """
+        jobs = jobs or config.config.get("index_jobs") or os.cpu_count() or 1
+        roots = repeat(self.current_dir)
+        if jobs == 1 or len(filepaths) < PARALLEL_THRESHOLD:
+            yield from map(extract_document, roots, filepaths)
+            return
+        executor = ProcessPoolExecutor(max_workers=jobs, mp_context=process_context())
+        try:
+            yield from executor.map(
+                extract_document, roots, filepaths, chunksize=PARALLEL_CHUNKSIZE
+            )
+        finally:
+            # Don't read the rest of the tree if the consumer gave up early
+            executor.shutdown(cancel_futures=True)
+
+    def index_current_dir(
+        self,
+        bulk: Optional[bool] = None,
+        jobs: Optional[int] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+        cancel: Optional[threading.Event] = None,
+        quiet: bool = False,
+    ) -> str:
+        """
+        Brings the FTS database in line with the files in the current directory.
+
+        Only files that were added, changed or removed since the last run are
+        touched. A file whose mtime and size match the manifest is skipped
+        without being read, one whose content hash matches only has its
+        manifest entry refreshed. Rows are written in batches of `BATCH_SIZE`
+        within a single transaction, so readers on other connections keep
+        seeing the previous index until the build commits.
+
+        Args:
+            bulk (Optional[bool]): Relax durability during the build, then
+                merge the index into a single segment and vacuum. Defaults to
+                True for a cold build, i.e. when the index is empty.
+            jobs (Optional[int]): Number of processes used to read files,
+                see `extract_documents`. Writes always happen on this one.
+            progress (Optional[Callable[[int, int], None]]): Called with the
+                number of files processed so far and the total, as the build
+                starts, every `PROGRESS_INTERVAL` seconds and once it is done.
+            cancel (Optional[threading.Event]): When set, the build is rolled
+                back and `IndexCancelled` is raised.
+            quiet (bool): Don't print the directory and the summary, e.g. for
+                periodic rescans in the background.
+
+        Returns:
+            str: A summary of the changes and the throughput.
+        """
+        start = time.perf_counter()
+        if not quiet:
+            print(f"Indexing {self.current_dir}...")
+        manifest = self.load_manifest()
+        if bulk is None:
+            bulk = not manifest
+        pending = self.find_changes(manifest)
+        # Whatever is left in the manifest no longer exists on disk
+        removed = [(file_id,) for file_id, *_ in manifest.values()]
+        total = len(pending)
+        if progress is not None:
+            progress(0, total)
+        reported = time.perf_counter()
+
+        added = updated = nbytes = done = 0
+        with self.bulk_load() if bulk else nullcontext():
+            with self.db:
+                (next_id,) = self.db.execute(
+                    "SELECT COALESCE(MAX(id), 0) + 1 FROM files"
+                ).fetchone()
+                batch = []
+                documents = self.extract_documents([p[0] for p in pending], jobs)
+                with closing(documents):
+                    for (_, mtime, size, entry), (filepath, digest, document) in zip(
+                        pending, documents
+                    ):
+                        if cancel is not None and cancel.is_set():
+                            raise IndexCancelled(self.current_dir)
+                        done += 1
+                        if progress is not None:
+                            now = time.perf_counter()
+                            if now - reported >= PROGRESS_INTERVAL:
+                                progress(done, total)
+                                reported = now
+                        if digest is None:
+                            print(
+                                f"Error indexing file {filepath}: {document}",
+                                file=sys.stderr,
+                            )
+                            continue
+                        batch.append((filepath, mtime, size, entry, digest, document))
+                        nbytes += size
+                        if len(batch) < BATCH_SIZE and done < total:
+                            continue
+                        n_added, n_updated = self.write_batch(batch, next_id)
+                        next_id += n_added
+                        added += n_added
+                        updated += n_updated
+                        batch = []
+                # Flush the remainder if the last file failed to read
+                n_added, n_updated = self.write_batch(batch, next_id)
+                added += n_added
+                updated += n_updated
+
+                self.delete_rows(removed)
+
+            if bulk:
+                # Merge the b-trees written by each batch into one
+                with self.db:
+                    for table in self.fts_tables:
                         self.db.execute(
-                            "INSERT INTO fts(title, body) VALUES (?, ?)", (title, body)
+                            f"INSERT INTO {table}({table}) VALUES ('optimize')"
                         )
-                except Exception as e:
-                    # Log the error or handle it accordingly
-                    print(f"Error indexing file {filepath}: {e}", file=sys.stderr)
-        self.db.commit()
+                # Give back the pages of the b-trees the merge replaced
+                self.db.execute("VACUUM")
 
-        # Test that the indexing was successful
-        with self.db:
-            cursor = self.db.execute("SELECT COUNT(*) FROM fts")
-            count = cursor.fetchone()[0]
-            print(f"Indexed {count} documents into {self.db_path}")
+        if added or updated or removed:
+            self.writes += 1
+        if progress is not None:
+            progress(total, total)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        summary = (
+            f"Indexed {self.current_dir} in {elapsed:.2f}s: "
+            f"{added} added, {updated} updated, {len(removed)} removed "
+            f"({total / elapsed:.0f} files/s, "
+            f"{nbytes / elapsed / 1e6:.1f} MB/s)"
+        )
+        if not quiet:
+            print(summary)
+        return summary
 
     def close(self) -> None:
         """
@@ -137,37 +1299,454 @@ class FTS:
         """
         self.close()
 
-    def search(self, query: str) -> List[tuple]:
+    @property
+    def generation(self) -> Tuple[int, int]:
+        """
+        A token that changes whenever the index is written.
+
+        `PRAGMA data_version` changes when another connection, e.g. the
+        background indexer, commits; `writes` counts this connection's own.
+        """
+        (data_version,) = self.db.execute("PRAGMA data_version").fetchone()
+        return data_version, self.writes
+
+    def iter_rows(
+        self,
+        query: str,
+        limit: int = -1,
+        offset: int = 0,
+        mode: str = "fts",
+        snippets: bool = True,
+    ) -> Iterator[Tuple[int, SearchResult]]:
+        """
+        Streams search results best first, along with their rowids.
+
+        See `iter_search`.
+        """
+        query = match_query(query, mode)
+        params = (limit, offset)
+        try:
+            if query.strip() == "":
+                cursor = self.db.execute(
+                    "SELECT id, path, 0.0, '' FROM files ORDER BY path LIMIT ? OFFSET ?",
+                    params,
+                )
+            elif mode == "substring":
+                cursor = self.substring_cursor(query, params, snippets)
+            else:
+                # `rank` is bm25() unless configured otherwise, ordering by it
+                # lets FTS5 stop after the first `limit` results
+                snippet = snippet_column("fts") if snippets else "''"
+                cursor = self.db.execute(
+                    f"""
+                    SELECT rowid, title, rank, {snippet}
+                    FROM fts WHERE fts MATCH ?
+                    ORDER BY rank LIMIT ? OFFSET ?
+                    """,
+                    (query, *params),
+                )
+        except sqlite3.OperationalError as e:
+            # A superseded query, see `SearchService.interrupt`
+            if str(e) == "interrupted":
+                raise
+            print(f"Invalid query: {e}", file=sys.stderr)
+            return
+        for rowid, path, rank, snippet in cursor:
+            text, matches = parse_highlight(snippet)
+            yield rowid, SearchResult(path, rank, text, matches)
+
+    def substring_cursor(
+        self, text: str, params: tuple, snippets: bool = True
+    ) -> sqlite3.Cursor:
+        """
+        Runs a substring search, see `iter_search`.
+
+        With the trigram index, text of three or more characters is matched
+        as a phrase of trigrams, which is ranked and has snippets, while
+        wildcards use `GLOB` and shorter text `LIKE`, both of which the index
+        accelerates where it can. Without it they scan every body.
+        """
+        table = "fts_trigram" if self.trigram else "fts"
+        if GLOB_PATTERN.search(text):
+            if not text.startswith("*"):
+                text = "*" + text
+            if not text.endswith("*"):
+                text += "*"
+            return self.db.execute(
+                f"""
+                SELECT rowid, title, 0.0, '' FROM {table}
+                WHERE body GLOB ?
+                ORDER BY title LIMIT ? OFFSET ?
+                """,
+                (text, *params),
+            )
+        if self.trigram and len(text) >= 3:
+            phrase = '"' + text.replace('"', '""') + '"'
+            snippet = snippet_column(table, SNIPPET_TRIGRAMS) if snippets else "''"
+            return self.db.execute(
+                f"""
+                SELECT rowid, title, rank, {snippet}
+                FROM {table} WHERE {table} MATCH ?
+                ORDER BY rank LIMIT ? OFFSET ?
+                """,
+                (phrase, *params),
+            )
+        pattern = "%" + re.sub(r"([\\%_])", r"\\\1", text) + "%"
+        return self.db.execute(
+            f"""
+            SELECT rowid, title, 0.0, '' FROM {table}
+            WHERE body LIKE ? ESCAPE '\\'
+            ORDER BY title LIMIT ? OFFSET ?
+            """,
+            (pattern, *params),
+        )
+
+    def iter_search(
+        self, query: str, limit: int = -1, offset: int = 0, mode: str = "fts"
+    ) -> Iterator[SearchResult]:
+        """
+        Streams search results best first, straight off the cursor.
+
+        An empty query lists every indexed file by path. An invalid query
+        yields nothing.
+
+        Args:
+            query (str): An FTS5 query.
+            limit (int): The maximum number of results, -1 for no limit.
+            offset (int): The number of results to skip.
+            mode (str): How to interpret `query`, one of:
+                "fts": an FTS5 query, whose column filters may use
+                    `FIELD_ALIASES`, e.g. `tag:foo`.
+                "prefix": text being typed, see `prefix_query`.
+                "substring": text to find anywhere in a note, a `GLOB`
+                    pattern if it contains wildcards, see `substring_cursor`.
+
+        Yields:
+            SearchResult: The path, bm25 rank and snippet of each match.
+        """
+        for _, result in self.iter_rows(query, limit, offset, mode):
+            yield result
+
+    def search(
+        self,
+        query: str,
+        limit: int = SEARCH_PAGE_SIZE,
+        offset: int = 0,
+        mode: str = "fts",
+        snippets: bool = True,
+    ) -> List[SearchResult]:
         """
         Searches the FTS database for the given query.
 
+        Results are cached until the index changes. A prefix query that
+        extends one that found nothing, e.g. "xyzw" after "xyz", isn't run.
+
         Args:
             query (str): The search query.
+            limit (int): The page size, -1 for every result.
+            offset (int): The number of results to skip, i.e. the page start.
+            mode (str): How to interpret `query`, see `iter_search`.
+            snippets (bool): Compute each result's snippet. A snippet reads
+                and tokenizes the whole note, a palette can leave them out
+                and fetch those it shows with `snippets`.
 
         Returns:
-            List[tuple]: A list of tuples containing the title and body of matching documents.
+            List[SearchResult]: One page of results, best first.
         """
+        self.cache.validate(self.generation)
+        key = (query, mode, limit, offset, snippets)
+        rows = self.cache.get(key)
+        if rows is None:
+            if mode == "prefix" and offset == 0 and self.cache.excludes(query):
+                rows = []
+            else:
+                rows = list(self.iter_rows(query, limit, offset, mode, snippets))
+            self.cache.put(key, rows)
+        return [result for _, result in rows]
 
-        def get_all_files() -> sqlite3.Cursor:
-            return self.db.execute("SELECT title FROM fts")
+    def snippets(
+        self, query: str, mode: str, results: List[SearchResult]
+    ) -> List[SearchResult]:
+        """
+        Fills in the snippets of results found with `snippets=False`.
 
-        if query.strip() == "":
-            # Return all documents if the query is empty
-            cursor = get_all_files()
-        else:
-            try:
-                cursor = self.db.execute(
-                    "SELECT title FROM fts WHERE fts MATCH ?", (query,)
+        Args:
+            query (str): The text searched for.
+            mode (str): How it was searched, see `iter_search`.
+            results (List[SearchResult]): Results of that search, e.g. the
+                rows a palette shows.
+
+        Returns:
+            List[SearchResult]: The results in the same order, with snippets
+                where the search has them.
+        """
+        source = snippet_source(query, mode, self.trigram)
+        if source is None or not results:
+            return results
+        table, match, tokens = source
+        paths = [result.path for result in results]
+        try:
+            cursor = self.db.execute(
+                f"""
+                SELECT title, {snippet_column(table, tokens)}
+                FROM {table} WHERE {table} MATCH ? AND rowid IN (
+                    SELECT id FROM files
+                    WHERE path IN (SELECT value FROM json_each(?))
                 )
-            except sqlite3.OperationalError as e:
-                # If the query is invalid, return all documents
-                cursor = get_all_files()
-                print(f"Invalid query: {e}", file=sys.stderr)
-            except Exception as e:
-                # Log the error or handle it accordingly
-                print(f"Error searching for '{query}': {e}", file=sys.stderr)
-                cursor = get_all_files()
-
-        results = cursor.fetchall()
-        # Get only the filenames
-        return [filepath for filepath, in results]
+                """,
+                (match, json.dumps(paths)),
+            )
+            found = {path: parse_highlight(snippet) for path, snippet in cursor}
+        except sqlite3.OperationalError as e:
+            if str(e) == "interrupted":
+                raise
+            print(f"Invalid query: {e}", file=sys.stderr)
+            return results
+        filled = []
+        for result in results:
+            if result.path in found:
+                snippet, matches = found[result.path]
+                result = result._replace(snippet=snippet, matches=matches)
+            filled.append(result)
+        return filled
+
+    def relative_path(self, path: str) -> str:
+        """
+        Converts an absolute path, or one relative to the working directory,
+        into the form stored in the index.
+        """
+        return os.path.relpath(os.path.abspath(path), self.current_dir)
+
+    def read_documents(
+        self, paths: Optional[List[str]] = None
+    ) -> List[Tuple[str, str, str]]:
+        """
+        Reads stored notes back for indexes derived from this one.
+
+        Args:
+            paths (Optional[List[str]]): The notes to read, every note if None.
+
+        Returns:
+            List[Tuple[str, str, str]]: The path, hash and body of each note.
+        """
+        query = """
+            SELECT files.path, files.hash, documents.body
+            FROM documents JOIN files ON files.id = documents.id
+        """
+        if paths is None:
+            return self.db.execute(query).fetchall()
+        return self.db.execute(
+            query + " WHERE files.path IN (SELECT value FROM json_each(?))",
+            (json.dumps(paths),),
+        ).fetchall()
+
+    def manifest_hashes(self) -> Dict[str, str]:
+        """
+        The hash of every indexed note by path, to find what derived indexes
+        need to update.
+        """
+        return dict(self.db.execute("SELECT path, hash FROM files"))
+
+    def outgoing_links(self, path: str) -> List[Link]:
+        """
+        Lists the links in a note, including those to missing files.
+
+        Args:
+            path (str): The note, see `relative_path`.
+        """
+        path = self.relative_path(path)
+        cursor = self.db.execute(
+            """
+            SELECT files.path, links.target, links.kind
+            FROM files JOIN links ON links.source = files.id
+            WHERE files.path = ? ORDER BY links.rowid
+            """,
+            (path,),
+        )
+        return [Link(*row) for row in cursor]
+
+    def backlinks(self, path: str) -> List[Link]:
+        """
+        Lists the links to a note from every other note in the index.
+
+        Args:
+            path (str): The note, see `relative_path`.
+        """
+        path = self.relative_path(path)
+        cursor = self.db.execute(
+            """
+            SELECT files.path, links.target, links.kind
+            FROM links JOIN files ON files.id = links.source
+            WHERE links.target = ? ORDER BY files.path
+            """,
+            (path,),
+        )
+        return [Link(*row) for row in cursor]
+
+    def orphans(self) -> List[str]:
+        """
+        Lists the notes that neither link to nor are linked from another note.
+        """
+        cursor = self.db.execute(
+            """
+            SELECT path FROM files
+            WHERE NOT EXISTS (
+                SELECT 1 FROM links WHERE links.source = files.id
+                    AND links.target != files.path
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM links WHERE links.target = files.path
+                    AND links.source != files.id
+            )
+            ORDER BY path
+            """
+        )
+        return [path for (path,) in cursor]
+
+
+class SearchService:
+    """
+    Keeps FTS connections open per indexed directory and thread.
+
+    Owned by the main window and shared by the palettes, so that a keystroke
+    only costs the query itself rather than hashing the directory and opening
+    a new connection. SQLite connections can't be shared between threads, so
+    each thread searching a directory, e.g. the palette worker, gets its own.
+    """
+
+    def __init__(self, allowed_extensions: Optional[List[str]] = None):
+        self.allowed_extensions = allowed_extensions or [".md"]
+        self.indexes: Dict[Tuple[str, int], FTS] = {}
+        # Workspaces by their roots and thread, see `search_workspace`
+        self.workspaces: Dict[Tuple[Tuple[str, ...], int], "Workspace"] = {}
+        self.lock = threading.Lock()
+
+    def get(self, directory: Optional[str] = None) -> FTS:
+        """
+        Returns the calling thread's index for a directory, opening it on first use.
+
+        Args:
+            directory (Optional[str]): Defaults to the current working directory.
+        """
+        key = (directory or os.getcwd(), threading.get_ident())
+        with self.lock:
+            fts = self.indexes.get(key)
+            if fts is None:
+                fts = FTS(self.allowed_extensions, key[0])
+                self.indexes[key] = fts
+        return fts
+
+    def search(
+        self,
+        query: str,
+        directory: Optional[str] = None,
+        limit: int = SEARCH_PAGE_SIZE,
+        offset: int = 0,
+        mode: str = "prefix",
+        snippets: bool = True,
+    ) -> List[SearchResult]:
+        """
+        Searches the index of a directory as the user types, see `FTS.search`.
+        """
+        return self.get(directory).search(query, limit, offset, mode, snippets)
+
+    def get_workspace(self, roots: List[str]) -> "Workspace":
+        """
+        Returns the calling thread's workspace over several directories,
+        attaching their indexes on first use.
+        """
+        from workspace import Workspace
+
+        key = (tuple(roots), threading.get_ident())
+        with self.lock:
+            workspace = self.workspaces.get(key)
+        if workspace is None:
+            # Attaching reads every index, don't hold the lock
+            workspace = Workspace(roots)
+            with self.lock:
+                self.workspaces[key] = workspace
+        return workspace
+
+    def search_workspace(
+        self,
+        query: str,
+        roots: List[str],
+        limit: int = SEARCH_PAGE_SIZE,
+        offset: int = 0,
+        mode: str = "prefix",
+        snippets: bool = True,
+    ) -> List[SearchResult]:
+        """
+        Searches the indexes of several directories as one, see `Workspace.search`.
+        """
+        if len(roots) == 1:
+            return self.search(query, roots[0], limit, offset, mode, snippets)
+        return self.get_workspace(roots).search(query, limit, offset, mode, snippets)
+
+    def snippets(
+        self, query: str, roots: List[str], results: List[SearchResult], mode: str
+    ) -> List[SearchResult]:
+        """
+        Fills in the snippets of results from `search_workspace`, see `FTS.snippets`.
+        """
+        if len(roots) == 1:
+            return self.get(roots[0]).snippets(query, mode, results)
+        return self.get_workspace(roots).snippets(query, mode, results)
+
+    def interrupt(self, thread_id: int) -> None:
+        """
+        Aborts whatever a thread's connections are running, which then raise
+        `sqlite3.OperationalError("interrupted")`.
+
+        Args:
+            thread_id (int): The `threading.get_ident` of the searching thread.
+        """
+        with self.lock:
+            for (_, owner), fts in self.indexes.items():
+                if owner == thread_id:
+                    fts.db.interrupt()
+            for (_, owner), workspace in self.workspaces.items():
+                if owner == thread_id:
+                    workspace.db.interrupt()
+
+    def close(self, directory: Optional[str] = None) -> None:
+        """
+        Closes every connection to a directory, e.g. before removing its database.
+        """
+        directory = directory or os.getcwd()
+        with self.lock:
+            keys = [key for key in self.indexes if key[0] == directory]
+            for key in keys:
+                self.indexes.pop(key).close()
+            # Workspaces attach the database too
+            keys = [key for key in self.workspaces if directory in key[0]]
+            for key in keys:
+                self.workspaces.pop(key).close()
+
+    def close_all(self) -> None:
+        """
+        Closes every open connection.
+        """
+        with self.lock:
+            for fts in self.indexes.values():
+                fts.close()
+            self.indexes.clear()
+            for workspace in self.workspaces.values():
+                workspace.close()
+            self.workspaces.clear()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Index a directory of notes")
+    parser.add_argument("directory", nargs="?", default=os.getcwd())
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of processes used to read files (defaults to the CPU count)",
+    )
+    args = parser.parse_args()
+    with FTS([".md"], os.path.abspath(args.directory)) as fts:
+        fts.index_current_dir(jobs=args.jobs)
@@ -0,0 +1,201 @@
+import os
+import sqlite3
+import sys
+import threading
+from typing import Optional, Set
+
+from PyQt6.QtCore import QFileSystemWatcher, QObject, QThread, QTimer, pyqtSignal
+
+from filetree import file_tree
+from fts import FTS, IndexCancelled, SearchService
+
+
+class IndexWorker(QThread):
+    """
+    Indexes a directory on a background thread.
+
+    The worker opens its own database connection, searches on the GUI thread
+    keep reading the previous index until the build commits.
+
+    Signals:
+        progress(int, int): Files processed so far and the total.
+        finished_indexing(str): The summary of a completed build.
+        cancelled(): The build was cancelled and rolled back.
+        failed(str): The build raised an error.
+    """
+
+    progress = pyqtSignal(int, int)
+    finished_indexing = pyqtSignal(str)
+    cancelled = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(
+        self,
+        directory: str,
+        jobs: Optional[int] = None,
+        quiet: bool = False,
+        parent=None,
+    ):
+        super().__init__(parent)
+        self.directory = directory
+        self.jobs = jobs
+        self.quiet = quiet
+        self._cancel = threading.Event()
+
+    def run(self):
+        try:
+            with FTS([".md"], self.directory) as fts:
+                summary = fts.index_current_dir(
+                    jobs=self.jobs,
+                    progress=self.progress.emit,
+                    cancel=self._cancel,
+                    quiet=self.quiet,
+                )
+        except IndexCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.finished_indexing.emit(summary)
+
+    def cancel(self):
+        """
+        Asks the build to stop, it is rolled back at the next file.
+        """
+        self._cancel.set()
+
+
+class IndexWatcher(QObject):
+    """
+    Keeps the index of a directory current as files change.
+
+    Directories are watched with QFileSystemWatcher, bursts of change events
+    are coalesced and applied as targeted updates through the search
+    service's connection. A periodic rescan catches in-place edits by
+    external tools, which don't touch the directory, and stands in for the
+    watcher where the OS refuses more watches.
+
+    Signals:
+        rescan_requested(): Emitted by the poll timer, the owner should run
+            an incremental index in the background.
+        index_updated(): Pending changes were written to the index.
+    """
+
+    rescan_requested = pyqtSignal()
+    index_updated = pyqtSignal()
+
+    def __init__(
+        self,
+        search_service: SearchService,
+        coalesce_ms: int = 300,
+        poll_interval_ms: int = 30000,
+        parent=None,
+    ):
+        super().__init__(parent)
+        self.search_service = search_service
+        self.root: Optional[str] = None
+        self.pending_dirs: Set[str] = set()
+        self.pending_files: Set[str] = set()
+        self.paused = False
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.directory_changed)
+
+        self.coalesce_timer = QTimer(self)
+        self.coalesce_timer.setSingleShot(True)
+        self.coalesce_timer.setInterval(coalesce_ms)
+        self.coalesce_timer.timeout.connect(self.flush)
+
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setInterval(poll_interval_ms)
+        self.poll_timer.timeout.connect(self.rescan_requested.emit)
+
+    def set_root(self, directory: str):
+        """
+        Starts watching a directory tree, dropping any previous one.
+        """
+        self.stop()
+        self.root = directory
+        self.watch_tree(directory)
+        if self.poll_timer.interval() > 0:
+            self.poll_timer.start()
+
+    def stop(self):
+        """
+        Stops watching, e.g. when the index is removed.
+        """
+        self.root = None
+        self.pending_dirs.clear()
+        self.pending_files.clear()
+        watched = self.watcher.directories()
+        if watched:
+            self.watcher.removePaths(watched)
+        self.coalesce_timer.stop()
+        self.poll_timer.stop()
+
+    def watch_tree(self, directory: str):
+        """
+        Watches a directory and every directory beneath it that isn't ignored.
+        """
+        directories = file_tree(self.root).directories(
+            os.path.relpath(directory, self.root)
+        )
+        watched = set(self.watcher.directories())
+        directories = [d for d in directories if d not in watched]
+        if not directories:
+            return
+        failed = self.watcher.addPaths(directories)
+        if failed:
+            print(
+                f"Unable to watch {len(failed)} directories, relying on polling",
+                file=sys.stderr,
+            )
+
+    def directory_changed(self, directory: str):
+        self.pending_dirs.add(directory)
+        self.coalesce_timer.start()
+
+    def file_saved(self, file_path: str):
+        """
+        Updates the index for a file written by the editor, right away.
+
+        Before a root is watched, e.g. right after launch in a directory that
+        hasn't been indexed, the file goes to the current directory's index.
+        """
+        self.pending_files.add(os.path.abspath(file_path))
+        self.flush()
+
+    def pause(self):
+        """
+        Defers updates, e.g. while a full index build holds the write lock.
+        """
+        self.paused = True
+
+    def resume(self):
+        """
+        Applies the updates deferred by `pause`.
+        """
+        self.paused = False
+        self.flush()
+
+    def flush(self):
+        if self.paused or not (self.pending_dirs or self.pending_files):
+            return
+        directories, self.pending_dirs = self.pending_dirs, set()
+        files, self.pending_files = self.pending_files, set()
+        fts = self.search_service.get(self.root or os.getcwd())
+        try:
+            for directory in sorted(directories):
+                fts.update_directory(directory)
+                if os.path.isdir(directory):
+                    # Pick up directories created since the last change
+                    self.watch_tree(directory)
+            fts.update_files(sorted(files))
+        except sqlite3.OperationalError as e:
+            # Another connection holds the write lock, try again shortly
+            print(f"Deferring index update: {e}", file=sys.stderr)
+            self.pending_dirs |= directories
+            self.pending_files |= files
+            self.coalesce_timer.start()
+        else:
+            self.index_updated.emit()
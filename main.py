@@ -1,5 +1,11 @@
 from enum import Enum
-from fts import FTS
+from fts import FTS, SearchService
+from indexing import IndexWatcher, IndexWorker
+from embeddings import embedding_dir
+from semantic import semantic_dir
+from workspace import workspace_roots
+from asset_scheme import install_asset_scheme, register_scheme
+from preview import PreviewRenderer, RenderScheduler
 from utils import popup_notification
 from editor_highlighting_regex import MarkdownHighlighter
 import markdown
@@ -7,7 +13,10 @@ import os
 from palette import (
     CommandPalette,
     InsertLinkPalette,
+    LinkGraphPalette,
     OpenFilePalette,
+    PaletteWorker,
+    RelatedNotesPalette,
     SearchFilePalette,
 )
 from typing import Callable
@@ -25,6 +34,7 @@ import markdown
 from pathlib import Path
 from config import Config  # Import Config class
 import sys
+import shutil
 import argparse
 from PyQt6.QtWidgets import (
     QApplication,
@@ -39,6 +49,9 @@ from PyQt6.QtWidgets import (
     QMessageBox,
     QTabWidget,
     QLabel,
+    QDockWidget,
+    QListWidget,
+    QListWidgetItem,
 )
 from PyQt6.QtCore import Qt, pyqtSignal, QRegularExpression, QFile, QTextStream, QTimer
 from PyQt6.QtGui import (
@@ -97,9 +110,13 @@ class MarkdownEditor(QWidget):
         local_katex=True,
         allow_remote_content=True,
         open_file_callback=None,  # Add this parameter
+        renderer: PreviewRenderer | None = None,
     ):
         super().__init__()
         self.config = config
+        # Builds the preview off the GUI thread, None renders in place
+        self.renderer = renderer
+        self.preview_revision = 0
         self.css_dir = css_dir
         self.dark_mode = False
         self.preview_visible = True
@@ -176,8 +193,16 @@ class MarkdownEditor(QWidget):
         # Apply syntax highlighting to the editor
         self.highlighter = MarkdownHighlighter(self.editor.document())
 
-        # Connect the Editor with the Preview
-        self.editor.textChanged.connect(self.update_preview)
+        # Connect the Editor with the Preview, a burst of edits renders once
+        self.render_scheduler = RenderScheduler(
+            debounce_ms=self.config.config.get("preview_debounce_ms", 150),
+            max_latency_ms=self.config.config.get("preview_max_latency_ms", 500),
+            parent=self,
+        )
+        self.render_scheduler.render_requested.connect(self.update_preview)
+        self.editor.textChanged.connect(self.render_scheduler.schedule)
+        if self.renderer is not None:
+            self.renderer.rendered.connect(self.apply_preview)
 
         # Set initial content for the preview
         self.update_preview()
@@ -212,14 +237,31 @@ class MarkdownEditor(QWidget):
 
     def update_preview(self):
         """Update the Markdown preview."""
+        # This render includes any edits still waiting to be rendered
+        self.render_scheduler.cancel()
         if self.preview_visible or self.preview_overlay:
             text = self.editor.toPlainText()
+            if self.renderer is not None:
+                self.preview_revision = self.renderer.submit(
+                    id(self),
+                    text,
+                    css_path=self.css_dir,
+                    dark_mode=self.dark_mode,
+                    local_katex=self.local_katex,
+                )
+                return
             markdown_content = Markdown(
                 text=text, css_path=self.css_dir, dark_mode=self.dark_mode
             )
             html = markdown_content.build_html(local_katex=self.local_katex)
             self.preview.setHtml(html)
 
+    def apply_preview(self, revision: int, html: str):
+        """Show a page from the renderer unless a newer one was requested."""
+        # Pages for the other tabs, and any that went stale, are ignored
+        if revision == self.preview_revision:
+            self.preview.setHtml(html)
+
     def toggle_math_popups(self):
         self.math_popups.toggle()
 
@@ -242,6 +284,42 @@ class Icon(Enum):
     NEXT_TAB = "icons/arrow.png"
     DARK_MODE = "icons/light-bulb.png"
     PALETTE = "icons/keyboard.png"
+    BACKLINKS = "icons/chain--arrow.png"
+    ORPHANS = "icons/chain-unchain.png"
+
+
+class BacklinksPanel(QDockWidget):
+    """Lists the notes linking to the current note, read from the index."""
+
+    def __init__(self, search_service: SearchService, open_file_callback, parent=None):
+        super().__init__("Backlinks", parent)
+        self.search_service = search_service
+        self.open_file_callback = open_file_callback
+        self.file_path = None
+
+        self.list_widget = QListWidget()
+        self.list_widget.itemActivated.connect(self.open_item)
+        self.setWidget(self.list_widget)
+
+    def refresh(self, file_path=None):
+        if file_path is not None:
+            self.file_path = file_path
+        self.list_widget.clear()
+        if not self.file_path or not self.isVisible():
+            return
+        for link in self.search_service.get().backlinks(self.file_path):
+            item = QListWidgetItem(f"{link.source} ({link.kind})")
+            item.setData(Qt.ItemDataRole.UserRole, link.source)
+            self.list_widget.addItem(item)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+
+    def open_item(self, item):
+        file_path = item.data(Qt.ItemDataRole.UserRole)
+        if file_path and os.path.isfile(file_path):
+            self.open_file_callback(file_path)
 
 
 class MainWindow(QMainWindow):
@@ -267,6 +345,37 @@ class MainWindow(QMainWindow):
         self.local_katex = not remote_katex
         self.allow_remote_content = not disable_remote_content
 
+        # Long-lived FTS connections shared by the palettes
+        self.search_service = SearchService([".md"])
+
+        # Palettes filter and search on this thread, keeping typing responsive
+        self.palette_worker = PaletteWorker(self.search_service, parent=self)
+        self.palette_worker.start()
+
+        # Renders the previews of every tab, keeping typing responsive
+        self.preview_renderer = PreviewRenderer(parent=self)
+        self.preview_renderer.start()
+
+        # Applies edits to the index of the current directory as they happen
+        self.index_watcher = IndexWatcher(
+            self.search_service,
+            poll_interval_ms=self.config.config.get("index_poll_interval", 30000),
+            parent=self,
+        )
+        self.index_watcher.rescan_requested.connect(
+            lambda: self.index_current_dir(quiet=True)
+        )
+
+        # Notes linking to the current one, kept current as the index changes
+        self.backlinks_panel = BacklinksPanel(
+            self.search_service, self.open_file, parent=self
+        )
+        self.addDockWidget(Qt.DockWidgetArea.RightDockWidgetArea, self.backlinks_panel)
+        self.backlinks_panel.hide()
+        self.index_watcher.index_updated.connect(self.backlinks_panel.refresh)
+        # A save can be the first file indexed, start watching from there
+        self.index_watcher.index_updated.connect(self.watch_current_dir)
+
         # Create the first tab
         self.new_tab()
 
@@ -286,8 +395,20 @@ class MainWindow(QMainWindow):
         self.autorevert_enabled = False
         self.autorevert_action = None  # We'll set this in create_toolbar
 
+        # Background indexing, see index_current_dir
+        self.index_worker = None
+        # Workspace roots still to index and those that failed, see index_workspace
+        self.index_queue = []
+        self.index_failures = []
+
         # Connect tab change signal
         self.tab_widget.currentChanged.connect(self.update_current_tab_actions)
+        self.tab_widget.currentChanged.connect(
+            lambda: self.backlinks_panel.refresh(self.current_file())
+        )
+
+        # Keep the index of the working directory current, `--dir` moves it
+        self.watch_current_dir()
 
     def open_new_window(self):
         new_window = MainWindow()
@@ -300,6 +421,18 @@ class MainWindow(QMainWindow):
             cursor.insertText(text)
             current_editor.editor.setTextCursor(cursor)
 
+    def current_file(self):
+        current_editor = self.tab_widget.currentWidget()
+        if current_editor:
+            return current_editor.current_file
+        return None
+
+    def current_text(self):
+        current_editor = self.tab_widget.currentWidget()
+        if current_editor:
+            return current_editor.editor.toPlainText()
+        return ""
+
     # TODO Remove this?
     def update_current_tab_actions(self):
         current_editor = self.tab_widget.currentWidget()
@@ -324,6 +457,7 @@ class MainWindow(QMainWindow):
         current_tab = self.tab_widget.currentWidget()
         if current_tab:
             self.tab_widget.removeTab(self.tab_widget.currentIndex())
+            self.preview_renderer.discard(id(current_tab))
             current_tab.deleteLater()
 
     def new_tab(self):
@@ -336,6 +470,7 @@ class MainWindow(QMainWindow):
             local_katex=self.local_katex,
             allow_remote_content=self.allow_remote_content,
             open_file_callback=self.open_file,  # Pass the open_file method as a callback
+            renderer=self.preview_renderer,
         )
 
         # Add the new MarkdownEditor to a new tab
@@ -384,6 +519,7 @@ class MainWindow(QMainWindow):
 
                 if focus_tab:
                     self.tab_widget.setCurrentWidget(current_editor)
+                self.backlinks_panel.refresh(self.current_file())
 
             except Exception as e:
                 QMessageBox.warning(self, "Error", f"Failed to open file: {str(e)}")
@@ -408,6 +544,17 @@ class MainWindow(QMainWindow):
             editor.update_preview()
 
         self.files_palette.clear_items()
+        self.watch_current_dir()
+
+    def watch_current_dir(self):
+        # Only directories that have been indexed are kept up to date
+        if not self.config.config.get("index_watch", True):
+            return
+        current_dir = os.getcwd()
+        if self.search_service.get(current_dir).is_empty():
+            self.index_watcher.stop()
+        elif self.index_watcher.root != current_dir:
+            self.index_watcher.set_root(current_dir)
 
     def toggle_autorevert(self):
         self.autorevert_enabled = not self.autorevert_enabled
@@ -442,6 +589,8 @@ class MainWindow(QMainWindow):
 
         with open(current_editor.current_file, "w", encoding="utf-8") as file:
             file.write(current_editor.editor.toPlainText())
+        if self.config.config.get("index_watch", True):
+            self.index_watcher.file_saved(current_editor.current_file)
 
         self.tab_widget.setTabText(
             self.tab_widget.currentIndex(),
@@ -488,14 +637,104 @@ class MainWindow(QMainWindow):
             print("No file to autosave")
 
     def reset_search_index(self):
+        if self.index_worker and self.index_worker.isRunning():
+            self.statusBar().showMessage("Cannot reset the index while indexing")
+            return
         current_dir = os.getcwd()
+        self.index_watcher.stop()
+        self.search_service.close(current_dir)
         with FTS([".md"], current_dir) as fts:
             fts.remove_database()
+            shutil.rmtree(semantic_dir(fts.db_path), ignore_errors=True)
+            shutil.rmtree(embedding_dir(fts.db_path), ignore_errors=True)
 
-    def index_current_dir(self):
-        current_dir = os.getcwd()
-        with FTS([".md"], current_dir) as fts:
-            fts.index_current_dir()
+    def index_current_dir(self, quiet: bool = False, directory=None):
+        if self.index_worker and self.index_worker.isRunning():
+            if not quiet:
+                self.statusBar().showMessage("Already indexing")
+            return
+        current_dir = directory or os.getcwd()
+        self.index_worker = IndexWorker(
+            current_dir,
+            jobs=self.config.config.get("index_jobs"),
+            quiet=quiet,
+            parent=self,
+        )
+        # Targeted updates would contend with the build for the write lock
+        self.index_watcher.pause()
+        self.index_worker.finished.connect(self.index_watcher.resume)
+        # Each rescan makes a new worker, free this one once it is done
+        worker = self.index_worker
+        self.index_worker.finished.connect(lambda: self.release_index_worker(worker))
+        self.index_worker.finished_indexing.connect(self.watch_current_dir)
+        self.index_worker.finished_indexing.connect(
+            lambda: self.backlinks_panel.refresh()
+        )
+        self.index_worker.failed.connect(
+            lambda error: self.statusBar().showMessage(
+                f"Indexing {current_dir} failed: {error}"
+            )
+        )
+        if quiet:
+            self.index_worker.start()
+            return
+        self.index_worker.progress.connect(
+            lambda done, total: self.statusBar().showMessage(
+                f"Indexing {current_dir}: {done}/{total} files"
+            )
+        )
+        self.index_worker.finished_indexing.connect(self.statusBar().showMessage)
+        self.index_worker.cancelled.connect(
+            lambda: self.statusBar().showMessage("Indexing cancelled")
+        )
+        self.statusBar().showMessage(f"Indexing {current_dir}...")
+        self.index_worker.start()
+
+    def release_index_worker(self, worker: IndexWorker):
+        if self.index_worker is worker:
+            self.index_worker = None
+        worker.deleteLater()
+
+    def index_workspace(self):
+        # Each root has its own database, built one after another
+        if self.index_worker and self.index_worker.isRunning():
+            self.statusBar().showMessage("Already indexing")
+            return
+        self.index_queue = workspace_roots()
+        self.index_failures = []
+        self.index_next_root()
+
+    def index_next_root(self):
+        if not self.index_queue:
+            if self.index_failures:
+                self.statusBar().showMessage(
+                    f"Indexing failed for {', '.join(self.index_failures)}"
+                )
+            return
+        root = self.index_queue.pop(0)
+        self.index_current_dir(directory=root)
+        worker = self.index_worker
+        worker.failed.connect(lambda _: self.index_failures.append(root))
+        # Move on however this root ended, after the worker is released
+        worker.finished.connect(self.index_next_root)
+
+    def cancel_indexing(self):
+        self.index_queue = []
+        if self.index_worker and self.index_worker.isRunning():
+            self.index_worker.cancel()
+
+    def closeEvent(self, event):
+        # Don't destroy the indexing thread while it is still running
+        self.index_queue = []
+        if self.index_worker and self.index_worker.isRunning():
+            self.index_worker.cancel()
+            self.index_worker.wait()
+        self.palette_worker.stop()
+        self.palette_worker.wait()
+        self.preview_renderer.stop()
+        self.preview_renderer.wait()
+        self.search_service.close_all()
+        super().closeEvent(event)
 
     def create_toolbar(self):
         # Create a Toolbar
@@ -592,9 +831,23 @@ class MainWindow(QMainWindow):
                     Icon.SEARCH.value,
                     "Index Current Directory",
                     "Index all files in the current directory",
-                    self.index_current_dir,
+                    lambda: self.index_current_dir(),
                     "Ctrl+I",
                 ),
+                "Index Workspace": self.build_action(
+                    Icon.SEARCH.value,
+                    "Index Workspace",
+                    "Index the current directory and the workspace_roots",
+                    self.index_workspace,
+                    None,
+                ),
+                "Cancel Indexing": self.build_action(
+                    Icon.SEARCH_REMOVE.value,
+                    "Cancel Indexing",
+                    "Stop indexing the current directory",
+                    self.cancel_indexing,
+                    None,
+                ),
                 "Reset Search Index": self.build_action(
                     Icon.SEARCH_REMOVE.value,
                     "Reset Search Index",
@@ -609,6 +862,34 @@ class MainWindow(QMainWindow):
                     self.open_search_palette,
                     "Ctrl+F",
                 ),
+                "Backlinks": self.build_action(
+                    Icon.BACKLINKS.value,
+                    "Backlinks",
+                    "List the notes linking to the current note",
+                    self.open_backlinks_palette,
+                    "Ctrl+Shift+B",
+                ),
+                "Outgoing Links": self.build_action(
+                    Icon.LINK.value,
+                    "Outgoing Links",
+                    "List the notes the current note links to",
+                    self.open_outgoing_links_palette,
+                    None,
+                ),
+                "Related Notes": self.build_action(
+                    Icon.SEARCH.value,
+                    "Related Notes",
+                    "List the notes most similar to the current buffer",
+                    self.open_related_notes_palette,
+                    "Ctrl+Shift+F",
+                ),
+                "Orphaned Notes": self.build_action(
+                    Icon.ORPHANS.value,
+                    "Orphaned Notes",
+                    "List the notes without links to or from other notes",
+                    self.open_orphans_palette,
+                    None,
+                ),
             },
             "View": {
                 "darkmode": self.build_action(
@@ -647,6 +928,13 @@ class MainWindow(QMainWindow):
                     self.open_files_palette,
                     "Ctrl+P",
                 ),
+                "Backlinks Panel": self.build_action(
+                    Icon.BACKLINKS.value,
+                    "Toggle Backlinks Panel",
+                    "Show the notes linking to the current note",
+                    self.toggle_backlinks_panel,
+                    "Ctrl+B",
+                ),
                 "Toggle Math Popups": self.build_action(
                     Icon.PREVIEW.value,  # You may want to use a different icon
                     "Toggle Math Popups",
@@ -713,7 +1001,13 @@ class MainWindow(QMainWindow):
         self.command_palette = CommandPalette(self.actions)
         self.link_palette = InsertLinkPalette(self)
         self.files_palette = OpenFilePalette(self)
-        self.search_palette = SearchFilePalette(self)
+        self.search_palette = SearchFilePalette(self, self.search_service)
+        self.backlinks_palette = LinkGraphPalette(self, self.search_service)
+        self.outgoing_links_palette = LinkGraphPalette(
+            self, self.search_service, "outgoing"
+        )
+        self.orphans_palette = LinkGraphPalette(self, self.search_service, "orphans")
+        self.related_notes_palette = RelatedNotesPalette(self, self.search_service)
 
     def collect_actions_from_menu(self, menu_dict):
         actions = []
@@ -808,6 +1102,21 @@ class MainWindow(QMainWindow):
     def open_link_palette(self):
         self.link_palette.open()
 
+    def open_backlinks_palette(self):
+        self.backlinks_palette.open()
+
+    def open_outgoing_links_palette(self):
+        self.outgoing_links_palette.open()
+
+    def open_orphans_palette(self):
+        self.orphans_palette.open()
+
+    def open_related_notes_palette(self):
+        self.related_notes_palette.open()
+
+    def toggle_backlinks_panel(self):
+        self.backlinks_panel.setVisible(not self.backlinks_panel.isVisible())
+
     def open_files_palette(self):
         self.files_palette.open()
 
@@ -885,7 +1194,14 @@ def main():
     parser.add_argument(
         "--autosave", action="store_true", help="Start with autosave enabled"
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=config.config.get("index_jobs", None),
+        help="Number of processes used to read files when indexing",
+    )
     args = parser.parse_args()
+    config.config["index_jobs"] = args.jobs
 
     # Ensure CSS path is resolved
     if args.css:
@@ -893,7 +1209,10 @@ def main():
     else:
         args.css = Path(config.config.get("css_path")).resolve()
 
+    # Custom schemes must be known before the web engine starts
+    register_scheme()
     app = QApplication(sys.argv)
+    install_asset_scheme(args.css)
     window = MainWindow(args.css,  config, args.remote_katex, args.disable_remote_content)
 
     if args.input_files:
@@ -28,8 +28,14 @@ class IncludeFilePreprocessor(Preprocessor):
                         file_content = f.read()
 
                     # Create a new Markdown instance and parse the included file's content
-                    included_md = markdown.Markdown(extensions=self.md.registeredExtensions)
-                    print(file_content)
+                    # with copies of the extensions, extendMarkdown would otherwise bind
+                    # the outer converter's to it and break reusing that converter
+                    included_md = markdown.Markdown(
+                        extensions=[
+                            type(extension)(**extension.getConfigs())
+                            for extension in self.md.registeredExtensions
+                        ]
+                    )
                     included_html = included_md.convert(file_content)
 
                     # Add the parsed HTML to new_lines
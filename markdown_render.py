@@ -0,0 +1,408 @@
+"""
+Markdown to HTML rendering without any Qt dependency.
+
+Used by the preview (through `markdown_utils`, which re-exports it) and by
+the headless command line interface in `cli.py`.
+"""
+
+import os
+import subprocess
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import markdown
+import markdown_gfm_admonition
+from markdown.extensions.wikilinks import WikiLinkExtension
+from pygments.formatters import HtmlFormatter
+
+from markdown_extension_image_size_and_caption import ImageWithFigureExtension
+from markdown_extension_transclusion import IncludeFileExtension
+from regex_patterns import INLINE_MATH_PATTERN, BLOCK_MATH_PATTERN
+
+
+KATEX_DIR = Path(__file__).resolve().parent / "assets/node_modules/katex/dist"
+
+# Pages built in the editor reference these directories by URL, served by
+# `asset_scheme.AssetSchemeHandler`, rather than inlining their files. Empty
+# elsewhere, e.g. in the command line interface, where pages stand alone.
+ASSET_URL = "draftsmith://assets/"
+ASSET_DIRECTORIES: Dict[str, Path] = {}
+
+
+def asset_url(path: Path) -> Optional[str]:
+    """
+    The URL a file is served at, None if it isn't in a served directory.
+
+    The URL carries the file's mtime, so it changes whenever the file does
+    and the engine can cache each version indefinitely.
+    """
+    path = path.resolve()
+    for name, directory in ASSET_DIRECTORIES.items():
+        try:
+            relative = path.relative_to(directory)
+            version = path.stat().st_mtime_ns
+        except (ValueError, OSError):
+            continue
+        return f"{ASSET_URL}{name}/{relative.as_posix()}?v={version}"
+    return None
+
+
+EXTENSION_CONFIGS = {
+    "codehilite": {
+        "css_class": "highlight",
+        "linenums": False,
+        "guess_lang": False,
+    }
+}
+
+
+def extensions(base_path: str) -> list:
+    """
+    The extensions of the preview, in registration order.
+
+    Args:
+        base_path (str): The directory transclusions and wikilinks resolve
+            against.
+    """
+    return [
+        IncludeFileExtension(base_path=base_path),
+        "attr_list",
+        ImageWithFigureExtension(),
+        # "markdown_captions",
+        "def_list",
+        "nl2br",
+        "sane_lists",
+        "pymdownx.tasklist",
+        "pymdownx.inlinehilite",
+        "pymdownx.blocks.tab",
+        "abbr",
+        "markdown_gfm_admonition",
+        "codehilite",
+        "fenced_code",
+        "tables",
+        "pymdownx.superfences",
+        "pymdownx.blocks.details",
+        "admonition",
+        # Registered once, where the later of the two registrations used to be
+        "toc",
+        # TODO Make base_url configurable to share between preview and editor
+        WikiLinkExtension(base_url=base_path + os.path.sep, end_url=".md"),
+        "md_in_html",
+        "footnotes",
+        "meta",
+    ]
+
+
+def build_converter(base_path: str) -> markdown.Markdown:
+    """
+    Builds the preview's converter, loading and configuring every extension.
+    """
+    return markdown.Markdown(
+        extensions=extensions(base_path), extension_configs=EXTENSION_CONFIGS
+    )
+
+
+# Converters keep state while converting, so each thread has its own
+converters = threading.local()
+
+
+def get_converter(base_path: Optional[str] = None) -> markdown.Markdown:
+    """
+    The calling thread's converter for a directory, built on first use.
+
+    Call `reset()` on it before converting each document.
+
+    Args:
+        base_path (Optional[str]): Defaults to the current working directory.
+    """
+    base_path = base_path or os.getcwd()
+    cache: Optional[Dict[str, markdown.Markdown]] = getattr(converters, "cache", None)
+    if cache is None:
+        cache = converters.cache = {}
+    converter = cache.get(base_path)
+    if converter is None:
+        converter = cache[base_path] = build_converter(base_path)
+    return converter
+
+
+DARK_MODE_PYGMENTS_STYLES = """
+            .highlight {
+                background-color: #2d2d2d;
+            }
+            .highlight pre {
+                background-color: #2d2d2d;
+            }
+            .highlight .hll {
+                background-color: #2d2d2d;
+            }
+            """
+
+DARK_MODE_STYLES = """
+            body {
+                background-color: #1e1e1e;
+                color: #d4d4d4;
+            }
+            a {
+                color: #3794ff;
+            }
+            code {
+                background-color: #2d2d2d;
+            }
+            .katex { color: #d4d4d4; }
+            """
+
+
+class StyleSheets:
+    """
+    Builds the CSS of preview pages once per stylesheet directory and theme.
+
+    Bundles are cached in memory and rebuilt only when a `.css` file in the
+    directory is added, removed or modified, or when the directory starts
+    being served by URL. Shared by every page, see `stylesheets`.
+    """
+
+    def __init__(self):
+        # (css_path, dark_mode) -> (stamp, links, inline styles)
+        self.bundles: Dict[Tuple[Optional[Path], bool], Tuple[tuple, str, str]] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def stamp(css_path: Optional[Path]) -> tuple:
+        """
+        The name, mtime and size of every CSS file in a directory.
+        """
+        if css_path is None:
+            return ()
+        try:
+            with os.scandir(css_path) as entries:
+                files = [
+                    (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                    for entry in entries
+                    if entry.name.endswith(".css") and entry.is_file()
+                ]
+        except OSError:
+            return ()
+        return tuple(sorted(files)), tuple(ASSET_DIRECTORIES.items())
+
+    def build(self, css_path: Optional[Path], dark_mode: bool) -> Tuple[str, str]:
+        """
+        The stylesheets of a page.
+
+        Args:
+            css_path (Optional[Path]): Directory of CSS files, applied in
+                alphabetical order.
+            dark_mode (bool): Use the dark theme.
+
+        Returns:
+            Tuple[str, str]: `<link>` elements for the files served by URL and
+                the styles to inline: the other files, Pygments' and the theme's.
+        """
+        key = (css_path, dark_mode)
+        stamp = self.stamp(css_path)
+        with self.lock:
+            cached = self.bundles.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1], cached[2]
+
+        links, css_styles = [], ""
+        for name, _, _ in stamp[0] if stamp else ():
+            css_file = css_path / name
+            url = asset_url(css_file)
+            if url is not None:
+                links.append(f'<link rel="stylesheet" href="{url}">')
+                continue
+            try:
+                with open(css_file, "r") as file:
+                    css_styles += file.read()
+            except OSError:
+                continue
+
+        # Add Pygments CSS for code highlighting
+        formatter = HtmlFormatter(style="default" if not dark_mode else "monokai")
+        pygments_css = formatter.get_style_defs(".highlight")
+        # Modify Pygments CSS for dark mode
+        if dark_mode:
+            pygments_css = pygments_css.replace(
+                "background: #f8f8f8", "background: #2d2d2d"
+            )
+            pygments_css += DARK_MODE_PYGMENTS_STYLES
+        css_styles += pygments_css
+
+        # Add dark mode styles if enabled
+        if dark_mode:
+            css_styles += DARK_MODE_STYLES
+
+        bundle = (stamp, "\n".join(links), css_styles)
+        with self.lock:
+            self.bundles[key] = bundle
+        return bundle[1], bundle[2]
+
+
+# Shared by every page built in the process
+stylesheets = StyleSheets()
+
+
+class Markdown:
+    def __init__(
+        self,
+        text: str,
+        css_path: Path | None = None,
+        dark_mode: bool = False,
+        base_path: str | None = None,
+    ):
+        """
+        Args:
+            text (str): The Markdown source.
+            css_path (Path | None): The directory of preview stylesheets.
+            dark_mode (bool): Use the dark variants of the styles.
+            base_path (str | None): The directory links and transclusions
+                resolve against, defaults to the current one when rendering.
+        """
+        self.css_path = css_path
+        self.dark_mode = dark_mode
+        self.base_path = base_path
+        self.text = text
+        self.math_blocks = []
+
+    def _preserve_math(self, match):
+        math = match.group(0)
+        placeholder = f"MATH_PLACEHOLDER_{len(self.math_blocks)}"
+        self.math_blocks.append(math)
+        return placeholder
+
+    def _restore_math(self, text):
+        for i, math in enumerate(self.math_blocks):
+            placeholder = f"MATH_PLACEHOLDER_{i}"
+            text = text.replace(placeholder, math)
+        return text
+
+    def make_html(self) -> str:
+        # Preserve math environments
+        text = BLOCK_MATH_PATTERN.sub(self._preserve_math, self.text)
+        text = INLINE_MATH_PATTERN.sub(self._preserve_math, text)
+
+        # The pipeline is built once per thread, only its state is reset
+        html_body = get_converter(self.base_path).reset().convert(text)
+
+        # Restore math environments
+        html_body = self._restore_math(html_body)
+
+        return html_body
+
+    def build_css_links(self) -> str:
+        """
+        Links the CSS files that are served by URL, see `ASSET_DIRECTORIES`.
+        """
+        return stylesheets.build(self.css_path, self.dark_mode)[0]
+
+    def build_css(self) -> str:
+        """
+        The styles inlined into the page, see `StyleSheets`.
+        """
+        return stylesheets.build(self.css_path, self.dark_mode)[1]
+
+    def build_html(self, content_editable=False, local_katex=True) -> str:
+        html_body = self.make_html()
+        css_styles = self.build_css()
+        content_editable_attr = 'contenteditable="true"' if content_editable else ""
+
+        katex_dark_mode_styles = (
+            """
+        .katex { color: #d4d4d4; }
+        """
+            if self.dark_mode
+            else ""
+        )
+
+        katex_min_css, katex_min_js, auto_render_min_js = get_katex_html(
+            local=local_katex
+        )
+        css_links = self.build_css_links()
+
+        # Allow separate dark mode styles
+        if self.dark_mode:
+            html_body = f'<div class="dark-mode">{html_body}</div>'
+
+        html = f"""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            {katex_min_css}
+            {css_links}
+            <style>
+            {css_styles}
+            {katex_dark_mode_styles}
+            </style>
+        </head>
+        <body {content_editable_attr}>
+            {html_body}
+            {katex_min_js}
+            {auto_render_min_js}
+            <script>
+            document.addEventListener("DOMContentLoaded", function() {{
+                renderMathInElement(document.body, {{
+                    delimiters: [
+                      {{left: "$$", right: "$$", display: true}},
+                      {{left: "$", right: "$", display: false}}
+                    ]
+                }});
+            }});
+            </script>
+        </body>
+        </html>
+        """
+        return html
+
+
+def install_katex():
+    current_dir = os.getcwd()
+    os.chdir(os.path.dirname(__file__))
+    os.makedirs("assets", exist_ok=True)
+    os.chdir("assets")
+    subprocess.run(["npm", "install", "katex"], check=True)
+    os.chdir(current_dir)
+
+
+def get_katex_html(local: bool = True) -> tuple[str, str, str]:
+    if local and asset_url(KATEX_DIR / "katex.min.js") is not None:
+        # The engine caches these, nothing is read or sent per page
+        return (
+            f'<link rel="stylesheet" href="{asset_url(KATEX_DIR / "katex.min.css")}">',
+            f'<script src="{asset_url(KATEX_DIR / "katex.min.js")}"></script>',
+            f'<script src="{asset_url(KATEX_DIR / "contrib" / "auto-render.min.js")}">'
+            "</script>",
+        )
+    if local:
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        # I can't get this to work unless the style is a link
+        katex_min_css_path = f"{dir_path}/assets/node_modules/katex/dist/katex.min.css"
+        with open(
+            f"{dir_path}/assets/node_modules/katex/dist/katex.min.js",
+            "r",
+            encoding="utf-8",
+        ) as f:
+            katex_min_js = f.read()
+        with open(
+            f"{dir_path}/assets/node_modules/katex/dist/contrib/auto-render.min.js",
+            "r",
+            encoding="utf-8",
+        ) as f:
+            auto_render_min_js = f.read()
+
+        return (
+            f'<link rel="stylesheet" href="{katex_min_css_path}" crossorigin="anonymous">',
+            f"<script>{katex_min_js}</script>",
+            f"<script>{auto_render_min_js}</script>",
+        )
+    else:
+        url = "https://cdn.jsdelivr.net/npm/katex@0.15.1/dist/"
+        katex_min_css = (
+            f'<link rel="stylesheet" href="{url}katex.min.css" crossorigin="anonymous">'
+        )
+        katex_min_js = (
+            f'<script defer src="{url}katex.min.js" crossorigin="anonymous"></script>'
+        )
+        auto_render_min_js = f'<script defer src="{url}contrib/auto-render.min.js" crossorigin="anonymous"></script>'
+        return katex_min_css, katex_min_js, auto_render_min_js
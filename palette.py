@@ -1,7 +1,10 @@
 import os
-from fts import FTS
+from fts import SEARCH_PAGE_SIZE, Link, SearchResult, SearchService
+from semantic import RelatedNote, SemanticIndex
 from markdown_utils import set_web_security_policies
 from utils import popup_notification
+from workspace import workspace_roots
+from filetree import file_tree
 from pathlib import Path
 from PyQt6.QtWebEngineCore import QWebEngineSettings
 from fuzzywuzzy import fuzz
@@ -15,16 +18,102 @@ from PyQt6.QtWidgets import (
     QVBoxLayout,
     QListWidgetItem,
 )
-from PyQt6.QtCore import QUrl, Qt, QEvent
+from PyQt6.QtCore import QPoint, QUrl, Qt, QEvent, QThread, pyqtSignal
 
 from markdown_utils import Markdown, WebEngineViewWithBaseUrl
+import sqlite3
 import sys
+import threading
+from typing import Callable, Optional
 
 from config import Config
 
 config = Config()
 
 
+class PaletteWorker(QThread):
+    """
+    Runs palette queries off the GUI thread so typing never waits on them.
+
+    Only the latest query matters: submitting one drops any that hasn't
+    started and interrupts a running search, and results are tagged with a
+    generation so the palette can ignore those of superseded queries.
+
+    Signals:
+        results_ready(int, object): The generation and result of a query.
+        query_finished(int): The generation of a query that returned, failed
+            or was interrupted. Any earlier ones are finished too.
+    """
+
+    results_ready = pyqtSignal(int, object)
+    query_finished = pyqtSignal(int)
+
+    def __init__(self, search_service: SearchService, parent=None):
+        super().__init__(parent)
+        self.search_service = search_service
+        self.condition = threading.Condition()
+        self.pending = None
+        self.generation = 0
+        self.stopping = False
+        self.thread_id = None
+
+    def submit(self, query: Callable[[], object]) -> int:
+        """
+        Queues a query, superseding any earlier one.
+
+        Args:
+            query (Callable[[], object]): Run on the worker thread, searches
+                should go through the `search_service` so they can be
+                interrupted.
+
+        Returns:
+            int: The generation `results_ready` will report for it.
+        """
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, query)
+            if self.thread_id is not None:
+                self.search_service.interrupt(self.thread_id)
+            self.condition.notify()
+        return self.generation
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.pending = None
+            if self.thread_id is not None:
+                self.search_service.interrupt(self.thread_id)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                # Set under the lock so `submit` never interrupts the next query
+                self.thread_id = None
+                while self.pending is None and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                generation, query = self.pending
+                self.pending = None
+                self.thread_id = threading.get_ident()
+            try:
+                result = query()
+            except sqlite3.OperationalError as e:
+                if str(e) != "interrupted":
+                    print(f"Palette query failed: {e}", file=sys.stderr)
+                self.query_finished.emit(generation)
+                continue
+            except Exception as e:
+                print(f"Palette query failed: {e}", file=sys.stderr)
+                self.query_finished.emit(generation)
+                continue
+            with self.condition:
+                if generation == self.generation:
+                    self.results_ready.emit(generation, result)
+            self.query_finished.emit(generation)
+
+
 class Palette(QDialog):
     def __init__(self, title="Palette", size=(400, 300), previewer=None):
         super().__init__()
@@ -65,6 +154,12 @@ class Palette(QDialog):
         # Check if it's been populated
         self.populated = False
 
+        # Runs queries in the background when set, see run_query
+        self.worker: Optional[PaletteWorker] = None
+        self.query_generation = 0
+        self.query_pending = False
+        self.apply_results = None
+
     def populate_items(self):
         raise NotImplementedError("Subclasses must implement populate_items method")
 
@@ -87,17 +182,19 @@ class Palette(QDialog):
         self.show()
         self.search_bar.setFocus()
         self.search_bar.clear()
-        if not self.populated:
-            self.populate_items()
-            self.populated = True
-        if refresh:
+        # Populate once, whether this is the first open or a refresh
+        if refresh or not self.populated:
             self.repopulate_items()
+            self.populated = True
 
     def _update_list_widget(self):
         self.list_widget.clear()
-        for item in self.filtered_items:
+        self._add_list_items(self.filtered_items)
+
+    def _add_list_items(self, items):
+        for item in items:
             list_item = QListWidgetItem(self.get_display_text(item))
-            list_item.setData(Qt.ItemDataRole.UserRole, item)
+            list_item.setData(Qt.ItemDataRole.UserRole, self.get_item_data(item))
             self.list_widget.addItem(list_item)
 
     def _filter_items(self, text, fuzzy=False):
@@ -120,10 +217,52 @@ class Palette(QDialog):
     def filter_items(self, text):
         self._filter_items(text)
 
+    def run_query(self, query, apply):
+        """
+        Runs `query` on the worker, if any, and passes its result to `apply`
+        unless another query was submitted in the meantime.
+        """
+        if self.worker is None:
+            apply(query())
+            return
+        if self.apply_results is None:
+            self.worker.results_ready.connect(self._results_ready)
+            self.worker.query_finished.connect(self._query_finished)
+        self.apply_results = apply
+        self.query_pending = True
+        self.query_generation = self.worker.submit(query)
+
+    def cancel_query(self):
+        """
+        Ignores the query in flight, e.g. once the list was filled without it.
+        """
+        self.query_generation = 0
+        self.query_pending = False
+
+    def _results_ready(self, generation, result):
+        # The worker is shared, results may belong to another palette
+        if generation == self.query_generation:
+            self.query_pending = False
+            self.apply_results(result)
+
+    def _query_finished(self, generation):
+        # Failed, interrupted, or superseded by a later query of any palette
+        if generation >= self.query_generation:
+            self.query_pending = False
+
+    def show_filtered_items(self, items):
+        self.filtered_items = items or []
+        self._update_list_widget()
+        self.highlight_first_item()
+
     def get_display_text(self, item):
         # To be overridden by subclasses if necessary
         return str(item)
 
+    def get_item_data(self, item):
+        # The data handed to execute_item, to be overridden if necessary
+        return item
+
     def eventFilter(self, obj, event):
         if obj == self.search_bar and event.type() == QEvent.Type.KeyPress:
             direction_keys = DirectionKeys(event)
@@ -235,8 +374,20 @@ class OpenFilePalette(Palette):
         self.main_layout.addWidget(self.splitter)
         self.list_widget.currentItemChanged.connect(self.preview_item)
 
+        self.worker = getattr(main_window, "palette_worker", None)
+
     def filter_items(self, text):
-        self._filter_items(text, fuzzy=True)
+        if not text:
+            # A late result for the previous text must not replace this
+            self.cancel_query()
+            self.show_filtered_items(self.items.copy())
+            return
+        # Snapshot the items, the worker must not see them change
+        items = self.items.copy()
+        displays = [self.get_display_text(item).lower() for item in items]
+        self.run_query(
+            lambda: fzy_sort(items, displays, text.lower()), self.show_filtered_items
+        )
 
     def preview_item(self, item):
         try:
@@ -275,13 +426,8 @@ class OpenFilePalette(Palette):
 
     def populate_items(self):
         self.items.clear()
-        current_dir = os.getcwd()
-        for root, dirs, files in os.walk(current_dir):
-            for file in files:
-                if file.endswith(".md"):
-                    full_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(full_path, current_dir)
-                    self.items.append(relative_path)
+        # Shared with the indexer, unchanged directories aren't read again
+        self.items.extend(file_tree(os.getcwd()).files([".md"]))
         self.filtered_items = self.items.copy()
         self._update_list_widget()
 
@@ -318,19 +464,220 @@ class InsertLinkPalette(OpenFilePalette):
 
 
 class SearchFilePalette(OpenFilePalette):
-    def __init__(self, main_window):
+    def __init__(self, main_window, search_service: SearchService):
         super().__init__(main_window)
-        self.setWindowTitle("Insert Link")
+        self.setWindowTitle("Search")
+        self.search_service = search_service
+        self.query = ""
+        # Rows whose snippets have been requested, see load_snippets
+        self.snippet_rows = set()
+
+        # Fetch the next page of results when scrolled to the bottom
+        self.list_widget.verticalScrollBar().valueChanged.connect(self.load_next_page)
+        self.list_widget.verticalScrollBar().valueChanged.connect(self.load_snippets)
 
     def filter_items(self, text):
-        fts = FTS()
-        current_dir = os.getcwd()
-        with FTS([".md"], current_dir) as fts:
-            self.filtered_items = fts.search(text)
+        self.query = text
+        query, mode = self.parse_query(text)
+        roots = workspace_roots()
+        # Snippets cost far more than ranking, only those in view are fetched
+        self.run_query(
+            lambda: self.search_service.search_workspace(
+                query, roots, mode=mode, snippets=False
+            ),
+            self.show_results,
+        )
+
+    def show_results(self, results):
+        self.snippet_rows = set()
+        self.show_filtered_items(results)
+        self.load_snippets()
+
+    def load_snippets(self, *_):
+        """
+        Fetches the snippets of the rows in view that don't have them yet.
+        """
+        # Let the results of the latest query arrive first
+        if self.query_pending or not self.filtered_items:
+            return
+        viewport = self.list_widget.viewport()
+        first = max(self.list_widget.indexAt(QPoint(0, 0)).row(), 0)
+        last = self.list_widget.indexAt(QPoint(0, viewport.height() - 1)).row()
+        if last < 0:
+            last = len(self.filtered_items) - 1
+        rows = [
+            row
+            for row in range(first, min(last + 1, len(self.filtered_items)))
+            if row not in self.snippet_rows
+            and isinstance(self.filtered_items[row], SearchResult)
+        ]
+        if not rows:
+            return
+        self.snippet_rows.update(rows)
+        results = [self.filtered_items[row] for row in rows]
+        query, mode = self.parse_query(self.query)
+        roots = workspace_roots()
+        self.run_query(
+            lambda: self.search_service.snippets(query, roots, results, mode),
+            lambda filled: self.show_snippets(rows, results, filled),
+        )
+
+    def show_snippets(self, rows, results, filled):
+        for row, result, new in zip(rows, results, filled):
+            if row < len(self.filtered_items) and self.filtered_items[row] is result:
+                self.filtered_items[row] = new
+                self.list_widget.item(row).setText(self.get_display_text(new))
+        # Scrolling while these were fetched may have brought more into view
+        self.load_next_page(self.list_widget.verticalScrollBar().value())
+        self.load_snippets()
+
+    def load_next_page(self, value):
+        if value < self.list_widget.verticalScrollBar().maximum():
+            return
+        # A short page means there is nothing more to fetch
+        if not self.filtered_items or len(self.filtered_items) % SEARCH_PAGE_SIZE:
+            return
+        # Let the results of the latest query arrive first
+        if self.query_pending:
+            return
+        query, mode = self.parse_query(self.query)
+        roots, offset = workspace_roots(), len(self.filtered_items)
+        self.run_query(
+            lambda: self.search_service.search_workspace(
+                query, roots, offset=offset, mode=mode, snippets=False
+            ),
+            self.show_next_page,
+        )
+
+    def show_next_page(self, page):
+        self.filtered_items.extend(page)
+        self._add_list_items(page)
+        self.load_snippets()
+
+    @staticmethod
+    def parse_query(text):
+        # A leading ~ searches for the text anywhere, e.g. in identifiers
+        if text.startswith("~"):
+            return text[1:], "substring"
+        return text, "prefix"
+
+    def get_display_text(self, item):
+        if isinstance(item, SearchResult):
+            path = item.path
+            # Notes from the other workspace roots are shown under their root
+            if item.root and item.root != os.getcwd():
+                path = os.path.join(os.path.basename(item.root), path)
+            if item.snippet:
+                return f"{path}\n    {' '.join(item.snippet.split())}"
+            return path
+        return str(item)
+
+    def get_item_data(self, item):
+        if isinstance(item, SearchResult):
+            return os.path.join(item.root, item.path) if item.root else item.path
+        return item
 
+
+class LinkGraphPalette(OpenFilePalette):
+    """
+    Lists notes from the link graph: those linking to the current note,
+    those it links to, or the notes with no links either way.
+    """
+
+    TITLES = {
+        "backlinks": "Backlinks",
+        "outgoing": "Outgoing Links",
+        "orphans": "Orphaned Notes",
+    }
+
+    def __init__(self, main_window, search_service: SearchService, direction="backlinks"):
+        super().__init__(main_window)
+        self.setWindowTitle(self.TITLES[direction])
+        self.search_service = search_service
+        self.direction = direction
+
+    def open(self, refresh: bool = True):
+        # The graph changes as notes are saved, so always repopulate
+        super().open(refresh=refresh)
+
+    def populate_items(self):
+        self.items.clear()
+        fts = self.search_service.get()
+        current_file = self.main_window.current_file()
+        if self.direction == "orphans":
+            self.items.extend(fts.orphans())
+        elif current_file:
+            if self.direction == "backlinks":
+                self.items.extend(fts.backlinks(current_file))
+            else:
+                self.items.extend(fts.outgoing_links(current_file))
+        self.filtered_items = self.items.copy()
         self._update_list_widget()
         self.highlight_first_item()
 
+    def get_display_text(self, item):
+        if isinstance(item, Link):
+            path = item.source if self.direction == "backlinks" else item.target
+            return f"{path} ({item.kind})"
+        return str(item)
+
+    def get_item_data(self, item):
+        if isinstance(item, Link):
+            path = item.source if self.direction == "backlinks" else item.target
+            return path if os.path.isfile(path) else None
+        return item
+
+
+class RelatedNotesPalette(OpenFilePalette):
+    """
+    Ranks the vault by similarity to the current buffer, see `SemanticIndex`.
+    """
+
+    def __init__(self, main_window, search_service: SearchService):
+        super().__init__(main_window)
+        self.setWindowTitle("Related Notes")
+        self.search_service = search_service
+        # Only used on the worker thread, like the connections they read
+        self.semantic_indexes = {}
+
+    def open(self, refresh: bool = True):
+        # Rank against the buffer as it is now
+        super().open(refresh=refresh)
+
+    def populate_items(self):
+        self.items = []
+        self.show_filtered_items([])
+        text = self.main_window.current_text()
+        current_file = self.main_window.current_file()
+        directory = os.getcwd()
+        self.run_query(
+            lambda: self.related(text, directory, current_file), self.show_related
+        )
+
+    def related(self, text, directory, current_file):
+        fts = self.search_service.get(directory)
+        index = self.semantic_indexes.get(directory)
+        # The connection is replaced when the index is reset
+        if index is None or index.fts is not fts:
+            index = SemanticIndex(fts)
+            self.semantic_indexes[directory] = index
+        exclude = fts.relative_path(current_file) if current_file else None
+        return index.related(text, exclude=exclude)
+
+    def show_related(self, notes):
+        self.items = notes
+        self.filter_items(self.search_bar.text())
+
+    def get_display_text(self, item):
+        if isinstance(item, RelatedNote):
+            return f"{item.path} ({item.score:.2f})"
+        return str(item)
+
+    def get_item_data(self, item):
+        if isinstance(item, RelatedNote):
+            return item.path
+        return item
+
 
 def fzy_dist(s1: str, s2: str) -> float:
     return fuzz.ratio(s1, s2)
@@ -344,7 +691,7 @@ def fzy_sort(values: list[str], displays: list[str], text: str) -> list[str] | N
         return None
 
     def sort_func(x):
-        return fzy_dist(x[0], text)
+        return fzy_dist(x[1], text)
 
     sorted_values = sorted(zip(values, displays), key=sort_func, reverse=True)
     sorted_values = [value for value, _ in sorted_values]
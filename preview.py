@@ -0,0 +1,195 @@
+"""
+Keeps the Markdown preview current without rendering on every keystroke,
+and without rendering on the GUI thread.
+"""
+
+import os
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, Hashable, NamedTuple, Optional
+
+from PyQt6.QtCore import QObject, QThread, QTimer, pyqtSignal
+
+from markdown_render import Markdown
+
+
+class RenderScheduler(QObject):
+    """
+    Collapses bursts of edits into a single preview render.
+
+    A render is requested once edits pause for `debounce_ms`, and at least
+    every `max_latency_ms` while they continue, so typing without a pause
+    still updates the preview. Scheduling only re-arms the timers, at most
+    one render is ever pending.
+
+    Signals:
+        render_requested(): The owner should render now.
+    """
+
+    render_requested = pyqtSignal()
+
+    def __init__(self, debounce_ms: int = 150, max_latency_ms: int = 500, parent=None):
+        """
+        Args:
+            debounce_ms (int): Quiet time after the last edit, 0 renders on
+                every edit.
+            max_latency_ms (int): The longest a pending render waits, 0 for
+                no bound.
+        """
+        super().__init__(parent)
+        self.debounce_timer = QTimer(self)
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.setInterval(debounce_ms)
+        self.debounce_timer.timeout.connect(self.fire)
+
+        self.latency_timer = QTimer(self)
+        self.latency_timer.setSingleShot(True)
+        self.latency_timer.setInterval(max_latency_ms)
+        self.latency_timer.timeout.connect(self.fire)
+
+    @property
+    def pending(self) -> bool:
+        return self.debounce_timer.isActive()
+
+    def schedule(self):
+        """
+        Requests a render for an edit, postponing one that is already pending.
+        """
+        if self.debounce_timer.interval() <= 0:
+            self.fire()
+            return
+        self.debounce_timer.start()
+        # The first edit of a burst starts the clock on its latency
+        if self.latency_timer.interval() > 0 and not self.latency_timer.isActive():
+            self.latency_timer.start()
+
+    def cancel(self):
+        """
+        Drops the pending render, e.g. when the preview was rendered anyway.
+        """
+        self.debounce_timer.stop()
+        self.latency_timer.stop()
+
+    def flush(self):
+        """
+        Renders right away if a render is pending.
+        """
+        if self.pending:
+            self.fire()
+
+    def fire(self):
+        self.cancel()
+        self.render_requested.emit()
+
+
+class RenderJob(NamedTuple):
+    """
+    A snapshot of everything a preview page is built from.
+    """
+
+    revision: int
+    text: str
+    css_path: Optional[Path]
+    dark_mode: bool
+    local_katex: bool
+    base_path: str
+
+
+class PreviewRenderer(QThread):
+    """
+    Builds preview pages, Markdown, highlighting and transclusions, on a
+    worker thread shared by every editor.
+
+    Each editor has at most one job waiting, submitting again replaces it,
+    so a backlog of edits renders once. Revisions are unique across editors,
+    an owner applies a page only if its revision is the last it submitted.
+    Pages that went stale while rendering are not emitted at all.
+
+    Signals:
+        rendered(int, str): The revision and the HTML of a page.
+    """
+
+    rendered = pyqtSignal(int, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.condition = threading.Condition()
+        self.revision = 0
+        # Waiting jobs and the last revision submitted, by owner
+        self.pending: Dict[Hashable, RenderJob] = {}
+        self.latest: Dict[Hashable, int] = {}
+        self.stopping = False
+
+    def submit(
+        self,
+        owner: Hashable,
+        text: str,
+        css_path: Optional[Path] = None,
+        dark_mode: bool = False,
+        local_katex: bool = True,
+        base_path: Optional[str] = None,
+    ) -> int:
+        """
+        Queues a render, replacing the owner's job if it hasn't started.
+
+        Args:
+            owner (Hashable): Identifies the preview, e.g. `id(editor)`.
+            text (str): The Markdown source, copied before submitting.
+            base_path (Optional[str]): Where links and transclusions resolve,
+                defaults to the current directory at the time of submitting.
+
+        Returns:
+            int: The revision `rendered` will report for the page.
+        """
+        with self.condition:
+            self.revision += 1
+            self.pending[owner] = RenderJob(
+                self.revision,
+                text,
+                css_path,
+                dark_mode,
+                local_katex,
+                base_path or os.getcwd(),
+            )
+            self.latest[owner] = self.revision
+            self.condition.notify()
+        return self.revision
+
+    def discard(self, owner: Hashable):
+        """
+        Forgets an owner, e.g. a closed tab, dropping its waiting job.
+        """
+        with self.condition:
+            self.pending.pop(owner, None)
+            self.latest.pop(owner, None)
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.pending.clear()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                # Oldest first, so that no editor's preview starves
+                owner = next(iter(self.pending))
+                job = self.pending.pop(owner)
+            try:
+                html = Markdown(
+                    text=job.text,
+                    css_path=job.css_path,
+                    dark_mode=job.dark_mode,
+                    base_path=job.base_path,
+                ).build_html(local_katex=job.local_katex)
+            except Exception as e:
+                print(f"Preview render failed: {e}", file=sys.stderr)
+                continue
+            with self.condition:
+                if self.latest.get(owner) == job.revision:
+                    self.rendered.emit(job.revision, html)
@@ -0,0 +1,462 @@
+"""
+Offline "related notes" search with TF-IDF and latent semantic analysis.
+
+The index is built from the bodies already stored in the FTS database and
+kept next to it as NumPy arrays. Notes are TF-IDF weighted over a pruned
+vocabulary and, unless `semantic_dimensions` is 0, projected onto the top
+singular vectors of that matrix (LSA) so that notes sharing related terms
+match even without shared words. Ranking the vault against a buffer is
+then a single matrix-vector product over a memory-mapped float32 matrix.
+"""
+
+import json
+import math
+import os
+import re
+import shutil
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from config import Config
+from fts import FTS, TOKEN_PATTERN
+
+config = Config()
+
+# Bump whenever the stored arrays change; older indexes are rebuilt
+SEMANTIC_VERSION = 1
+
+# Terms kept in the vocabulary, the most widespread first
+MAX_TERMS = 20000
+
+# Terms in fewer notes than this can't relate two notes
+MIN_DOCUMENT_FREQUENCY = 2
+
+# Terms in more than this fraction of notes carry no meaning
+MAX_DOCUMENT_FRACTION = 0.5
+
+# Extra random vectors and power iterations of the randomized SVD
+SVD_OVERSAMPLES = 10
+SVD_POWER_ITERATIONS = 2
+
+# Incremental updates fold changed notes into the existing vocabulary and
+# projection, past this fraction of changed notes the index is rebuilt
+REBUILD_FRACTION = 0.2
+
+# Elements of the dense blocks the sparse products work in, bounds memory
+DENSE_BLOCK_SIZE = 1 << 23
+
+RELATED_LIMIT = 50
+
+WORD_PATTERN = re.compile(TOKEN_PATTERN)
+
+STOP_WORDS = frozenset(
+    """
+    a an and are as at be but by for from has have he her his i if in into is
+    it its me my not of on or our she so than that the their them then there
+    these they this to was we were what when which who will with you your
+    """.split()
+)
+
+
+class RelatedNote(NamedTuple):
+    """
+    A note similar to the query text.
+
+    Attributes:
+        path (str): The path relative to the indexed directory.
+        score (float): The cosine similarity, higher is closer.
+    """
+
+    path: str
+    score: float
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits text into lower case words, dropping numbers and stop words.
+    """
+    return [
+        token
+        for token in WORD_PATTERN.findall(text.lower())
+        if len(token) > 1 and not token.isdigit() and token not in STOP_WORDS
+    ]
+
+
+def densify(
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    data: np.ndarray,
+    start: int,
+    end: int,
+    columns: int,
+) -> np.ndarray:
+    """
+    Expands rows `start` to `end` of a CSR matrix into a dense array.
+    """
+    lo, hi = indptr[start], indptr[end]
+    rows = np.repeat(np.arange(end - start), np.diff(indptr[start : end + 1]))
+    block = np.zeros((end - start, columns), dtype=np.float32)
+    block[rows, indices[lo:hi]] = data[lo:hi]
+    return block
+
+
+def sparse_dot(
+    csr: Tuple[np.ndarray, np.ndarray, np.ndarray],
+    columns: int,
+    dense: np.ndarray,
+    transpose: bool = False,
+) -> np.ndarray:
+    """
+    Multiplies a sparse matrix, or its transpose, by a dense matrix.
+
+    Rows are expanded into dense blocks of at most `DENSE_BLOCK_SIZE`
+    elements so the products run in BLAS, gathering the rows of `dense` for
+    every non-zero is much slower at the densities of a TF-IDF matrix.
+
+    Args:
+        csr (Tuple[np.ndarray, np.ndarray, np.ndarray]): The indptr, indices
+            and data of the sparse matrix.
+        columns (int): The number of columns of the sparse matrix.
+        dense (np.ndarray): A (columns, k) matrix, or (rows, k) when
+            multiplying by the transpose.
+        transpose (bool): Multiply by the transpose of the sparse matrix.
+
+    Returns:
+        np.ndarray: The (rows, k) product, or (columns, k) for the transpose.
+    """
+    rows = len(csr[0]) - 1
+    out = np.zeros((columns if transpose else rows, dense.shape[1]), np.float32)
+    step = max(1, DENSE_BLOCK_SIZE // max(columns, 1))
+    for start in range(0, rows, step):
+        end = min(start + step, rows)
+        block = densify(*csr, start, end, columns)
+        if transpose:
+            out += block.T @ dense[start:end]
+        else:
+            out[start:end] = block @ dense
+    return out
+
+
+def truncated_svd(
+    csr: Tuple[np.ndarray, np.ndarray, np.ndarray],
+    columns: int,
+    dimensions: int,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Finds the top right singular vectors of a sparse matrix.
+
+    Uses the randomized range finder of Halko, Martinsson and Tropp, which
+    only needs products with the matrix and its transpose.
+
+    Returns:
+        np.ndarray: A (columns, dimensions) float32 projection onto the
+            latent space.
+    """
+    rng = np.random.default_rng(seed)
+    width = min(dimensions + SVD_OVERSAMPLES, columns)
+    omega = rng.standard_normal((columns, width), dtype=np.float32)
+    y = sparse_dot(csr, columns, omega)
+    for _ in range(SVD_POWER_ITERATIONS):
+        q, _ = np.linalg.qr(y)
+        z, _ = np.linalg.qr(sparse_dot(csr, columns, q, transpose=True))
+        y = sparse_dot(csr, columns, z)
+    q, _ = np.linalg.qr(y)
+    # B = Q^T X, computed as (X^T Q)^T
+    b = sparse_dot(csr, columns, q, transpose=True).T
+    _, _, vt = np.linalg.svd(b, full_matrices=False)
+    return np.ascontiguousarray(vt[:dimensions].T, dtype=np.float32)
+
+
+def normalise_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (matrix / norms).astype(np.float32)
+
+
+def semantic_dir(db_path: Path) -> Path:
+    """
+    Where the semantic index of an FTS database is stored.
+    """
+    return db_path.with_name(db_path.stem + ".semantic")
+
+
+class SemanticIndex:
+    """
+    A TF-IDF / LSA index over the notes of an FTS database.
+
+    Not thread safe, like the FTS connection it reads from it should only
+    be used by one thread.
+    """
+
+    def __init__(self, fts: FTS, dimensions: Optional[int] = None):
+        """
+        Args:
+            fts (FTS): The full-text index whose documents are indexed.
+            dimensions (Optional[int]): Latent dimensions, 0 to rank by
+                TF-IDF alone. Defaults to the `semantic_dimensions` config
+                option.
+        """
+        self.fts = fts
+        if dimensions is None:
+            dimensions = config.config.get("semantic_dimensions", 128)
+        self.dimensions = dimensions
+        self.path = semantic_dir(fts.db_path)
+        self.paths: List[str] = []
+        self.hashes: List[str] = []
+        self.vocabulary: Dict[str, int] = {}
+        # Memory-mapped by `load`, see `save` for their layout
+        self.idf = self.indptr = self.indices = self.data = None
+        self.vectors = self.components = None
+        self.generation = None
+        self.load()
+
+    def load(self) -> None:
+        """
+        Opens the stored index, the large arrays are memory-mapped.
+        """
+        try:
+            with open(self.path / "meta.json", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return
+        if meta.get("version") != SEMANTIC_VERSION:
+            return
+        if meta.get("dimensions") != self.dimensions:
+            return
+        self.paths = meta["paths"]
+        self.hashes = meta["hashes"]
+        self.vocabulary = {term: i for i, term in enumerate(meta["vocabulary"])}
+        for name in ("idf", "indptr", "indices", "data", "vectors", "components"):
+            setattr(self, name, np.load(self.path / f"{name}.npy", mmap_mode="r"))
+
+    def save(self, **arrays: np.ndarray) -> None:
+        """
+        Writes the index, replacing the old files only once all are written.
+
+        Besides the paths, hashes and vocabulary in meta.json, the arrays are
+        the inverse document frequency of each term, the TF-IDF rows as CSR
+        (indptr, indices, data), the unit latent vector of each note and the
+        (terms, dimensions) projection onto the latent space.
+        """
+        staging = self.path.with_name(self.path.name + ".tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        for name, array in arrays.items():
+            np.save(staging / f"{name}.npy", array)
+        meta = {
+            "version": SEMANTIC_VERSION,
+            "dimensions": self.dimensions,
+            "paths": self.paths,
+            "hashes": self.hashes,
+            "vocabulary": sorted(self.vocabulary, key=self.vocabulary.get),
+        }
+        with open(staging / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(staging, self.path)
+        self.load()
+
+    def remove(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def weigh(self, documents: List[List[str]]) -> Tuple[np.ndarray, ...]:
+        """
+        TF-IDF weighs tokenized texts over the current vocabulary.
+
+        Returns:
+            Tuple[np.ndarray, ...]: The rows as CSR arrays, each normalised
+                to unit length.
+        """
+        indptr, indices, data = [0], [], []
+        for tokens in documents:
+            counts = Counter(
+                self.vocabulary[token] for token in tokens if token in self.vocabulary
+            )
+            columns = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+            tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+            weights = (1 + np.log(tf)) * self.idf[columns]
+            norm = np.linalg.norm(weights)
+            order = np.argsort(columns)
+            indices.append(columns[order])
+            data.append(weights[order] / (norm or 1))
+            indptr.append(indptr[-1] + len(counts))
+        return (
+            np.asarray(indptr, dtype=np.int64),
+            np.concatenate(indices) if indices else np.zeros(0, np.int32),
+            np.concatenate(data).astype(np.float32) if data else np.zeros(0),
+        )
+
+    def project(self, csr: Tuple[np.ndarray, np.ndarray, np.ndarray]) -> np.ndarray:
+        """
+        Maps TF-IDF rows into the latent space, one unit vector per row.
+        """
+        if not len(self.components):
+            return np.zeros((len(csr[0]) - 1, 0), dtype=np.float32)
+        components = np.asarray(self.components)
+        return normalise_rows(sparse_dot(csr, len(components), components))
+
+    def rebuild(self, documents: List[Tuple[str, str, str]]) -> None:
+        """
+        Builds the index from scratch, choosing a new vocabulary.
+
+        Args:
+            documents (List[Tuple[str, str, str]]): The path, hash and body
+                of every note.
+        """
+        tokens = [tokenize(body) for _, _, body in documents]
+        frequencies = Counter(term for terms in tokens for term in set(terms))
+        most = MAX_DOCUMENT_FRACTION * len(documents)
+        terms = [
+            term
+            for term, df in frequencies.most_common()
+            if MIN_DOCUMENT_FREQUENCY <= df <= max(most, MIN_DOCUMENT_FREQUENCY)
+        ][:MAX_TERMS]
+        terms.sort()
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        df = np.array([frequencies[term] for term in terms], dtype=np.float32)
+        self.idf = np.log((1 + len(documents)) / (1 + df)) + 1
+        self.paths = [path for path, _, _ in documents]
+        self.hashes = [digest for _, digest, _ in documents]
+        csr = self.weigh(tokens)
+        dimensions = min(self.dimensions, len(documents) - 1, len(terms) - 1)
+        if dimensions > 0:
+            self.components = truncated_svd(csr, len(terms), dimensions)
+        else:
+            self.components = np.zeros((len(terms), 0), dtype=np.float32)
+        self.save(
+            idf=self.idf,
+            indptr=csr[0],
+            indices=csr[1],
+            data=csr[2],
+            vectors=self.project(csr),
+            components=self.components,
+        )
+
+    def update(
+        self, documents: List[Tuple[str, str, str]], removed: List[str]
+    ) -> None:
+        """
+        Replaces changed notes and drops removed ones, keeping the vocabulary.
+
+        Args:
+            documents (List[Tuple[str, str, str]]): The path, hash and body
+                of each new or changed note.
+            removed (List[str]): The paths of deleted notes.
+        """
+        dropped = set(removed) | {path for path, _, _ in documents}
+        keep = np.array([path not in dropped for path in self.paths], dtype=bool)
+        counts = np.diff(self.indptr)[keep]
+        nonzeros = np.repeat(keep, np.diff(self.indptr))
+        csr = self.weigh([tokenize(body) for _, _, body in documents])
+        indptr = np.concatenate(
+            ([0], np.cumsum(np.concatenate((counts, np.diff(csr[0])))))
+        ).astype(np.int64)
+        indices = np.concatenate((self.indices[nonzeros], csr[1]))
+        data = np.concatenate((self.data[nonzeros], csr[2]))
+        vectors = np.concatenate((self.vectors[keep], self.project(csr)))
+        self.paths = [p for p, k in zip(self.paths, keep) if k]
+        self.paths += [path for path, _, _ in documents]
+        self.hashes = [h for h, k in zip(self.hashes, keep) if k]
+        self.hashes += [digest for _, digest, _ in documents]
+        self.save(
+            idf=np.asarray(self.idf),
+            indptr=indptr,
+            indices=indices,
+            data=data,
+            vectors=vectors,
+            components=np.asarray(self.components),
+        )
+
+    def refresh(self) -> None:
+        """
+        Brings the index up to date with the FTS database, if it changed.
+        """
+        generation = self.fts.generation
+        if generation == self.generation:
+            return
+        manifest = self.fts.manifest_hashes()
+        current = dict(zip(self.paths, self.hashes))
+        changed = [path for path, h in manifest.items() if current.get(path) != h]
+        removed = [path for path in current if path not in manifest]
+        if not self.vocabulary or (
+            len(changed) + len(removed) > REBUILD_FRACTION * len(manifest)
+        ):
+            self.rebuild(self.fts.read_documents())
+        elif changed or removed:
+            self.update(self.fts.read_documents(changed), removed)
+        self.generation = generation
+
+    def related(
+        self,
+        text: str,
+        limit: int = RELATED_LIMIT,
+        exclude: Optional[str] = None,
+    ) -> List[RelatedNote]:
+        """
+        Ranks the notes by similarity to some text, e.g. the current buffer.
+
+        Args:
+            text (str): The query text.
+            limit (int): The number of notes to return.
+            exclude (Optional[str]): A path to leave out, e.g. the note the
+                text came from.
+
+        Returns:
+            List[RelatedNote]: The closest notes, best first.
+        """
+        self.refresh()
+        if not self.paths:
+            return []
+        csr = self.weigh([tokenize(text)])
+        if not len(csr[1]):
+            return []
+        if self.vectors.shape[1]:
+            query = self.project(csr)[0]
+            scores = self.vectors @ query
+        else:
+            # Without LSA, the dot product of the sparse rows and the query
+            dense = np.zeros(len(self.vocabulary), dtype=np.float32)
+            dense[csr[1]] = csr[2]
+            rows = np.repeat(np.arange(len(self.paths)), np.diff(self.indptr))
+            scores = np.bincount(
+                rows, weights=self.data * dense[self.indices], minlength=len(self.paths)
+            )
+        if exclude is not None and exclude in self.paths:
+            scores[self.paths.index(exclude)] = -math.inf
+        limit = min(limit, len(scores))
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [
+            RelatedNote(self.paths[i], float(scores[i]))
+            for i in top
+            if scores[i] > 0 and np.isfinite(scores[i])
+        ]
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(description="List notes related to a note")
+    parser.add_argument("note")
+    parser.add_argument("directory", nargs="?", default=os.getcwd())
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+    with FTS([".md"], os.path.abspath(args.directory)) as fts:
+        index = SemanticIndex(fts)
+        start = time.perf_counter()
+        index.refresh()
+        print(f"Refreshed in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+        with open(args.note, encoding="utf-8") as f:
+            text = f.read()
+        start = time.perf_counter()
+        results = index.related(text, args.limit, fts.relative_path(args.note))
+        elapsed = (time.perf_counter() - start) * 1000
+        for result in results:
+            print(f"{result.score:.3f}  {result.path}")
+        print(f"Ranked {len(index.paths)} notes in {elapsed:.1f}ms", file=sys.stderr)
@@ -0,0 +1,54 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# The modules live at the top of the repository, not in a package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import fts  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def data_home(tmp_path, monkeypatch):
+    """
+    Keeps every index a test builds out of the real data directory.
+    """
+    data_home = tmp_path / "data"
+    monkeypatch.setattr(fts.config, "data_home", data_home)
+    return data_home
+
+
+@pytest.fixture
+def vault(tmp_path):
+    """
+    A directory of a few notes, not yet indexed.
+    """
+    vault = tmp_path / "vault"
+    vault.mkdir()
+    (vault / "apples.md").write_text(
+        "# Orchards\n\nApples grow on trees. #fruit\n", encoding="utf-8"
+    )
+    (vault / "boats.md").write_text(
+        "# Harbours\n\nBoats float in the harbour. #travel\n", encoding="utf-8"
+    )
+    return vault
+
+
+@pytest.fixture(scope="session")
+def qapp():
+    from PyQt6.QtWidgets import QApplication
+
+    app = QApplication.instance()
+    if app is None:
+        try:
+            from asset_scheme import register_scheme
+        except ImportError:
+            pass
+        else:
+            # Must happen before the application is created, see main
+            register_scheme()
+        app = QApplication([])
+    return app
@@ -0,0 +1,55 @@
+import pytest
+
+import fts
+from fts import FTS
+from workspace import Workspace
+
+
+@pytest.fixture
+def index(vault):
+    with FTS([".md"], str(vault)) as index:
+        index.index_current_dir(quiet=True)
+        yield index
+
+
+def paths(results):
+    return sorted(result.path for result in results)
+
+
+@pytest.mark.parametrize("mode", ["fts", "prefix"])
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        ("tag:fruit", ["apples.md"]),
+        ("heading:harbours", ["boats.md"]),
+        ("title:apples", ["apples.md"]),
+        ("path:boats", ["boats.md"]),
+    ],
+)
+def test_field_aliases(index, mode, query, expected):
+    assert paths(index.search(query, mode=mode)) == expected
+
+
+def test_field_aliases_in_fts_syntax(index):
+    assert paths(index.search("tag:fruit OR tag:travel")) == ["apples.md", "boats.md"]
+    assert paths(index.search("{tag heading}: orchards")) == ["apples.md"]
+    # Only the headings are searched, "harbour" is in the body of boats.md
+    assert paths(index.search("heading:harbour")) == []
+
+
+def test_field_aliases_across_workspace(index, vault):
+    with Workspace([str(vault)]) as workspace:
+        assert paths(workspace.search("tag:travel")) == ["boats.md"]
+
+
+def test_progress_is_reported_within_a_batch(vault, monkeypatch):
+    monkeypatch.setattr(fts, "PROGRESS_INTERVAL", 0)
+    reports = []
+    with FTS([".md"], str(vault)) as index:
+        index.index_current_dir(
+            quiet=True, progress=lambda done, total: reports.append((done, total))
+        )
+    # Far fewer files than `BATCH_SIZE`, each one is still reported
+    assert reports[0] == (0, 2)
+    assert (1, 2) in reports
+    assert reports[-1] == (2, 2)
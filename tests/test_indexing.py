@@ -0,0 +1,49 @@
+import pytest
+
+from fts import FTS, SearchService
+
+
+def paths(results):
+    return sorted(result.path for result in results)
+
+
+def test_save_without_root_indexes_current_directory(qapp, vault, monkeypatch):
+    from indexing import IndexWatcher
+
+    monkeypatch.chdir(vault)
+    service = SearchService([".md"])
+    watcher = IndexWatcher(service)
+    assert watcher.root is None
+
+    (vault / "cakes.md").write_text("Cakes need flour.\n", encoding="utf-8")
+    watcher.file_saved(str(vault / "cakes.md"))
+
+    assert paths(service.search("flour")) == ["cakes.md"]
+    service.close_all()
+
+
+def test_launch_without_dir_keeps_index_current(qapp, vault, monkeypatch):
+    # The web engine needs system libraries that headless machines may lack
+    pytest.importorskip("PyQt6.QtWebEngineWidgets", exc_type=ImportError)
+    from config import Config
+    from main import MainWindow
+
+    with FTS([".md"], str(vault)) as fts:
+        fts.index_current_dir(quiet=True)
+    monkeypatch.chdir(vault)
+    config = Config()
+    config.config.update(index_watch=True, index_poll_interval=30000)
+    window = MainWindow(config.default_style_path, config)
+    try:
+        # No `--dir`, the working directory is watched and rescanned
+        assert window.index_watcher.root == str(vault)
+        assert window.index_watcher.poll_timer.isActive()
+
+        editor = window.tab_widget.currentWidget()
+        editor.current_file = str(vault / "cakes.md")
+        editor.editor.setPlainText("Cakes need flour.\n")
+        window.save_file()
+
+        assert paths(window.search_service.search("flour")) == ["cakes.md"]
+    finally:
+        window.close()
@@ -0,0 +1,351 @@
+"""
+Searches several indexed directories, e.g. work and personal notes, as one.
+
+Each root keeps its own database, see `FTS.set_db_path`, so adding or
+removing a root never re-indexes the others. A `Workspace` attaches the
+databases to one connection and runs a query against each in a single
+statement, merging the results by bm25 rank.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from config import Config
+from fts import (
+    GLOB_PATTERN,
+    SCHEMA_VERSION,
+    SEARCH_PAGE_SIZE,
+    SNIPPET_TRIGRAMS,
+    QueryCache,
+    SearchResult,
+    inflate,
+    database_path,
+    parse_highlight,
+    match_query,
+    snippet_column,
+    snippet_source,
+)
+
+config = Config()
+
+
+def workspace_roots(current_dir: Optional[str] = None) -> List[str]:
+    """
+    The directories searched together: the current one first, then those
+    listed under `workspace_roots` in the config.
+
+    Missing directories and duplicates are dropped.
+    """
+    roots = [current_dir or os.getcwd()]
+    roots += [
+        os.path.expanduser(root) for root in config.config.get("workspace_roots") or []
+    ]
+    unique = {}
+    for root in roots:
+        root = os.path.abspath(root)
+        if os.path.isdir(root):
+            unique.setdefault(os.path.normcase(root), root)
+    return list(unique.values())
+
+
+class Workspace:
+    """
+    A read-only view over the indexes of several directories.
+
+    The databases are attached read-only to an in-memory connection as
+    `root0`, `root1`, ... Scores are computed by each index against its own
+    statistics, which is close enough to rank notes of similar vaults
+    against each other.
+    """
+
+    def __init__(self, roots: List[str]):
+        """
+        Args:
+            roots (List[str]): The indexed directories.
+        """
+        # URI filenames let `attach` open the indexes read-only
+        self.db = sqlite3.connect("file::memory:", uri=True, check_same_thread=False)
+        # Each index's `documents` view decompresses bodies with this
+        self.db.create_function("inflate", 1, inflate, deterministic=True)
+        limit = self.db.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        if len(roots) > limit:
+            raise ValueError(f"A workspace can have at most {limit} roots")
+        self.roots: List[str] = []
+        # Root directory by schema name, and whether it has a trigram index
+        self.schemas: Dict[str, str] = {}
+        self.trigram: Dict[str, bool] = {}
+        # Roots whose index couldn't be attached, by the mtime it had then
+        self.pending: Dict[str, str] = {}
+        self.cache = QueryCache()
+        for root in roots:
+            self.attach(root)
+
+    def attach(self, root: str) -> bool:
+        """
+        Adds a directory, opening its index read-only as it is.
+
+        Building or upgrading an index is left to `FTS`, a directory that
+        hasn't been indexed, or whose index has an older schema, is only
+        searched once it has been, see `attach_pending`.
+
+        Returns:
+            bool: Whether the index was attached.
+        """
+        root = os.path.abspath(root)
+        if root in self.schemas.values():
+            return True
+        if root not in self.roots:
+            self.roots.append(root)
+        db_path = database_path(root)
+        if not db_path.exists():
+            if self.pending.get(root) != "missing":
+                print(f"{root} hasn't been indexed, not searching it", file=sys.stderr)
+            self.pending[root] = "missing"
+            return False
+        schema = f"root{len(self.schemas)}"
+        while schema in self.schemas:
+            schema += "_"
+        self.db.execute(
+            "ATTACH DATABASE ? AS ?", (db_path.as_uri() + "?mode=ro", schema)
+        )
+        (version,) = self.db.execute(f"PRAGMA {schema}.user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            self.db.execute("DETACH DATABASE ?", (schema,))
+            if self.pending.get(root) != "outdated":
+                print(
+                    f"The index of {root} is out of date, not searching it "
+                    "until it is rebuilt",
+                    file=sys.stderr,
+                )
+            self.pending[root] = "outdated"
+            return False
+        (trigram,) = self.db.execute(
+            f"SELECT count(*) FROM {schema}.sqlite_master WHERE name = 'fts_trigram'"
+        ).fetchone()
+        self.pending.pop(root, None)
+        self.schemas[schema] = root
+        self.trigram[schema] = bool(trigram)
+        return True
+
+    def attach_pending(self) -> None:
+        """
+        Retries the roots `attach` left out, in case they have been indexed
+        since. Checking the stored schema version is cheap and, unlike the
+        file's mtime, can't miss a rebuild within the same clock tick.
+        """
+        for root in list(self.pending):
+            self.attach(root)
+
+    def detach(self, root: str) -> None:
+        """
+        Removes a directory, its index is left as it is.
+        """
+        root = os.path.abspath(root)
+        if root in self.pending:
+            del self.pending[root]
+            self.roots.remove(root)
+        for schema, attached in list(self.schemas.items()):
+            if attached == root:
+                self.db.execute("DETACH DATABASE ?", (schema,))
+                del self.schemas[schema]
+                del self.trigram[schema]
+                self.roots.remove(root)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def generation(self) -> tuple:
+        """
+        A token that changes whenever any of the indexes is written or the
+        roots change, see `FTS.generation`.
+        """
+        versions = []
+        for schema, root in self.schemas.items():
+            (version,) = self.db.execute(f"PRAGMA {schema}.data_version").fetchone()
+            versions.append((schema, root, version))
+        return tuple(versions)
+
+    def root_select(
+        self, schema: str, text: str, mode: str, window: int, snippets: bool = True
+    ) -> Tuple[str, tuple]:
+        """
+        The statement finding the best matches in one root.
+
+        Mirrors `FTS.iter_rows` and `FTS.substring_cursor`, every statement
+        selects (root, path, rank, snippet) and keeps at most `window` rows,
+        -1 for all of them. Snippets are '' unless `snippets` is set.
+        """
+        root = (self.schemas[schema],)
+        if text.strip() == "":
+            return (
+                f"SELECT ?, path, 0.0, '' FROM {schema}.files "
+                f"ORDER BY path LIMIT {window}",
+                root,
+            )
+        if mode != "substring":
+            snippet = snippet_column("fts") if snippets else "''"
+            return (
+                f"""
+                SELECT ?, title, rank, {snippet}
+                FROM {schema}.fts WHERE fts MATCH ?
+                ORDER BY rank LIMIT {window}
+                """,
+                (*root, text),
+            )
+        table = "fts_trigram" if self.trigram[schema] else "fts"
+        if GLOB_PATTERN.search(text):
+            pattern = text if text.startswith("*") else "*" + text
+            pattern = pattern if pattern.endswith("*") else pattern + "*"
+            return (
+                f"SELECT ?, title, 0.0, '' FROM {schema}.{table} "
+                f"WHERE body GLOB ? ORDER BY title LIMIT {window}",
+                (*root, pattern),
+            )
+        if self.trigram[schema] and len(text) >= 3:
+            phrase = '"' + text.replace('"', '""') + '"'
+            snippet = snippet_column(table, SNIPPET_TRIGRAMS) if snippets else "''"
+            return (
+                f"""
+                SELECT ?, title, rank, {snippet}
+                FROM {schema}.{table} WHERE {table} MATCH ?
+                ORDER BY rank LIMIT {window}
+                """,
+                (*root, phrase),
+            )
+        escaped = re.sub(r"([\\%_])", r"\\\1", text)
+        return (
+            f"SELECT ?, title, 0.0, '' FROM {schema}.{table} "
+            f"WHERE body LIKE ? ESCAPE '\\' ORDER BY title LIMIT {window}",
+            (*root, f"%{escaped}%"),
+        )
+
+    def iter_search(
+        self,
+        query: str,
+        limit: int = -1,
+        offset: int = 0,
+        mode: str = "fts",
+        snippets: bool = True,
+    ) -> Iterator[SearchResult]:
+        """
+        Streams results from every root, best first, see `FTS.iter_search`.
+
+        Each root contributes at most its best `offset + limit` matches, so
+        FTS5 can still stop early, which are then merged by rank and path.
+
+        Yields:
+            SearchResult: Matches with `root` set to the directory they were
+                found in and `path` relative to it.
+        """
+        if not self.schemas:
+            return
+        query = match_query(query, mode)
+        window = -1 if limit < 0 else offset + limit
+        selects, params = [], []
+        for schema in self.schemas:
+            select, values = self.root_select(schema, query, mode, window, snippets)
+            # Compound members can't have their own ORDER BY and LIMIT
+            selects.append(f"SELECT * FROM ({select})")
+            params.extend(values)
+        sql = " UNION ALL ".join(selects)
+        try:
+            cursor = self.db.execute(
+                f"{sql} ORDER BY 3, 2, 1 LIMIT ? OFFSET ?", (*params, limit, offset)
+            )
+        except sqlite3.OperationalError as e:
+            if str(e) == "interrupted":
+                raise
+            print(f"Invalid query: {e}", file=sys.stderr)
+            return
+        for root, path, rank, snippet in cursor:
+            text, matches = parse_highlight(snippet)
+            yield SearchResult(path, rank, text, matches, root)
+
+    def search(
+        self,
+        query: str,
+        limit: int = SEARCH_PAGE_SIZE,
+        offset: int = 0,
+        mode: str = "fts",
+        snippets: bool = True,
+    ) -> List[SearchResult]:
+        """
+        Searches every root, caching pages until one of the indexes changes.
+
+        See `FTS.search` for the arguments.
+        """
+        if self.pending:
+            self.attach_pending()
+        self.cache.validate(self.generation)
+        key = (query, mode, limit, offset, snippets)
+        rows = self.cache.get(key)
+        if rows is None:
+            results = self.iter_search(query, limit, offset, mode, snippets)
+            rows = [(None, result) for result in results]
+            self.cache.put(key, rows)
+        return [result for _, result in rows]
+
+    def snippets(
+        self, query: str, mode: str, results: List[SearchResult]
+    ) -> List[SearchResult]:
+        """
+        Fills in the snippets of results found with `snippets=False`, one
+        statement per root, see `FTS.snippets`.
+        """
+        found: Dict[Tuple[str, str], Tuple[str, list]] = {}
+        for schema, root in self.schemas.items():
+            paths = [result.path for result in results if result.root == root]
+            source = snippet_source(query, mode, self.trigram[schema])
+            if source is None or not paths:
+                continue
+            table, match, tokens = source
+            try:
+                cursor = self.db.execute(
+                    f"""
+                    SELECT title, {snippet_column(table, tokens)}
+                    FROM {schema}.{table} WHERE {table} MATCH ? AND rowid IN (
+                        SELECT id FROM {schema}.files
+                        WHERE path IN (SELECT value FROM json_each(?))
+                    )
+                    """,
+                    (match, json.dumps(paths)),
+                )
+                for path, snippet in cursor:
+                    found[root, path] = parse_highlight(snippet)
+            except sqlite3.OperationalError as e:
+                if str(e) == "interrupted":
+                    raise
+                print(f"Invalid query: {e}", file=sys.stderr)
+        filled = []
+        for result in results:
+            if (result.root, result.path) in found:
+                snippet, matches = found[result.root, result.path]
+                result = result._replace(snippet=snippet, matches=matches)
+            filled.append(result)
+        return filled
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Search several indexes at once")
+    parser.add_argument("query")
+    parser.add_argument("roots", nargs="+", help="Indexed directories")
+    parser.add_argument("--mode", default="prefix")
+    parser.add_argument("--limit", type=int, default=SEARCH_PAGE_SIZE)
+    args = parser.parse_args()
+    with Workspace(args.roots) as workspace:
+        results = workspace.search(args.query, args.limit, mode=args.mode)
+    json.dump([result._asdict() for result in results], sys.stdout, indent=2)
+    sys.stdout.write("\n")